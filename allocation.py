@@ -33,19 +33,199 @@ class Block:
     free      = attr.ib(cmp = False, hash = False, default = False)
     prev_free = attr.ib(cmp = False, hash = False, default = None)
     next_free = attr.ib(cmp = False, hash = False, default = None)
+    gen       = attr.ib(cmp = False, hash = False, default = 0)
 
 
 class AllocationError(Exception):
     pass
 
 
+@attr.s
+class AllocationCounters:
+    """
+    Counts of operations on an allocation map, for performance
+    statistics.  search_hops counts the index nodes, free list blocks
+    or bitmap words examined while searching for free space.
+    """
+    allocate    = attr.ib(default = 0)
+    free        = attr.ib(default = 0)
+    find_free   = attr.ib(default = 0)
+    search_hops = attr.ib(default = 0)
+
+
+@attr.s(frozen = True)
+class AllocationSnapshot:
+    """
+    Saved state of an Allocation, returned by Allocation.snapshot().
+    Not to be examined by callers.
+    """
+    allocation = attr.ib()
+    blocks     = attr.ib()
+    total_free = attr.ib()
+    first_free = attr.ib()
+    next_free  = attr.ib()
+    index      = attr.ib()
+
+
 class AllocationPolicy(Enum):
     FIRST_FIT = 1
     ROTATING_FIRST_FIT = 2
+    BEST_FIT = 3
+
+
+class FreeIndex:
+    """
+    Used internally to Allocation to index free blocks by address and
+    by size.  Not part of public API.
+
+    Free blocks are indexed by address with a sparse implicit binary
+    tree over the address space, in which each node holds the size of
+    the largest free block starting within its address range, so that
+    the lowest addressed free block of at least a given size, at or
+    above a given address, can be found in O(log address space size).
+    Free blocks are also kept in a list sorted by size, for best fit.
+    """
+    def __init__(self, size: int, counters: AllocationCounters = None):
+        self._counters = counters if counters is not None else AllocationCounters()
+        self._leaf_base = 1 << max(1, (size - 1).bit_length())
+        self._max = { }     # tree node index -> largest free block size
+        self._by_size = SortedList()   # (size, addr) of free blocks
+        # True if the containers are shared with a snapshot, and must be
+        # copied before they are modified
+        self._shared = False
+
+    def _own(self):
+        if self._shared:
+            self._max = dict(self._max)
+            self._by_size = self._by_size.copy()
+            self._shared = False
+
+    def _set(self, addr: int, size: int):
+        m = self._max
+        i = self._leaf_base + addr
+        if size:
+            m[i] = size
+        else:
+            m.pop(i, None)
+        i >>= 1
+        while i:
+            v = max(m.get(2 * i, 0), m.get(2 * i + 1, 0))
+            if m.get(i, 0) == v:
+                break    # no change to this node or its ancestors
+            if v:
+                m[i] = v
+            else:
+                del m[i]
+            i >>= 1
+
+    def add(self, addr: int, size: int):
+        self._own()
+        self._by_size.add((size, addr))
+        self._set(addr, size)
+
+    def remove(self, addr: int, size: int):
+        self._own()
+        self._by_size.remove((size, addr))
+        self._set(addr, 0)
+
+    def resize(self, addr: int, old_size: int, new_size: int):
+        self._own()
+        self._by_size.remove((old_size, addr))
+        self._by_size.add((new_size, addr))
+        self._set(addr, new_size)
+
+    def first_fit(self, size: int, start: int = 0) -> int:
+        """
+        Return the address of the lowest addressed free block at or
+        above start of at least the specified size, or None.
+        """
+        m = self._max
+        leaf_base = self._leaf_base
+        size = max(size, 1)
+        if m.get(1, 0) < size or start >= leaf_base:
+            return None
+        i = leaf_base + start
+        hops = 1
+        if m.get(i, 0) < size:
+            # go up until a right sibling contains a large enough block
+            while True:
+                if i == 1:
+                    self._counters.search_hops += hops
+                    return None
+                if (i & 1) == 0 and m.get(i + 1, 0) >= size:
+                    i += 1
+                    break
+                i >>= 1
+                hops += 1
+            # then go down to the leftmost large enough block
+            while i < leaf_base:
+                i *= 2
+                if m.get(i, 0) < size:
+                    i += 1
+                hops += 1
+        self._counters.search_hops += hops
+        return i - leaf_base
+
+    def last_before(self, end: int) -> int:
+        """
+        Return the address of the highest addressed free block below
+        end, or None.
+        """
+        m = self._max
+        leaf_base = self._leaf_base
+        if end >= leaf_base:
+            i = 1
+            if i not in m:
+                return None
+        else:
+            i = leaf_base + end
+            # go up until a left sibling contains a free block
+            while True:
+                if i == 1:
+                    return None
+                if (i & 1) and (i - 1) in m:
+                    i -= 1
+                    break
+                i >>= 1
+        # then go down to the rightmost free block
+        while i < leaf_base:
+            i = 2 * i + 1
+            if i not in m:
+                i -= 1
+        return i - leaf_base
+
+    def snapshot(self):
+        self._shared = True
+        return (self._max, self._by_size)
+
+    def restore(self, state):
+        self._max, self._by_size = state
+        self._shared = True
+
+    def best_fit(self, size: int) -> int:
+        """
+        Return the address of the smallest free block of at least the
+        specified size, lowest address first among equal sizes, or None.
+        """
+        i = self._by_size.bisect_left((size, -1))
+        self._counters.search_hops += 1
+        if i == len(self._by_size):
+            return None
+        return self._by_size[i][1]
 
 
 class Allocation:
-    def __init__(self, size: int, name: str = None, policy = AllocationPolicy.FIRST_FIT):
+    def __init__(self, size: int, name: str = None, policy = AllocationPolicy.FIRST_FIT,
+                 indexed: bool = False):
+        """
+        Args:
+            size:    size of the address space
+            name:    name for debugging
+            policy:  AllocationPolicy for allocations without an address
+            indexed: if True, maintain a FreeIndex so that searching for
+                     free space is O(log n) rather than walking the
+                     free list
+        """
         if size < 1:
             raise ValueError('requested size is negative or zero')
 
@@ -58,12 +238,27 @@ class Allocation:
         self._next_free  = 0	# start addr of next free block to consider
                                 # for allocation
 
+        # Blocks are shared with snapshots, and are copied on write.
+        # Blocks with a generation number other than the current one
+        # may be shared.  The block list itself is also shared if
+        # _blocks_shared is True, and is copied before it's modified.
+        self._gen = 0
+        self._blocks_shared = False
+
         block = Block(addr = 0,
                       size = size,
                       free = True)
 
         self._blocks = SortedList([block], key = lambda b: b.addr)
 
+        self.counters = AllocationCounters()
+
+        if indexed:
+            self._index = FreeIndex(size, self.counters)
+            self._index.add(0, size)
+        else:
+            self._index = None
+
 
     def _dump(self):
         """
@@ -75,11 +270,38 @@ class Allocation:
             print(b)
 
 
-    def _find_block(self, addr: int, exact: bool = False, require_free: bool = False):
+    def _own(self, b: Block) -> Block:
+        """
+        Return a block that may be modified, which is a copy of the
+        given block if it may be shared with a snapshot.
+        """
+        if b.gen == self._gen:
+            return b
+        nb = attr.evolve(b, gen = self._gen)
+        blocks = self._own_blocks()
+        blocks.remove(b)
+        blocks.add(nb)
+        return nb
+
+
+    def _own_blocks(self):
+        """
+        Return the block list, copying it first if it's shared with a
+        snapshot.
+        """
+        if self._blocks_shared:
+            self._blocks = self._blocks.copy()
+            self._blocks_shared = False
+        return self._blocks
+
+
+    def _find_block(self, addr: int, exact: bool = False, require_free: bool = False,
+                    writable: bool = False):
         """
         Find the block that contains a particular address, optionally
         reqiring exactly matching the start address, and optionally requiring
-        the block to be free.
+        the block to be free. If writable is True, the returned block
+        may be modified.
         """
         i = self._blocks.bisect_key_right(addr)
         b = self._blocks[i-1]
@@ -87,6 +309,8 @@ class Allocation:
             assert b.addr == addr
         if require_free:
             assert b.free
+        if writable:
+            b = self._own(b)
         return b
         
 
@@ -95,35 +319,43 @@ class Allocation:
         Given the address of a free block and a size, split that block into
         two blocks, the first of which will be of the specified size.
         """
-        b = self._find_block(addr, exact = True, require_free = True)
+        b = self._find_block(addr, exact = True, require_free = True, writable = True)
         assert size < b.size
         nb = Block(addr = addr + size,
                    size = b.size - size,
                    data = b.data,
                    free = b.free,
                    prev_free = addr,
-                   next_free = b.next_free)
+                   next_free = b.next_free,
+                   gen = self._gen)
+        if nb.next_free is not None:
+            self._find_block(nb.next_free, exact = True, writable = True).prev_free = nb.addr
+        if self._index is not None:
+            self._index.resize(addr, b.size, size)
+            self._index.add(nb.addr, nb.size)
         b.size = size
         b.next_free = nb.addr
-        self._blocks.add(nb)
+        self._own_blocks().add(nb)
 
 
     def _allocate_block(self, addr: int, data):
         """
         Given the address of a free block, allocate the block.
         """
-        b = self._find_block(addr, exact = True, require_free = True)
+        b = self._find_block(addr, exact = True, require_free = True, writable = True)
 
         self._total_free -= b.size
+        if self._index is not None:
+            self._index.remove(b.addr, b.size)
 
         if b.prev_free is not None:
-            pb = self._find_block(b.prev_free, exact = True)
+            pb = self._find_block(b.prev_free, exact = True, writable = True)
             pb.next_free = b.next_free
         else:
             self._first_free = b.next_free
 
         if b.next_free is not None:
-            nb = self._find_block(b.next_free, exact = True)
+            nb = self._find_block(b.next_free, exact = True, writable = True)
             nb.prev_free = b.prev_free
         else:
             nb = None
@@ -179,25 +411,69 @@ class Allocation:
             else:
                 raise AllocationError('requested address range unavailable')
 
-        second_pass = False
+        self.counters.find_free += 1
+        if self._index is not None:
+            addr = self._find_free_indexed(size)
+        else:
+            addr = self._find_free_list(size)
+        if addr is None:
+            raise AllocationError('insufficient contiguous free space available')
+        return addr
+
+
+    def _find_free_indexed(self, size: int) -> int:
+        if self._policy == AllocationPolicy.BEST_FIT:
+            return self._index.best_fit(size)
+        if self._policy == AllocationPolicy.ROTATING_FIRST_FIT:
+            addr = None
+            if self._next_free is not None:
+                addr = self._index.first_fit(size, self._next_free)
+            if addr is None:
+                addr = self._index.first_fit(size)
+            if addr is not None:
+                self._next_free = addr
+            return addr
+        return self._index.first_fit(size)
+
+
+    def _find_free_list(self, size: int) -> int:
+        """
+        Search for free space by walking the free list.
+        """
+        if self._first_free is None:
+            return None
+        if self._policy == AllocationPolicy.BEST_FIT:
+            best = None
+            b = self._find_block(self._first_free, require_free = True)
+            while True:
+                self.counters.search_hops += 1
+                if b.size >= size and (best is None or b.size < best.size):
+                    best = b
+                if b.next_free is None:
+                    break
+                b = self._find_block(b.next_free, require_free = True)
+            return None if best is None else best.addr
+
+        if (self._policy == AllocationPolicy.ROTATING_FIRST_FIT and
+            self._next_free is not None):
+            start = self._next_free
+        else:
+            start = self._first_free
+        addr = start
         while True:
-            if self._policy == AllocationPolicy.ROTATING_FIRST_FIT:
-#                i = self._blocks.bisect_key_right(self._next_free)
-#                b = self._blocks[i-1]
-                b = self._find_block(self._next_free, require_free = True)
-            else:
-                b = self._find_block(self._first_free, require_free = True)
+            b = self._find_block(addr, require_free = True)
+            self.counters.search_hops += 1
             if b.size >= size:
-                addr = b.addr
-                break
-            self._next_free = b.next_free
-            if self._next_free is None:
-                if second_pass or self._policy == AllocationPolicy.FIRST_FIT:
-                    raise AllocationError('insufficient contiguous free space available')
-                self._next_free = self._first_free
-                second_pass = True
-                continue
-        return addr
+                if self._policy == AllocationPolicy.ROTATING_FIRST_FIT:
+                    self._next_free = b.addr
+                return b.addr
+            addr = b.next_free
+            if addr is None:
+                if self._policy != AllocationPolicy.ROTATING_FIRST_FIT:
+                    return None
+                addr = self._first_free
+            if addr == start:
+                return None
 
 
     def is_available(self, addr: int, size: int) -> bool:
@@ -276,41 +552,181 @@ class Allocation:
             if debug:
                 print('have match, allocating')
             self._allocate_block(addr, data)
+            self.counters.allocate += 1
             break
             
         return addr
 
 
+    def _prev_free_block_addr(self, addr: int) -> int:
+        """
+        Return the address of the highest addressed free block below addr,
+        or None.
+        """
+        if self._index is not None:
+            return self._index.last_before(addr)
+        i = self._blocks.bisect_key_left(addr) - 1
+        while i >= 0:
+            if self._blocks[i].free:
+                return self._blocks[i].addr
+            i -= 1
+        return None
+
+
+    def _next_free_block_addr(self, addr: int) -> int:
+        """
+        Return the address of the lowest addressed free block above addr,
+        or None.
+        """
+        if self._index is not None:
+            return self._index.first_fit(1, addr + 1)
+        i = self._blocks.bisect_key_right(addr)
+        while i < len(self._blocks):
+            if self._blocks[i].free:
+                return self._blocks[i].addr
+            i += 1
+        return None
+
+
+    def _merge_with_next_free(self, b: Block):
+        """
+        Merge a free block with the immediately following block, which
+        must also be free.
+        """
+        nb = self._find_block(b.addr + b.size, exact = True, require_free = True)
+        assert b.next_free == nb.addr
+        if self._index is not None:
+            self._index.remove(nb.addr, nb.size)
+            self._index.resize(b.addr, b.size, b.size + nb.size)
+        b.size += nb.size
+        b.next_free = nb.next_free
+        if nb.next_free is not None:
+            self._find_block(nb.next_free, exact = True, writable = True).prev_free = b.addr
+        if self._next_free == nb.addr:
+            self._next_free = b.addr
+        self._own_blocks().remove(nb)
+
+
+    def free(self, addr: int):
+        """
+        Free a previously allocated block, merging it with adjacent
+        free blocks.
+
+        Args:
+            addr:   The start address of the allocated block
+
+        Raises:
+            AllocationError
+        """
+        i = self._blocks.bisect_key_left(addr)
+        if (i == len(self._blocks) or self._blocks[i].addr != addr or
+            self._blocks[i].free):
+            raise AllocationError('no allocated block at requested address')
+        b = self._own(self._blocks[i])
+        self.counters.free += 1
+
+        # link into the free list
+        prev_addr = self._prev_free_block_addr(addr)
+        next_addr = self._next_free_block_addr(addr)
+        b.free = True
+        b.data = None
+        b.prev_free = prev_addr
+        b.next_free = next_addr
+        if prev_addr is not None:
+            self._find_block(prev_addr, exact = True, writable = True).next_free = addr
+        else:
+            self._first_free = addr
+        if next_addr is not None:
+            self._find_block(next_addr, exact = True, writable = True).prev_free = addr
+        self._total_free += b.size
+        if self._index is not None:
+            self._index.add(addr, b.size)
+
+        # coalesce with adjacent free blocks
+        if next_addr == addr + b.size:
+            self._merge_with_next_free(b)
+        if prev_addr is not None:
+            pb = self._find_block(prev_addr, exact = True, writable = True)
+            if pb.addr + pb.size == addr:
+                self._merge_with_next_free(pb)
+
+
+    def snapshot(self) -> AllocationSnapshot:
+        """
+        Save the state of the allocation, so that it can later be
+        restored. The block list, the blocks and the free index are
+        shared between the allocation and its snapshots, so this takes
+        constant time. Each block is copied when it's first modified,
+        and the block list and free index are copied, in time linear
+        in the number of blocks, when they're first modified after a
+        snapshot or restore.
+
+        Returns:
+            An AllocationSnapshot to be passed to restore().
+        """
+        snapshot = AllocationSnapshot(allocation = self,
+                                      blocks = self._blocks,
+                                      total_free = self._total_free,
+                                      first_free = self._first_free,
+                                      next_free = self._next_free,
+                                      index = (self._index.snapshot()
+                                               if self._index is not None
+                                               else None))
+        self._blocks_shared = True
+        self._gen += 1
+        return snapshot
+
+
+    def restore(self, snapshot: AllocationSnapshot):
+        """
+        Restore the state of the allocation to that saved by snapshot(),
+        in constant time. A snapshot may be restored more than once.
+        """
+        assert snapshot.allocation is self
+        self._blocks = snapshot.blocks
+        self._blocks_shared = True
+        self._total_free = snapshot.total_free
+        self._first_free = snapshot.first_free
+        self._next_free = snapshot.next_free
+        if self._index is not None:
+            self._index.restore(snapshot.index)
+        self._gen += 1
+
+
     def free_space(self, addr: int = 0, size: int = None):
         """
         Returns the amount of free space available within an address
         range, which defaults to the entire address space.
         """
+        if size is None:
+            size = self._size - addr
+        if addr == 0 and size == self._size:
+            return self._total_free
+        return sum(s for a, s in self.free_ranges(addr, size))
+
+
+    def free_ranges(self, addr: int = 0, size: int = None):
+        """
+        Generates (addr, size) tuples of the free ranges within an
+        address range, which defaults to the entire address space, in
+        address order.
+        """
         if size is None:
             size = self._size - addr
         if addr < 0:
             raise ValueError('requested address is negative')
         if addr + size > self._size:
             raise ValueError('requested range extends beyond address space.')
-
-        #if addr == 0 and size == self._size:
-        #    return self._total_free
-
-        sa = addr
-        count = 0
-        b = self._find_block(sa)
-        sa += b.size
-        if b.free:
-            count += b.size - (b.addr - addr)
-        while addr + size > b.addr + b.size:
-            b = self._find_block(sa)
-            sa += b.size
+        end = addr + size
+        i = self._blocks.bisect_key_right(addr) - 1
+        for b in self._blocks.islice(i):
+            if b.addr >= end:
+                break
             if b.free:
-                if addr + size >= b.addr + b.size:
-                    count += b.size
-                else:
-                    count += (addr + size) - b.addr
-        return count
+                start = max(b.addr, addr)
+                stop = min(b.addr + b.size, end)
+                if stop > start:
+                    yield (start, stop - start)
 
 
     def allocated_space(self, addr: int = 0, size: int = None):
@@ -350,3 +766,162 @@ class Allocation:
         ff = self.find_free(1)
         lf = self.last_free_range()
         return ff == lf
+
+
+class SlotAllocator:
+    """
+    Allocation map of a fixed number of equal size slots, identified by
+    index, such as the entries of an object table.  Slots are tracked
+    with a bitmap of 64-bit words, with a hint of the lowest possibly
+    free slot, so that allocating the lowest free slot is O(1) amortized.
+    """
+    _full = (1 << 64) - 1
+
+    def __init__(self, count: int, name: str = None):
+        """
+        Args:
+            count: number of slots
+            name: name used in error messages
+        """
+        if count < 1:
+            raise ValueError('requested slot count is negative or zero')
+        self._count = count
+        self._name = name
+        self._words = [0] * ((count + 63) // 64)
+        self._hint = 0       # no free slots below this index
+        self._end = 0        # one past the highest used slot
+        self._used = 0
+        self.counters = AllocationCounters()
+
+    def __len__(self):
+        return self._count
+
+    def _check_index(self, index: int):
+        if index < 0 or index >= self._count:
+            raise AllocationError('%s slot %d out of range' % (self._name, index))
+
+    def is_free(self, index: int) -> bool:
+        self._check_index(index)
+        return not (self._words[index >> 6] >> (index & 63)) & 1
+
+    def used_count(self) -> int:
+        return self._used
+
+    def end(self) -> int:
+        """
+        Return one past the index of the highest used slot, or zero if
+        no slots are used.
+        """
+        return self._end
+
+    def find_free(self, start: int = 0) -> int:
+        """
+        Return the index of the lowest free slot at or above start,
+        or None if there is none.
+        """
+        self.counters.find_free += 1
+        return self._find_free(start)
+
+    def _find_free(self, start: int = 0) -> int:
+        start = max(start, self._hint)
+        if start >= self._count:
+            return None
+        words = self._words
+        w = start >> 6
+        word = words[w] | ((1 << (start & 63)) - 1)
+        while word == self._full:
+            w += 1
+            if w == len(words):
+                self.counters.search_hops += w - (start >> 6)
+                return None
+            word = words[w]
+        self.counters.search_hops += w - (start >> 6) + 1
+        index = (w << 6) + (~word & (word + 1)).bit_length() - 1
+        if index >= self._count:
+            return None
+        return index
+
+    def claim(self, index: int):
+        """
+        Mark a specific slot as used.
+
+        Raises:
+            AllocationError: the slot is out of range or already used
+        """
+        if not self.is_free(index):
+            raise AllocationError('%s slot %d already allocated' % (self._name, index))
+        self._words[index >> 6] |= 1 << (index & 63)
+        self.counters.allocate += 1
+        self._used += 1
+        self._end = max(self._end, index + 1)
+        if index == self._hint:
+            self._hint += 1
+
+    def allocate(self) -> int:
+        """
+        Allocate the lowest free slot, and return its index.
+
+        Raises:
+            AllocationError: no free slots
+        """
+        index = self.find_free()
+        if index is None:
+            raise AllocationError('%s has no free slots' % self._name)
+        self._hint = index
+        self.claim(index)
+        return index
+
+    def reserve(self, start: int, count: int):
+        """
+        Mark a range of slots as used.
+
+        Raises:
+            AllocationError: the range is out of range or any slot in
+            it is already used
+        """
+        if count <= 0:
+            return
+        self._check_index(start)
+        self._check_index(start + count - 1)
+        if not all(self.is_free(i) for i in range(start, start + count)):
+            raise AllocationError('%s slots %d..%d not available' % (self._name, start, start + count - 1))
+        for i in range(start, start + count):
+            self._words[i >> 6] |= 1 << (i & 63)
+        self.counters.allocate += 1
+        self._used += count
+        self._end = max(self._end, start + count)
+        if start <= self._hint < start + count:
+            self._hint = start + count
+
+    def free(self, index: int):
+        """
+        Mark a used slot as free.
+
+        Raises:
+            AllocationError: the slot is out of range or not used
+        """
+        if self.is_free(index):
+            raise AllocationError('%s slot %d not allocated' % (self._name, index))
+        self._words[index >> 6] &= ~(1 << (index & 63))
+        self.counters.free += 1
+        self._used -= 1
+        self._hint = min(self._hint, index)
+        if index + 1 == self._end:
+            while self._end and self.is_free(self._end - 1):
+                self._end -= 1
+
+    def free_ranges(self, end: int = None):
+        """
+        Generates (start, count) tuples of the runs of free slots below
+        end, which defaults to the end of the highest used slot, in
+        index order.
+        """
+        if end is None:
+            end = self._end
+        index = self._find_free()
+        while index is not None and index < end:
+            stop = index + 1
+            while stop < end and self.is_free(stop):
+                stop += 1
+            yield (index, stop - index)
+            index = self._find_free(stop)
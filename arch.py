@@ -17,32 +17,26 @@
 
 import argparse
 import collections
+import os
+import pickle
 import re
 import sys
 import warnings
 import xml.etree.ElementTree
 
+import archtables
+from archtables import (add_arch_cache_arguments, arch_cache_key,
+                        load_tables_py, update_tables_py)
+
 class Arch(object):
     Symbol = collections.namedtuple('Symbol', ['type',
                                                'value'])
 
-    SizedValue = collections.namedtuple('SizedValue', ['size_bits',
-                                                       'value'])
-    SizedValue.__str__ = lambda self: ("{:0" + str(self.size_bits) + "b}").format(self.value)
-
-    Format = collections.namedtuple('Format', ['encoding',
-                                               'operands'])
-
-    Class = collections.namedtuple('Class', ['encoding',
-                                             'reserved',
-                                             'refs',
-                                             'branch_ref',
-                                             'operators'])
-
-    Operator = collections.namedtuple('Operator', ['names',
-                                                   'id',
-                                                   'clas',
-                                                   'encoding']) # opcode
+    # shared with decoding tables modules
+    SizedValue = archtables.SizedValue
+    Format = archtables.Format
+    Class = archtables.Class
+    Operator = archtables.Operator
 
     class Field(object):
         # a factory method
@@ -307,33 +301,70 @@ class Arch(object):
         return ed
 
 
-    # ensure that no two entries in a dictionary have sized values that conflict
-    # (neither can be a prefix of the other)
-    # XXX would be nice to report missing encodings
+    # Ensure that no two entries in a dictionary have sized values that
+    # conflict (neither can be a prefix of the other), and optionally that
+    # there are no missing encodings. This is done by building a binary
+    # trie of the encodings, consuming bits LSB first as the processor
+    # does, so it is linear in the total length of the encodings.
     def validate_encodings (self, d, name, attr='encoding', check_missing=True):
-        items = list(d.values())
-        if len(items) == 0:
+        if len(d) == 0:
             return
-        max_len = max([getattr(i, attr).size_bits for i in items])
-
-        for i in range(len(items)-1):
-            enc_i = getattr(items[i], attr)
-            for j in range(i+1, len(items)):
-                enc_j = getattr(items[j], attr)
-                if self.is_prefix_of(enc_i, enc_j):
-                    print(name, enc_i, 'is prefix of', enc_j)
-                if self.is_prefix_of(enc_j, enc_i):
-                    print(name, enc_j, 'is prefix of', enc_i)
-                assert ((not self.is_prefix_of(enc_i, enc_j)) and
-                        (not self.is_prefix_of(enc_j, enc_i)))
+        # trie node is a list [child for 0 bit, child for 1 bit, encoding]
+        # where encoding is not None only for leaves
+        root = [None, None, None]
+        conflict = False
+        for v in d.values():
+            enc = getattr(v, attr)
+            node = root
+            for i in range(enc.size_bits):
+                if node[2] is not None:
+                    print(name, node[2], 'is prefix of', enc)
+                    conflict = True
+                    break
+                bit = (enc.value >> i) & 1
+                if node[bit] is None:
+                    node[bit] = [None, None, None]
+                node = node[bit]
+            else:
+                if node[2] is not None:
+                    print(name, node[2], 'is prefix of', enc)
+                    conflict = True
+                elif node[0] is not None or node[1] is not None:
+                    print(name, enc, 'is prefix of', self.trie_first_leaf(node))
+                    conflict = True
+                else:
+                    node[2] = enc
+        assert not conflict
 
         if not check_missing:
             return
-        bin_entries = self.expand_encoding_dict(d)
-        # for i in range(1 << max_len):
-        #     if bin_entries [i] is None:
-        #         print("no %s entry for %s" % (name, ("{:0" + str(max_len) + "b}").format(i)))
-        assert None not in bin_entries
+        missing = self.trie_missing_encodings(root)
+        for prefix in missing:
+            print("no %s entry for %s" % (name, str(prefix) if prefix.size_bits else "(empty)"))
+        assert len(missing) == 0
+
+    def trie_first_leaf(self, node):
+        while node[2] is None:
+            node = node[0] if node[0] is not None else node[1]
+        return node[2]
+
+    # Returns a list of SizedValue prefixes, each of which represents
+    # all encodings starting with that prefix being missing.
+    def trie_missing_encodings(self, root):
+        missing = []
+        stack = [(root, 0, 0)]
+        while stack:
+            node, size_bits, value = stack.pop()
+            if node[2] is not None:
+                continue
+            for bit in (1, 0):
+                child_value = value | (bit << size_bits)
+                if node[bit] is None:
+                    missing.append(self.SizedValue(size_bits + 1, child_value))
+                else:
+                    stack.append((node[bit], size_bits + 1, child_value))
+        missing.sort(key = lambda p: str(p)[::-1])
+        return missing
 
 
     operand_type_to_bits = { 'b': 8,
@@ -349,22 +380,20 @@ class Arch(object):
 
     def parse_operands_string(self, operand_string, get_modes = False):
         branch_ref = False
-        if len(operand_string) == 0:
-            return [], branch_ref
-        ops = operand_string.split(',')
-        if ops[-1] == 'br':
+        ops = operand_string.split(',') if operand_string else []
+        if ops and ops[-1] == 'br':
             branch_ref = True
             ops = ops[:-1]
         modes = []
         if get_modes:
             for op in ops:
-                m = operand_re.match(op)
-                if m:
+                m = self.operand_re.match(op)
+                if m and m.group(3):
                     mode = m.group(3)
                 else:
                     mode = 'r'
                 modes += [mode]
-        opl = [self.operand_type_to_bits[o] for o in ops]
+        opl = [self.operand_type_to_bits[self.operand_strip_mode(o)] for o in ops]
         if get_modes:
             return opl, modes, branch_ref
         else:
@@ -426,6 +455,7 @@ class Arch(object):
             operator_elem = operator_elems[name]
             id = int(operator_elem['id'])
             operands = self.operands_strip_modes(operator_elem['operands'])
+            modes = tuple(self.parse_operands_string(operator_elem['operands'], get_modes = True)[1])
             encoding = self.size_and_value(operator_elem['encoding'])
             clas = self.class_by_operands [operands]
             if id in self.operator_by_id:
@@ -434,16 +464,18 @@ class Arch(object):
                 assert id == operator.id
                 assert clas == operator.clas
                 assert encoding == operator.encoding
+                assert modes == operator.modes
                 operator.names.append(name)
             else:
-                operator = self.Operator([name], id, clas, encoding)
+                operator = self.Operator([name], id, clas, encoding, modes)
                 self.operator_by_id [id] = operator
                 # also add operator to class operator dict
                 assert encoding not in clas.operators
                 clas.operators [encoding] = operator
         # validate per-class opcode dicts
         for operands in self.class_by_operands:
-            self.validate_encodings(self.class_by_operands[operands].operators, 'class(%s)' % str(clas.encoding))
+            clas = self.class_by_operands[operands]
+            self.validate_encodings(clas.operators, 'class(%s)' % str(clas.encoding))
 
 
     def parse_instruction_set(self, instruction_set):
@@ -480,6 +512,87 @@ class Arch(object):
 # XXX                self.symbols[name] = self.Symbol(child.tag, segment)
 
 
+# The Symbol namedtuple type is created inside the Arch class body,
+# but namedtuple() doesn't know that, so fix up its qualified name to
+# allow pickle to find it.
+Arch.Symbol.__qualname__ = 'Arch.Symbol'
+
+
+# Constructing an Arch from the XML definition is comparatively slow, so
+# the fully constructed Arch can be cached on disk as a pickle, keyed by
+# archtables.arch_cache_key().
+def load_arch(arch_file, cache_dir = None, use_cache = True, rebuild = False):
+    """
+    Construct an Arch from an open architecture definition file, using
+    an on-disk cache if possible.
+
+    Args:
+        arch_file: open file (text or binary) containing the XML definition
+        cache_dir: directory for cache files, defaults to __pycache__
+                   in the directory containing the definition file
+        use_cache: if False, neither read nor write the cache
+        rebuild:   if True, ignore any existing cache entry and replace it
+
+    Returns:
+        An Arch.
+    """
+    arch_xml = arch_file.read()
+    if isinstance(arch_xml, str):
+        arch_xml = arch_xml.encode('utf-8')
+    key = arch_cache_key(arch_xml)
+
+    arch_path = getattr(arch_file, 'name', None)
+    if cache_dir is None and isinstance(arch_path, str) and os.path.isfile(arch_path):
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(arch_path)),
+                                 '__pycache__')
+    if cache_dir is None:
+        use_cache = False
+
+    if use_cache:
+        prefix = os.path.basename(arch_path) if isinstance(arch_path, str) else 'arch'
+        cache_fn = os.path.join(cache_dir,
+                                '%s.%s.pickle' % (prefix, key))
+        if not rebuild:
+            try:
+                with open(cache_fn, 'rb') as f:
+                    arch = pickle.load(f)
+                if isinstance(arch, Arch) and getattr(arch, 'source_hash', None) == key:
+                    return arch
+            except (OSError, EOFError, pickle.UnpicklingError,
+                    AttributeError, ImportError):
+                pass
+
+    arch_root = xml.etree.ElementTree.fromstring(arch_xml)
+    arch = Arch(xml.etree.ElementTree.ElementTree(arch_root))
+    # identifies the definition, e.g. for incremental image builds
+    arch.source_hash = key
+
+    if use_cache:
+        try:
+            os.makedirs(cache_dir, exist_ok = True)
+            # remove stale cache entries for the same definition file
+            for fn in os.listdir(cache_dir):
+                if fn.startswith(prefix + '.') and fn.endswith('.pickle'):
+                    os.remove(os.path.join(cache_dir, fn))
+            temp_fn = '%s.%d.tmp' % (cache_fn, os.getpid())
+            with open(temp_fn, 'wb') as f:
+                pickle.dump(arch, f, protocol = pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_fn, cache_fn)
+        except OSError as e:
+            print('unable to write architecture cache:', e)
+
+    return arch
+
+
+def load_arch_from_args(args):
+    arch = load_arch(args.arch,
+                     cache_dir = args.arch_cache_dir,
+                     use_cache = not args.no_arch_cache,
+                     rebuild = args.rebuild_arch_cache)
+    args.arch.close()
+    return arch
+
+
 def gen_operator_h(arch, f):
     f.write('// Automatically generated - do not edit!\n')
     f.write('\n')
@@ -520,6 +633,27 @@ def gen_operator_h(arch, f):
     f.write('} class_info_t;\n')
     f.write('\n')
 
+    f.write('typedef struct dispatch_info_t\n')
+    f.write('{\n')
+    f.write('  int bit_len;  // class and format, 0 for a fallback entry\n')
+    f.write('  bool reserved;\n')
+    f.write('  int order;\n')
+    f.write('  operand_len_t operand_len [3];\n')
+    f.write('  int operand_ref [3];  // data reference index, -1 for operand stack\n')
+    f.write('  int ref_count;\n')
+    f.write('  bool branch_ref;\n')
+    f.write('  int opcode_base;  // index in dispatch_opcode_table\n')
+    f.write('  int opcode_mask;\n')
+    f.write('  int fallback_base;  // index in dispatch_table\n')
+    f.write('  int fallback_mask;\n')
+    f.write('} dispatch_info_t;\n')
+    f.write('\n')
+
+    f.write('extern const int dispatch_index_bits;\n')
+    f.write('extern const dispatch_info_t dispatch_table [];\n')
+    f.write('extern const operator_info_t dispatch_opcode_table [];\n')
+    f.write('\n')
+
     for id in arch.operator_by_id:
         operator = arch.operator_by_id[id]
         f.write('  /* %3d */ operator_fn_t op_%s;' % (id, operator.names [0]))
@@ -598,6 +732,267 @@ def gen_tables_c(arch, f):
     f.write('\n')
 
 
+# A single-level dispatch table, indexed by the low index_bits bits of
+# an instruction, which are the class and format encodings, padded with
+# whatever follows.  Each entry gives everything needed to decode the
+# rest of the instruction.  The opcode follows the data and branch
+# references, so it can't be part of the index; instead the opcode
+# tables of all classes are concatenated into a single table, and each
+# entry gives the index of its class's opcode table within it, and the
+# mask for the opcode bits.
+#
+# If index_bits is less than the longest class and format encoding, the
+# entries for index values that are a prefix of longer encodings are
+# fallback entries, with a bit_len of zero.  The entry to use is then at
+# fallback_base + ((bits >> index_bits) & fallback_mask), in the same
+# table.
+
+DispatchEntry = collections.namedtuple('DispatchEntry', ['bit_len',
+                                                         'clas',
+                                                         'format',
+                                                         'operand_refs',  # per operand, data reference index or None for stack
+                                                         'ref_count',
+                                                         'opcode_base',
+                                                         'opcode_mask',
+                                                         'fallback_base',
+                                                         'fallback_mask'])
+
+
+def _expand_sized(items, bits):
+    # items are (SizedValue, item); returns a list of 2**bits items, with
+    # None for index values not matching any encoding
+    table = [None] * (1 << bits)
+    for enc, item in items:
+        for j in range(enc.value, 1 << bits, 1 << enc.size_bits):
+            assert table[j] is None
+            table[j] = item
+    return table
+
+
+def build_dispatch_table(arch, index_bits = None):
+    """
+    Build a single-level dispatch table for the instruction set.
+
+    Args:
+        arch:       Arch
+        index_bits: number of instruction bits indexing the table,
+                    defaults to the longest class and format encoding,
+                    which requires no fallback entries
+
+    Returns:
+        (index_bits, entries, opcode_table), where entries is a list
+        of DispatchEntry, and opcode_table is a list of Operator.
+    """
+    opcode_table = []
+    opcode_base = { }
+    opcode_mask = { }
+    for clas in sorted(arch.class_by_encoding.values(), key = lambda c: str(c.encoding)[::-1]):
+        opcode_base[id(clas)] = len(opcode_table)
+        bits = arch.max_encoding_len(clas.operators)
+        opcode_mask[id(clas)] = (1 << bits) - 1
+        if bits == 0:
+            opcode_table += list(clas.operators.values())
+        else:
+            opcode_table += arch.expand_encoding_dict(clas.operators)
+
+    # every combination of class and format encoding
+    combined = []
+    for clas in arch.class_by_encoding.values():
+        for f in arch.format_by_order_encoding[len(clas.refs)].values():
+            enc = arch.SizedValue(clas.encoding.size_bits + f.encoding.size_bits,
+                                  clas.encoding.value | (f.encoding.value << clas.encoding.size_bits))
+            operand_refs = []
+            ref_count = 0
+            for operand in f.operands:
+                if operand.startswith('dref'):
+                    ref = int(operand[4:]) - 1
+                    operand_refs.append(ref)
+                    ref_count = max(ref_count, ref + 1)
+                else:
+                    operand_refs.append(None)
+            combined.append((enc, DispatchEntry(enc.size_bits, clas, f, tuple(operand_refs), ref_count,
+                                                opcode_base[id(clas)], opcode_mask[id(clas)],
+                                                0, 0)))
+    max_bits = max(enc.size_bits for enc, entry in combined)
+    if index_bits is None:
+        index_bits = max_bits
+    assert 1 <= index_bits <= max_bits
+
+    # entries with short encodings go in the primary table, the others in
+    # fallback tables keyed by their low index_bits bits
+    index_mask = (1 << index_bits) - 1
+    short = [(enc, entry) for enc, entry in combined if enc.size_bits <= index_bits]
+    long = collections.OrderedDict()
+    for enc, entry in sorted(combined, key = lambda c: c[0].value & index_mask):
+        if enc.size_bits > index_bits:
+            rest = arch.SizedValue(enc.size_bits - index_bits, enc.value >> index_bits)
+            long.setdefault(enc.value & index_mask, []).append((rest, entry))
+
+    entries = _expand_sized(short, index_bits)
+    for prefix, items in long.items():
+        assert entries[prefix] is None
+        bits = max(rest.size_bits for rest, entry in items)
+        entries[prefix] = DispatchEntry(0, None, None, (), 0, 0, 0,
+                                        len(entries), (1 << bits) - 1)
+        entries += _expand_sized(items, bits)
+    assert None not in entries
+    return index_bits, entries, opcode_table
+
+
+def gen_dispatch_c(arch, f, index_bits = None):
+    index_bits, entries, opcode_table = build_dispatch_table(arch, index_bits)
+
+    f.write('// Automatically generated - do not edit!\n')
+    f.write('\n')
+
+    f.write('#include <stdbool.h>\n')
+    f.write('\n')
+
+    f.write('#include "operator.h"\n')
+    f.write('\n')
+
+    f.write('const int dispatch_index_bits = %d;\n' % index_bits)
+    f.write('\n')
+
+    f.write('const operator_info_t dispatch_opcode_table [%d] =\n' % len(opcode_table))
+    f.write('{\n')
+    for i, operator in enumerate(opcode_table):
+        f.write('  /* %4d %5s */ { %d, %3d, op_%s },\n' % (i,
+                                                         str(operator.encoding),
+                                                         operator.encoding.size_bits,
+                                                         operator.id,
+                                                         operator.names[0]))
+    f.write('};\n')
+    f.write('\n')
+
+    f.write('const dispatch_info_t dispatch_table [%d] =\n' % len(entries))
+    f.write('{\n')
+    for i, entry in enumerate(entries):
+        if entry.bit_len == 0:
+            f.write('  /* %4d fallback */ { 0, false, 0, { 0 }, { 0 }, 0, false, 0, 0, %d, %d },\n' % (i,
+                                                                                                    entry.fallback_base,
+                                                                                                    entry.fallback_mask))
+            continue
+        clas = entry.clas
+        operand_len = ['op_len_%d' % bits for bits in clas.refs] or ['0']
+        operand_ref = ['%d' % (-1 if ref is None else ref) for ref in entry.operand_refs] or ['0']
+        f.write('  /* %4d %s:%s */ { %d, %s, %d, { %s }, { %s }, %d, %s, %d, %d, 0, 0 },\n' % (i,
+                                                                                          str(clas.encoding),
+                                                                                          ','.join(entry.format.operands),
+                                                                                          entry.bit_len,
+                                                                                          str(clas.reserved).lower(),
+                                                                                          len(clas.refs),
+                                                                                          ', '.join(operand_len),
+                                                                                          ', '.join(operand_ref),
+                                                                                          entry.ref_count,
+                                                                                          str(clas.branch_ref).lower(),
+                                                                                          entry.opcode_base,
+                                                                                          entry.opcode_mask))
+    f.write('};\n')
+    f.write('\n')
+
+
+# The decoding tables can also be written as a Python module of plain
+# tuples and bytes, which can be imported without parsing the XML
+# definition or constructing an Arch.  The module records the same key
+# as the Arch cache, so it can be regenerated when the definition or
+# this file changes.  It also has the enumeration values and segment
+# fields, for the simulator.  See archtables.py for using the module.
+
+def gen_tables_py(arch, f):
+    classes = sorted(arch.class_by_encoding.values(), key = lambda c: str(c.encoding)[::-1])
+    class_index = { id(c): i for i, c in enumerate(classes) }
+    formats = []
+    for order in range(4):
+        formats += sorted(arch.format_by_order_encoding[order].values(), key = lambda f: str(f.encoding)[::-1])
+    format_index = { id(fmt): i for i, fmt in enumerate(formats) }
+    operators = [arch.operator_by_id[id] for id in sorted(arch.operator_by_id)]
+    operator_index = { id(op): i for i, op in enumerate(operators) }
+    assert len(classes) < 256 and len(formats) < 256 and len(operators) < 256
+
+    def table(d, index):
+        bits = arch.max_encoding_len(d)
+        if bits == 0:
+            items = list(d.values())
+        else:
+            items = arch.expand_encoding_dict(d)
+        return bits, 'bytes([%s])' % ', '.join('%d' % index[id(v)] for v in items)
+
+    f.write('# Automatically generated by arch.py - do not edit!\n')
+    f.write('\n')
+    f.write("arch_key = '%s'\n" % arch.source_hash)
+    f.write('\n')
+    f.write('instruction_start_bits = %d\n' % arch.symbols['instruction_data_segment'].value.field_by_name['instructions'].offset_bits)
+    f.write('\n')
+
+    f.write('# (encoding bits, encoding, reserved, operand bits, branch reference)\n')
+    f.write('classes = (\n')
+    for c in classes:
+        f.write('    (%d, 0x%x, %s, %r, %s),\n' % (c.encoding.size_bits, c.encoding.value,
+                                                c.reserved, tuple(c.refs), c.branch_ref))
+    f.write(')\n')
+    f.write('\n')
+
+    f.write('# (order, encoding bits, encoding, operands)\n')
+    f.write('formats = (\n')
+    for fmt in formats:
+        f.write('    (%d, %d, 0x%x, %r),\n' % (len(fmt.operands), fmt.encoding.size_bits,
+                                             fmt.encoding.value, tuple(fmt.operands)))
+    f.write(')\n')
+    f.write('\n')
+
+    f.write('# (id, names, class index, opcode bits, opcode, operand modes)\n')
+    f.write('operators = (\n')
+    for op in operators:
+        f.write('    (%d, %r, %d, %d, 0x%x, %r),\n' % (op.id, tuple(op.names), class_index[id(op.clas)],
+                                                    op.encoding.size_bits, op.encoding.value, op.modes))
+    f.write(')\n')
+    f.write('\n')
+
+    f.write('# Lookup tables, indexed by the next bits of the instruction, of\n')
+    f.write('# class, format and operator indexes.  A table for zero bits has a\n')
+    f.write('# single entry.\n')
+    bits, t = table(arch.class_by_encoding, class_index)
+    f.write('class_bits = %d\n' % bits)
+    f.write('class_table = %s\n' % t)
+    f.write('\n')
+    f.write('# by order\n')
+    format_tables = [table(arch.format_by_order_encoding[order], format_index) for order in range(4)]
+    f.write('format_bits = (%s,)\n' % ', '.join('%d' % bits for bits, t in format_tables))
+    f.write('format_tables = (\n')
+    for bits, t in format_tables:
+        f.write('    %s,\n' % t)
+    f.write(')\n')
+    f.write('\n')
+    f.write('# by class index\n')
+    opcode_tables = [table(c.operators, operator_index) for c in classes]
+    f.write('opcode_bits = (%s,)\n' % ', '.join('%d' % bits for bits, t in opcode_tables))
+    f.write('opcode_tables = (\n')
+    for bits, t in opcode_tables:
+        f.write('    %s,\n' % t)
+    f.write(')\n')
+    f.write('\n')
+
+    f.write('# {enumeration name: {value name: value}}\n')
+    f.write('enumerations = {\n')
+    for name, symbol in arch.symbols.items():
+        if symbol.type == 'enumeration':
+            f.write('    %r: {%s},\n' % (name, ', '.join('%r: %d' % (item_name, item['value'])
+                                                       for item_name, item in symbol.value.items())))
+    f.write('}\n')
+    f.write('\n')
+
+    f.write('# {segment name: {field name: (offset bits, size bits)}}\n')
+    f.write('segments = {\n')
+    for name, symbol in arch.symbols.items():
+        if symbol.type == 'segment':
+            f.write('    %r: {\n' % name)
+            for field_name, field in symbol.value.field_by_name.items():
+                f.write('        %r: (%r, %r),\n' % (field_name, field.offset_bits, field.size_bits))
+            f.write('    },\n')
+    f.write('}\n')
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='iAPX 432 Architecture Parser')
     parser.add_argument('-a', '--arch',
@@ -619,12 +1014,22 @@ if __name__ == '__main__':
                         type=argparse.FileType('w'),
                         default='tables.c',
                         help='generate C tables source file')
+    parser.add_argument('--gen-dispatch-c',
+                        nargs='?',
+                        type=argparse.FileType('w'),
+                        default='dispatch.c',
+                        help='generate C single-level dispatch table source file')
+    parser.add_argument('--gen-tables-py',
+                        metavar='TABLES_PY',
+                        help='generate Python decoding tables module, if it isn\'t current')
+    parser.add_argument('--dispatch-index-bits',
+                        type=int,
+                        help='number of instruction bits indexing the dispatch table (default longest class and format encoding)')
+    add_arch_cache_arguments(parser)
 
     args = parser.parse_args()
 
-    arch_tree = xml.etree.ElementTree.parse(args.arch)
-    args.arch.close()
-    arch = Arch(arch_tree)
+    arch = load_arch_from_args(args)
 
     if args.gen_operator_h:
         gen_operator_h(arch, args.gen_operator_h)
@@ -638,3 +1043,15 @@ if __name__ == '__main__':
         gen_tables_c(arch, args.gen_tables_c)
         args.gen_tables_c.close()
 
+    if args.gen_dispatch_c:
+        gen_dispatch_c(arch, args.gen_dispatch_c, args.dispatch_index_bits)
+        args.gen_dispatch_c.close()
+
+    if args.gen_tables_py:
+        if update_tables_py(args.arch.name, args.gen_tables_py,
+                            cache_dir = args.arch_cache_dir,
+                            use_cache = not args.no_arch_cache):
+            print('generated', args.gen_tables_py)
+        else:
+            print(args.gen_tables_py, 'is up to date')
+
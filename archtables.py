@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+# Decoding tables modules for Intel iAPX 432 utilities
+
+# Copyright 2014, 2015, 2016, 2017 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The decoding tables can be written by arch.gen_tables_py() as a
+# Python module of plain tuples and bytes.  This module has what's
+# needed to use such a module, including the namedtuple types shared
+# with Arch, without importing arch.py, which imports xml.etree and
+# pickle.  arch.py is only imported to regenerate a module.
+
+import collections
+import hashlib
+import importlib.util
+import os
+import re
+
+
+SizedValue = collections.namedtuple('SizedValue', ['size_bits',
+                                                   'value'])
+SizedValue.__str__ = lambda self: ("{:0" + str(self.size_bits) + "b}").format(self.value)
+
+Format = collections.namedtuple('Format', ['encoding',
+                                           'operands'])
+
+Class = collections.namedtuple('Class', ['encoding',
+                                         'reserved',
+                                         'refs',
+                                         'branch_ref',
+                                         'operators'])
+
+Operator = collections.namedtuple('Operator', ['names',
+                                               'id',
+                                               'clas',
+                                               'encoding',  # opcode
+                                               'modes'])    # 'r', 'w' or 'rmw' per operand
+
+# a field of a segment in a decoding tables module
+SegmentField = collections.namedtuple('SegmentField', ['offset_bits',
+                                                       'size_bits'])
+
+
+# The key of both the Arch cache and decoding tables modules is a hash
+# of the XML source, arch.py and this file, so that a change to any of
+# them causes the cache or module to be rebuilt.
+def arch_cache_key(arch_xml):
+    h = hashlib.sha256()
+    for fn in ('arch.py', os.path.basename(__file__)):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), fn), 'rb') as f:
+            h.update(f.read())
+    h.update(arch_xml)
+    return h.hexdigest()
+
+
+def add_arch_cache_arguments(parser):
+    parser.add_argument('--arch-cache-dir',
+                        help='directory for cached architecture definition (default: __pycache__ next to definition)')
+    parser.add_argument('--no-arch-cache',
+                        action='store_true',
+                        help='do not use cached architecture definition')
+    parser.add_argument('--rebuild-arch-cache',
+                        action='store_true',
+                        help='force rebuild of cached architecture definition')
+
+
+_tables_py_key_re = re.compile(r"arch_key = '([0-9a-f]*)'$", re.MULTILINE)
+
+def update_tables_py(arch_fn, tables_fn, cache_dir = None, use_cache = True):
+    """
+    Regenerate a decoding tables module written by arch.gen_tables_py(), if
+    it doesn't exist, or wasn't generated from the current architecture
+    definition.  Only the key in the module is checked; it isn't
+    imported.
+
+    Returns:
+        True if the module was regenerated.
+    """
+    with open(arch_fn, 'rb') as f:
+        key = arch_cache_key(f.read())
+    try:
+        with open(tables_fn, 'r') as f:
+            m = _tables_py_key_re.search(f.read(4096))
+        if m and m.group(1) == key:
+            return False
+    except OSError:
+        pass
+    import py_compile
+    from arch import gen_tables_py, load_arch
+    with open(arch_fn, 'rb') as f:
+        arch = load_arch(f, cache_dir = cache_dir, use_cache = use_cache)
+    temp_fn = '%s.%d.tmp' % (tables_fn, os.getpid())
+    with open(temp_fn, 'w') as f:
+        gen_tables_py(arch, f)
+    os.replace(temp_fn, tables_fn)
+    # compile it now, so that importing it doesn't have to
+    py_compile.compile(tables_fn)
+    return True
+
+
+def load_tables_py(tables_fn):
+    """
+    Import a decoding tables module written by arch.gen_tables_py()
+    from a file.
+    """
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(tables_fn))[0],
+                                                  tables_fn)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+# Intel iAPX 432 GDP instruction assembler
+
+# Copyright 2014, 2015, 2016, 2017 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Encodes instructions in the format decoded by the disassembler; see
+# the description of the instruction format there.  Each instruction is
+# built up as a single integer, LSB first, and appended to a BitBuffer.
+#
+# A CodeBlock assembles a sequence of labels and instructions.  Each
+# instruction is encoded once, with any branch reference in its short,
+# relative form, and the branch reference is recorded as a fixup.  Once
+# all labels are defined, relax() lengthens the branch references whose
+# targets are out of range of a relative reference to absolute ones.
+# Lengthening a branch reference moves everything after it, which can
+# put other relative branch references out of range, so this is
+# repeated until no more branch references need to be lengthened.
+# Since branch references are only ever lengthened, this terminates.
+
+from bisect import bisect_left, bisect_right
+import collections
+import weakref
+
+from disassembler import (BranchReference, DataReference, DecodeTables,
+                          DirectSelector,
+                          absolute_branch_bits, displacement_types,
+                          instruction_start_bits, relative_branch_bits,
+                          segment_control_general,
+                          segment_control_long_direct,
+                          segment_control_operand_stack,
+                          segment_control_short_direct)
+
+
+class AssemblyError(Exception):
+    pass
+
+
+# Format names in image definitions may use "refN" rather than "drefN"
+# for explicit data references, and may include "br" for the branch
+# reference, which isn't part of the format.
+def normalize_format(name):
+    operands = []
+    for operand in name.split(','):
+        operand = operand.strip()
+        if operand in ('', 'br'):
+            continue
+        if operand.startswith('ref'):
+            operand = 'd' + operand
+        operands.append(operand)
+    return ','.join(operands)
+
+
+# Returns a scalar data reference to a segment by direct selector,
+# using the short forms of the selector and displacement if possible.
+def direct_scalar_reference(eas, slot, displacement):
+    return DataReference('scalar', displacement >= (1 << 7),
+                         DirectSelector(slot >= (1 << 4), eas, slot),
+                         displacement, None, None)
+
+
+# Encoding of an operator with a particular format.  The prefix is the
+# class encoding followed by the format encoding.
+OperatorEncoding = collections.namedtuple('OperatorEncoding', ['operator',
+                                                               'format',
+                                                               'prefix',
+                                                               'prefix_bits',
+                                                               'ref_count',
+                                                               'branch_ref',
+                                                               'opcode',
+                                                               'opcode_bits'])
+
+
+# The encoding of every combination of operator name and format name is
+# precomputed once per Arch.
+class EncodeTables(object):
+    def __init__(self, arch):
+        self.arch = arch
+        self.operator_by_name = { }
+        for operator in arch.operator_by_id.values():
+            for name in operator.names:
+                self.operator_by_name[name] = operator
+
+        self.encodings = { }
+        for name, operator in self.operator_by_name.items():
+            clas = operator.clas
+            order = len(clas.refs)
+            for format_name, f in arch.format_by_operands.items():
+                if len(f.operands) != order:
+                    continue
+                ref_count = DecodeTables.parse_format(f)[1]
+                prefix = (clas.encoding.value |
+                          (f.encoding.value << clas.encoding.size_bits))
+                self.encodings[(name, format_name)] = OperatorEncoding(operator, f,
+                                                                      prefix,
+                                                                      clas.encoding.size_bits + f.encoding.size_bits,
+                                                                      ref_count,
+                                                                      clas.branch_ref,
+                                                                      operator.encoding.value,
+                                                                      operator.encoding.size_bits)
+
+        self.start_bits = instruction_start_bits(arch)
+
+
+_tables_by_arch = weakref.WeakKeyDictionary()
+
+def get_encode_tables(arch):
+    tables = _tables_by_arch.get(arch)
+    if tables is None:
+        tables = EncodeTables(arch)
+        _tables_by_arch[arch] = tables
+    return tables
+
+
+class BitBuffer(object):
+    """
+    Growable buffer of bits, appended LSB first.  The last byte may be
+    partially filled.
+    """
+    def __init__(self):
+        self._data = bytearray()
+        self._bits = 0
+
+    def __len__(self):
+        return self._bits
+
+    def append(self, value, size_bits):
+        pos = self._bits
+        self._bits += size_bits
+        shift = pos & 7
+        if shift:
+            value = (value << shift) | self._data.pop()
+            size_bits += shift
+        self._data += value.to_bytes((size_bits + 7) >> 3, 'little')
+
+    def getvalue(self):
+        return bytes(self._data)
+
+
+# Fenwick tree of per-instruction growth in bits, so that the offset of
+# an instruction can be found in O(log n) time as branch references are
+# lengthened.
+class _GrowthIndex(object):
+    def __init__(self, size):
+        self._tree = [0] * (size + 1)
+
+    def add(self, index, delta):
+        index += 1
+        tree = self._tree
+        while index < len(tree):
+            tree[index] += delta
+            index += index & -index
+
+    # total growth of the instructions before index
+    def before(self, index):
+        total = 0
+        tree = self._tree
+        while index > 0:
+            total += tree[index]
+            index -= index & -index
+        return total
+
+
+def _check_range(what, value, size_bits):
+    if not 0 <= value < (1 << size_bits):
+        raise AssemblyError('%s %d out of range for %d bits' % (what, value, size_bits))
+
+
+class Assembler(object):
+    def __init__(self, arch):
+        self.arch = arch
+        self.tables = get_encode_tables(arch)
+
+    # Each of the following returns the encoded value and its size in bits.
+
+    def _direct_selector(self, sel):
+        size_bits = 16 if sel.long else 6
+        _check_range('EAS', sel.eas, 2)
+        _check_range('access descriptor slot', sel.slot, size_bits - 2)
+        return sel.eas | (sel.slot << 2), size_bits
+
+    def _displacement(self, displacement, long):
+        size_bits = 16 if long else 7
+        _check_range('displacement', displacement, size_bits)
+        return displacement, size_bits
+
+    def _general_indirect(self, ind):
+        value = ind.long_selector | (ind.long_displacement << 1)
+        o = 2
+        v, n = self._direct_selector(ind.selector)
+        value |= v << o
+        o += n
+        v, n = self._displacement(ind.displacement, ind.long_displacement)
+        return value | (v << o), o + n
+
+    def _indirect_reference(self, ind):
+        if ind.type == 'operand_stack':
+            return 1, 1
+        if ind.type == 'intrasegment':
+            v, n = self._displacement(ind.displacement, ind.long_displacement)
+            return 0b10 | (ind.long_displacement << 2) | (v << 3), 3 + n
+        v, n = self._general_indirect(ind)
+        return v << 2, 2 + n
+
+    def encode_data_reference(self, ref):
+        displacement_type = displacement_types.index(ref.displacement_type)
+        if isinstance(ref.segment, DirectSelector):
+            if ref.segment.long:
+                segment_control = segment_control_long_direct
+            else:
+                segment_control = segment_control_short_direct
+        elif ref.segment.type == 'general':
+            segment_control = segment_control_general
+        elif ref.segment.type == 'operand_stack':
+            segment_control = segment_control_operand_stack
+        else:
+            raise AssemblyError('invalid segment reference type %s' % ref.segment.type)
+
+        value = displacement_type | (segment_control << 2)
+        o = 4
+        if displacement_type != 3:
+            value |= ref.long_displacement << o
+            o += 1
+
+        if segment_control == segment_control_general:
+            v, n = self._general_indirect(ref.segment)
+        elif segment_control != segment_control_operand_stack:
+            v, n = self._direct_selector(ref.segment)
+        else:
+            v, n = 0, 0
+        value |= v << o
+        o += n
+
+        if displacement_type == 0:    # scalar
+            parts = [self._displacement(ref.displacement, ref.long_displacement)]
+        elif displacement_type == 1:  # record item
+            parts = [self._displacement(ref.index, ref.long_displacement),
+                     self._indirect_reference(ref.base)]
+        elif displacement_type == 2:  # static vector element
+            parts = []
+            if ref.long_displacement:
+                parts.append(self._displacement(ref.base, True))
+            elif ref.base != 0:
+                raise AssemblyError('static vector element base requires long displacement')
+            parts.append(self._indirect_reference(ref.index))
+        else:                         # dynamic vector element
+            parts = [self._indirect_reference(ref.base),
+                     self._indirect_reference(ref.index)]
+        for v, n in parts:
+            value |= v << o
+            o += n
+        return value, o
+
+    def encode(self, operator_name, format_name, refs, branch_ref = None):
+        """
+        Encode a single instruction.
+
+        Args:
+            operator_name: any name of the operator
+            format_name:   format as in the architecture definition,
+                           e.g. "dref1,stk", or "" for operators with no
+                           data operands
+            refs:          list of DataReferences for explicit operands
+            branch_ref:    BranchReference, for operators which take one
+
+        Returns:
+            A tuple of the encoded instruction, its size in bits, and
+            the bit offset within the instruction of the branch
+            reference value, or None.
+
+        Raises:
+            AssemblyError
+        """
+        e = self.tables.encodings.get((operator_name, format_name))
+        if e is None:
+            operator = self.tables.operator_by_name.get(operator_name)
+            if operator is None:
+                raise AssemblyError('unknown operator %s' % operator_name)
+            if format_name not in self.arch.format_by_operands:
+                raise AssemblyError('unknown format "%s"' % format_name)
+            raise AssemblyError('format "%s" has %d operands, operator %s requires %d' %
+                                (format_name,
+                                 len(self.arch.format_by_operands[format_name].operands),
+                                 operator_name, len(operator.clas.refs)))
+        if len(refs) != e.ref_count:
+            raise AssemblyError('operator %s format "%s" requires %d data references, %d given' %
+                                (operator_name, format_name, e.ref_count, len(refs)))
+
+        value = e.prefix
+        o = e.prefix_bits
+        for ref in refs:
+            v, n = self.encode_data_reference(ref)
+            value |= v << o
+            o += n
+
+        branch_offset = None
+        if e.branch_ref:
+            if branch_ref is None:
+                raise AssemblyError('operator %s requires a branch reference' % operator_name)
+            value |= branch_ref.absolute << o
+            o += 1
+            branch_offset = o
+            if branch_ref.absolute:
+                _check_range('absolute branch target', branch_ref.value, absolute_branch_bits)
+                value |= branch_ref.value << o
+                o += absolute_branch_bits
+            else:
+                limit = 1 << (relative_branch_bits - 1)
+                if not -limit <= branch_ref.value < limit:
+                    raise AssemblyError('relative branch displacement %d out of range' % branch_ref.value)
+                value |= (branch_ref.value & ((1 << relative_branch_bits) - 1)) << o
+                o += relative_branch_bits
+        elif branch_ref is not None:
+            raise AssemblyError('operator %s does not take a branch reference' % operator_name)
+
+        value |= e.opcode << o
+        o += e.opcode_bits
+        return value, o, branch_offset
+
+    def replace_branch_reference(self, value, size_bits, branch_offset, branch_ref):
+        """
+        Replace the branch reference of an encoded instruction, as
+        returned by encode(), with a branch reference of either form.
+
+        Returns:
+            A tuple of the encoded instruction and its size in bits.
+        """
+        if (value >> (branch_offset - 1)) & 1:
+            old_bits = absolute_branch_bits
+        else:
+            old_bits = relative_branch_bits
+        low = value & ((1 << (branch_offset - 1)) - 1)
+        high = value >> (branch_offset + old_bits)
+        if branch_ref.absolute:
+            _check_range('absolute branch target', branch_ref.value, absolute_branch_bits)
+            low |= (1 << (branch_offset - 1)) | (branch_ref.value << branch_offset)
+            new_bits = absolute_branch_bits
+        else:
+            limit = 1 << (relative_branch_bits - 1)
+            if not -limit <= branch_ref.value < limit:
+                raise AssemblyError('relative branch displacement %d out of range' % branch_ref.value)
+            low |= (branch_ref.value & ((1 << relative_branch_bits) - 1)) << branch_offset
+            new_bits = relative_branch_bits
+        return (low | (high << (branch_offset + new_bits)),
+                size_bits + new_bits - old_bits)
+
+
+Fixup = collections.namedtuple('Fixup', ['index',          # of instruction
+                                         'branch_offset',  # bit offset in instruction
+                                         'label'])
+
+
+class CodeBlock(object):
+    """
+    Labels and instructions of an instruction segment, starting at bit
+    offset start_bits of the segment.
+    """
+    def __init__(self, assembler, start_bits):
+        self.assembler = assembler
+        self.start_bits = start_bits
+        self.values = []      # encoded instructions, with short branch references
+        self.sizes = []       # in bits
+        self.label_index = { }   # instruction index following each label
+        self.fixups = []
+        self.long = None      # set of indexes of instructions with long branch references
+        self.offsets = None   # bit offset of each instruction, and of the end
+
+    def label(self, name):
+        if name in self.label_index:
+            raise AssemblyError('label %s already defined' % name)
+        self.label_index[name] = len(self.values)
+
+    def instruction(self, operator_name, format_name, refs, target = None):
+        branch_ref = None
+        if target is not None:
+            branch_ref = BranchReference(False, 0)
+        value, size_bits, branch_offset = self.assembler.encode(operator_name, format_name,
+                                                                refs, branch_ref)
+        if branch_offset is not None:
+            self.fixups.append(Fixup(len(self.values), branch_offset, target))
+        self.values.append(value)
+        self.sizes.append(size_bits)
+
+    def undefined_labels(self):
+        return sorted(set(f.label for f in self.fixups
+                          if f.label not in self.label_index))
+
+    def relax(self):
+        """
+        Choose the form of each branch reference, using a relative
+        reference wherever the target is in range.
+
+        Raises:
+            AssemblyError: a branch reference is to an undefined label
+        """
+        undefined = self.undefined_labels()
+        if undefined:
+            raise AssemblyError('undefined label%s %s' % ('s' if len(undefined) > 1 else '',
+                                                          ', '.join(undefined)))
+        growth = absolute_branch_bits - relative_branch_bits
+        limit = 1 << (relative_branch_bits - 1)
+
+        base = [self.start_bits]
+        for size_bits in self.sizes:
+            base.append(base[-1] + size_bits)
+        grown = _GrowthIndex(len(base))
+
+        fixups = self.fixups
+        targets = [self.label_index.get(f.label) for f in fixups]
+        is_long = [False] * len(fixups)
+        # fixups are in instruction order, so this is sorted
+        fixup_base = [base[f.index] for f in fixups]
+
+        # Displacements only increase in magnitude as branch references
+        # are lengthened, so references that are out of range when all
+        # are short must be long.
+        for k, f in enumerate(fixups):
+            t = targets[k]
+            if not -limit <= base[t] - base[f.index] < limit:
+                is_long[k] = True
+                grown.add(f.index, growth)
+
+        work = [k for k in range(len(fixups)) if not is_long[k]]
+        pending = [True] * len(fixups)
+        while work:
+            k = work.pop()
+            pending[k] = False
+            if is_long[k]:
+                continue
+            i = fixups[k].index
+            t = targets[k]
+            displacement = (base[t] + grown.before(t)) - (base[i] + grown.before(i))
+            if -limit <= displacement < limit:
+                continue
+            is_long[k] = True
+            grown.add(i, growth)
+            # Only the short branch references spanning the lengthened
+            # instruction have changed displacements.  Both ends of such
+            # a reference were within range, and offsets only increase,
+            # so its instruction is within range of this one's original
+            # offset.
+            lo = bisect_left(fixup_base, base[i] - limit)
+            hi = bisect_right(fixup_base, base[i] + limit)
+            for m in range(lo, hi):
+                if not (is_long[m] or pending[m]):
+                    j = fixups[m].index
+                    u = targets[m]
+                    if min(j, u) <= i < max(j, u):
+                        pending[m] = True
+                        work.append(m)
+
+        self.long = set(f.index for f, l in zip(fixups, is_long) if l)
+        self.offsets = [self.start_bits]
+        for i, size_bits in enumerate(self.sizes):
+            if i in self.long:
+                size_bits += growth
+            self.offsets.append(self.offsets[-1] + size_bits)
+
+    def label_offsets(self):
+        return { name: self.offsets[index] for name, index in self.label_index.items() }
+
+    def getvalue(self):
+        """
+        Returns the encoded instructions as bytes.  Must be called after
+        relax().
+        """
+        buf = BitBuffer()
+        values = self.values
+        sizes = self.sizes
+        offsets = self.offsets
+        prev = 0
+        for f in self.fixups:
+            for i in range(prev, f.index):
+                buf.append(values[i], sizes[i])
+            prev = f.index + 1
+            target = offsets[self.label_index[f.label]]
+            if f.index in self.long:
+                branch_ref = BranchReference(True, target)
+            else:
+                branch_ref = BranchReference(False, target - offsets[f.index])
+            buf.append(*self.assembler.replace_branch_reference(values[f.index], sizes[f.index],
+                                                                f.branch_offset, branch_ref))
+        for i in range(prev, len(values)):
+            buf.append(values[i], sizes[i])
+        return buf.getvalue()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# Allocation benchmark and randomized differential test
+
+# Copyright 2014, 2015, 2016, 2017 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The check command drives Allocation with randomized workloads of
+# allocate, free, find_free, is_available, free_space,
+# last_free_range, snapshot and restore, and compares every result
+# against ReferenceAllocation, a deliberately simple model that keeps
+# one byte per address.
+#
+# The bench command fills an Allocation with a given number of blocks,
+# frees some of them to fragment the address space, then times each
+# kind of operation, and reports operations per second and traced
+# memory per block.
+
+import argparse
+import random
+import re
+import sys
+import time
+import tracemalloc
+
+from allocation import Allocation, AllocationError, AllocationPolicy
+
+
+class ReferenceAllocation(object):
+    """
+    Model of Allocation keeping a byte per address, nonzero if the
+    address is allocated, and a dict of allocated blocks.  All
+    operations are O(size of address space).
+    """
+    def __init__(self, size, policy = AllocationPolicy.FIRST_FIT):
+        self.size = size
+        self.policy = policy
+        self.used = bytearray(size)
+        self.blocks = { }
+        # For rotating first fit, the start of the free block at which
+        # to start searching, or None to start at the lowest free block.
+        # Like Allocation, it's advanced past a block allocated at that
+        # address, and follows the block when it's merged with the
+        # preceding free block.
+        self.next_free = 0
+
+    # free blocks are maximal runs of free addresses
+    def free_blocks(self):
+        return [(m.start(), m.end() - m.start())
+                for m in re.finditer(b'\x00+', self.used)]
+
+    def find_free(self, size, addr = None):
+        if addr is not None:
+            if self.is_available(addr, size):
+                return addr
+            raise AllocationError('requested address range unavailable')
+        fits = [(a, s) for a, s in self.free_blocks() if s >= size]
+        if not fits:
+            raise AllocationError('insufficient contiguous free space available')
+        if self.policy == AllocationPolicy.BEST_FIT:
+            return min(fits, key = lambda f: (f[1], f[0]))[0]
+        if self.policy == AllocationPolicy.ROTATING_FIRST_FIT:
+            later = [a for a, s in fits
+                     if self.next_free is not None and a >= self.next_free]
+            addr = later[0] if later else fits[0][0]
+            self.next_free = addr
+            return addr
+        return fits[0][0]
+
+    def is_available(self, addr, size):
+        return self.used[addr:addr + size].count(0) == size
+
+    def allocate(self, size, addr = None):
+        addr = self.find_free(size, addr)
+        self.used[addr:addr + size] = b'\x01' * size
+        self.blocks[addr] = size
+        if addr == self.next_free:
+            self.next_free = self.used.find(0, addr + size)
+            if self.next_free < 0:
+                self.next_free = None
+        return addr
+
+    def free(self, addr):
+        if addr not in self.blocks:
+            raise AllocationError('no allocated block at requested address')
+        size = self.blocks.pop(addr)
+        self.used[addr:addr + size] = bytes(size)
+        if self.next_free is not None:
+            self.next_free = self.used.rfind(1, 0, self.next_free) + 1
+
+    def free_space(self, addr = 0, size = None):
+        if size is None:
+            size = self.size - addr
+        return self.used[addr:addr + size].count(0)
+
+    def last_free_range(self):
+        return len(self.used.rstrip(b'\x00'))
+
+    def snapshot(self):
+        return (bytes(self.used), dict(self.blocks), self.next_free)
+
+    def restore(self, state):
+        self.used = bytearray(state[0])
+        self.blocks = dict(state[1])
+        self.next_free = state[2]
+
+
+def _call(f, *args, **kwargs):
+    try:
+        return f(*args, **kwargs)
+    except AllocationError:
+        return AllocationError
+
+
+def check(size, policy, indexed, ops, rng, max_block = 16):
+    """
+    Run a randomized workload of ops operations against an Allocation
+    and a ReferenceAllocation, raising AssertionError on the first
+    difference.
+    """
+    a = Allocation(size, policy = policy, indexed = indexed)
+    r = ReferenceAllocation(size, policy)
+    snapshots = []   # (Allocation snapshot, ReferenceAllocation snapshot)
+    for i in range(ops):
+        op = rng.random()
+        n = rng.randrange(1, min(max_block, size) + 1)
+        addr = rng.randrange(size - n + 1)
+        if op < 0.3:
+            what = ('allocate', n)
+            result = (_call(a.allocate, n), _call(r.allocate, n))
+        elif op < 0.4:
+            what = ('allocate', n, addr)
+            result = (_call(a.allocate, n, addr = addr), _call(r.allocate, n, addr = addr))
+        elif op < 0.6:
+            if not r.blocks:
+                continue
+            addr = rng.choice(list(r.blocks))
+            what = ('free', addr)
+            result = (_call(a.free, addr), _call(r.free, addr))
+        elif op < 0.7:
+            what = ('is_available', addr, n)
+            result = (a.is_available(addr, n), r.is_available(addr, n))
+        elif op < 0.8:
+            # find_free doesn't change the state, except for the rotating
+            # first fit starting point
+            what = ('find_free', n)
+            result = (_call(a.find_free, n), _call(r.find_free, n))
+        elif op < 0.85:
+            count = rng.randrange(size - addr + 1)
+            what = ('free_space', addr, count)
+            result = (a.free_space(addr, count), r.free_space(addr, count))
+        elif op < 0.9:
+            what = ('last_free_range',)
+            result = (a.last_free_range(), r.last_free_range())
+        elif op < 0.95:
+            snapshots.append((a.snapshot(), r.snapshot()))
+            continue
+        else:
+            # a snapshot may be restored more than once
+            if not snapshots:
+                continue
+            k = rng.randrange(len(snapshots))
+            what = ('restore', k)
+            a.restore(snapshots[k][0])
+            r.restore(snapshots[k][1])
+            result = (list(a.free_ranges()), r.free_blocks())
+        assert result[0] == result[1], '%s %s: Allocation %s, reference %s' % (what, (size, policy, indexed, i), result[0], result[1])
+    assert a.free_space() == r.free_space()
+
+
+# Returns a fragmented Allocation of the specified size containing the
+# specified number of allocated blocks, and the list of addresses of
+# allocated blocks.
+def fill(size, blocks, policy, indexed, rng, max_block = 16):
+    a = Allocation(size, policy = policy, indexed = indexed)
+    addrs = [a.allocate(rng.randrange(1, max_block + 1)) for i in range(blocks)]
+    # free every third block, so that there are free blocks of assorted
+    # sizes throughout the address space
+    for addr in addrs[::3]:
+        a.free(addr)
+    return a, [addr for i, addr in enumerate(addrs) if i % 3]
+
+
+def bench(blocks, policy, indexed, ops, rng, max_block = 16, trace_memory = True):
+    """
+    Return a dict of operations per second by kind of operation, and
+    the traced memory per block, or None if trace_memory is False.
+    """
+    size = blocks * (max_block + 1)
+    if trace_memory:
+        tracemalloc.start()
+    a, addrs = fill(size, blocks, policy, indexed, rng, max_block)
+    bytes_per_block = None
+    if trace_memory:
+        bytes_per_block = tracemalloc.get_traced_memory()[0] / blocks
+        tracemalloc.stop()
+
+    results = { 'blocks': blocks, 'bytes_per_block': bytes_per_block }
+    sizes = [rng.randrange(1, max_block + 1) for i in range(ops)]
+    probe = [rng.randrange(size - 4 * max_block) for i in range(ops)]
+
+    def timed(name, f):
+        start = time.perf_counter()
+        f()
+        results[name] = ops / (time.perf_counter() - start)
+
+    def find_free():
+        for n in sizes:
+            _call(a.find_free, n)
+
+    def is_available():
+        for addr, n in zip(probe, sizes):
+            a.is_available(addr, n)
+
+    def free_space():
+        for addr, n in zip(probe, sizes):
+            a.free_space(addr, n * 4)
+
+    def last_free_range():
+        for i in range(ops):
+            a.last_free_range()
+
+    # alternate allocating a block and freeing a randomly chosen block,
+    # so that the number of blocks stays about the same
+    def allocate_free():
+        for n in sizes:
+            addr = _call(a.allocate, n)
+            if addr is not AllocationError:
+                addrs.append(addr)
+            i = rng.randrange(len(addrs))
+            addrs[i], addrs[-1] = addrs[-1], addrs[i]
+            a.free(addrs.pop())
+
+    timed('find_free', find_free)
+    timed('is_available', is_available)
+    timed('free_space', free_space)
+    timed('last_free_range', last_free_range)
+    timed('allocate_free', allocate_free)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Allocation benchmark and randomized differential test')
+    parser.add_argument('command',
+                        choices = ['check', 'bench'])
+    parser.add_argument('--policy',
+                        action = 'append',
+                        choices = [p.name for p in AllocationPolicy],
+                        help = 'allocation policy, may be repeated (default all)')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--list',
+                       action = 'store_true',
+                       help = 'only use Allocation without the free index, searching the free list (default both)')
+    group.add_argument('--indexed',
+                       action = 'store_true',
+                       help = 'only use Allocation with the free index (default both)')
+    parser.add_argument('--sizes',
+                        type = int,
+                        nargs = '+',
+                        help = 'check: address space sizes (default 8 64 1000 4096); bench: numbers of blocks (default 16 1024 16384, up to 1000000)')
+    parser.add_argument('--ops',
+                        type = int,
+                        default = None,
+                        help = 'operations per size (default check 2000, bench 20000)')
+    parser.add_argument('--trials',
+                        type = int,
+                        default = 10,
+                        help = 'check: randomized trials per size and policy (default 10)')
+    parser.add_argument('--no-trace-memory',
+                        action = 'store_true',
+                        help = 'bench: don\'t measure memory per block, which slows filling the allocation considerably')
+    parser.add_argument('--seed',
+                        type = int,
+                        default = 0)
+    args = parser.parse_args()
+
+    policies = [AllocationPolicy[p] for p in args.policy or [p.name for p in AllocationPolicy]]
+    if args.list:
+        modes = [False]
+    elif args.indexed:
+        modes = [True]
+    else:
+        modes = [True, False]
+    rng = random.Random(args.seed)
+
+    if args.command == 'check':
+        ops = args.ops or 2000
+        for size in args.sizes or [8, 64, 1000, 4096]:
+            for policy in policies:
+                for indexed in modes:
+                    for trial in range(args.trials):
+                        check(size, policy, indexed, ops, rng)
+                    print('ok: size %d %s %s' % (size, policy.name, 'indexed' if indexed else 'list'))
+    else:
+        ops = args.ops or 20000
+        names = ['find_free', 'is_available', 'free_space', 'last_free_range', 'allocate_free']
+        print('%-19s %-7s %8s %10s' % ('policy', 'search', 'blocks', 'bytes/blk') +
+              ''.join(' %15s' % name for name in names))
+        for blocks in args.sizes or [16, 1024, 16384]:
+            for policy in policies:
+                for indexed in modes:
+                    r = bench(blocks, policy, indexed, ops, rng,
+                              trace_memory = not args.no_trace_memory)
+                    memory = '-' if r['bytes_per_block'] is None else '%.1f' % r['bytes_per_block']
+                    print('%-19s %-7s %8d %10s' % (policy.name, 'indexed' if indexed else 'list',
+                                                   blocks, memory) +
+                          ''.join(' %15.0f' % r[name] for name in names))
+        print('(operations per second)')
+    sys.exit(0)
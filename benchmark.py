@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# End-to-end build benchmark for Intel iAPX 432 image builder
+
+# Copyright 2014, 2015, 2016, 2017 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Generates synthetic image definitions with imagegen, builds each one
+# phase by phase, recording the time and peak memory of each phase, and
+# appends the results to a JSON history file. Each result is compared
+# against the most recent previous result in the history for the same
+# scale, and phases that have become slower by more than the threshold
+# are reported as regressions.
+
+import argparse
+from collections import OrderedDict
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+from arch import load_arch
+from buildstats import BuildStats
+from builder import Image
+from imagegen import ImageGenParams, generate
+
+
+# name: (object tables, segments per table)
+scales = OrderedDict([('small',  (1,   100)),
+                      ('medium', (4,   1000)),
+                      ('large',  (16,  4095))])
+
+
+# The history is kept outside the working tree by default, so that
+# benchmark runs don't leave untracked files in the repository.
+default_history = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                               'iapx432-image-builder', 'benchmark_history.json')
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd = os.path.dirname(os.path.abspath(__file__)),
+                                       stderr = subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_build(arch_fn, image_xml, stats):
+    with stats.phase('load_arch'):
+        with open(arch_fn, 'rb') as f:
+            arch = load_arch(f, use_cache = False)
+
+    with stats.phase('parse'):
+        image = Image.parse_file(arch, io.BytesIO(image_xml))
+
+    # the builder reports its progress with print(), which isn't wanted here
+    with contextlib.redirect_stdout(io.StringIO()):
+        with stats.phase('assign_coordinates'):
+            image.assign_coordinates()
+        with stats.phase('compute_segment_sizes'):
+            image.compute_segment_sizes()
+        with stats.phase('allocate_physical_memory'):
+            image.allocate_physical_memory()
+        with stats.phase('resolve_references'):
+            image.resolve_references()
+        image.get_size()
+        with stats.phase('write_segments'):
+            image.write_segments()
+        with stats.phase('reachability_check'):
+            image.reachability_check()
+        with stats.phase('write_file'):
+            image.write_to_file(io.BytesIO())
+
+    for section, values in image.get_stats().items():
+        stats.set_counters(section, values)
+
+
+def run_benchmark(arch_fn, base_fn, params, trace_memory = True, profile_dir = None):
+    image_xml = ET.tostring(generate(ET.parse(base_fn), params).getroot())
+    stats = BuildStats(trace_memory = trace_memory, profile_dir = profile_dir)
+    try:
+        run_build(arch_fn, image_xml, stats)
+    finally:
+        stats.close()
+    return stats.as_dict()
+
+
+def load_history(fn):
+    if not os.path.exists(fn):
+        return []
+    with open(fn, 'r') as f:
+        return json.load(f)
+
+
+def save_history(fn, history):
+    os.makedirs(os.path.dirname(os.path.abspath(fn)), exist_ok = True)
+    temp_fn = fn + '.tmp'
+    with open(temp_fn, 'w') as f:
+        json.dump(history, f, indent = 1)
+    os.replace(temp_fn, fn)
+
+
+# Returns a list of (phase, previous wall time, current wall time) of
+# phases that are slower than in the previous result by more than
+# threshold, a fraction.  Very short phases are ignored, as their
+# times are dominated by noise.
+def find_regressions(previous, current, threshold, min_time = 0.01):
+    regressions = []
+    for phase, p in current['stats']['phases'].items():
+        prev = previous['stats']['phases'].get(phase)
+        if prev is None or prev['wall_s'] < min_time:
+            continue
+        if p['wall_s'] > prev['wall_s'] * (1 + threshold):
+            regressions.append((phase, prev['wall_s'], p['wall_s']))
+    return regressions
+
+
+def print_result(result):
+    print('%s: %d objects, image size %d' % (result['scale'],
+                                            result['stats']['counts']['objects'],
+                                            result['stats']['counts']['image_size']))
+    for phase, p in result['stats']['phases'].items():
+        line = '  %-26s %9.3f s wall %9.3f s cpu' % (phase, p['wall_s'], p['cpu_s'])
+        if 'peak_bytes' in p:
+            line += ' %12d bytes peak' % p['peak_bytes']
+        print(line)
+    print('  %-26s %9.3f s wall %9.3f s cpu' % ('total', result['stats']['total_wall_s'], result['stats']['total_cpu_s']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'iAPX 432 image builder benchmark')
+    parser.add_argument('-a', '--arch',
+                        default = 'iapx432-1.0.xml',
+                        help = 'architecture definition (XML)')
+    parser.add_argument('-b', '--base',
+                        default = 'image.xml',
+                        help = 'base image definition (XML)')
+    parser.add_argument('--scale',
+                        action = 'append',
+                        choices = list(scales.keys()) + ['custom'],
+                        help = 'scale to run, may be repeated (default small and medium); "custom" uses the image generator options')
+    parser.add_argument('--history',
+                        default = default_history,
+                        help = 'JSON benchmark history file (default %s)' % default_history)
+    parser.add_argument('--no-history',
+                        action = 'store_true',
+                        help = 'don\'t record results in the history file')
+    parser.add_argument('--threshold',
+                        type = float,
+                        default = 0.2,
+                        help = 'fractional slowdown of a phase reported as a regression (default 0.2)')
+    parser.add_argument('--no-trace-memory',
+                        action = 'store_true',
+                        help = 'don\'t trace peak memory use, which slows the build considerably')
+    parser.add_argument('--profile',
+                        metavar = 'PROFILE_DIR',
+                        help = 'profile each phase, writing .pstats files to PROFILE_DIR/<scale>')
+    ImageGenParams.add_arguments(parser)
+    args = parser.parse_args()
+
+    history = [] if args.no_history else load_history(args.history)
+    revision = git_revision()
+    regressed = False
+
+    for scale in args.scale or ['small', 'medium']:
+        params = ImageGenParams.from_args(args)
+        if scale != 'custom':
+            params.object_tables, params.segments_per_table = scales[scale]
+        profile_dir = None
+        if args.profile is not None:
+            profile_dir = os.path.join(args.profile, scale)
+
+        result = OrderedDict()
+        result['scale'] = scale
+        result['params'] = params.as_dict()
+        result['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        result['revision'] = revision
+        result['python'] = platform.python_version()
+        result['trace_memory'] = not args.no_trace_memory
+        result['stats'] = run_benchmark(args.arch, args.base, params,
+                                        trace_memory = not args.no_trace_memory,
+                                        profile_dir = profile_dir)
+        print_result(result)
+
+        # tracing memory slows the build, so only compare like with like
+        previous = [r for r in history
+                    if (r['params'] == result['params'] and
+                        r['trace_memory'] == result['trace_memory'])]
+        if previous:
+            for phase, prev_time, cur_time in find_regressions(previous[-1], result, args.threshold):
+                print('  REGRESSION: %s %.3f s -> %.3f s (revision %s)' % (phase, prev_time, cur_time, previous[-1]['revision']))
+                regressed = True
+        history.append(result)
+
+    if not args.no_history:
+        save_history(args.history, history)
+
+    sys.exit(1 if regressed else 0)
@@ -16,14 +16,23 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
-from collections import OrderedDict
+from collections import OrderedDict, deque
+import hashlib
+import json
+import os
 import pprint
 import re
 import sys
 import xml.etree.ElementTree
 
-from arch import Arch
-from allocation import Allocation
+from arch import Arch, add_arch_cache_arguments, load_arch_from_args
+import assembler
+from assembler import (Assembler, AssemblyError, CodeBlock,
+                       direct_scalar_reference, normalize_format)
+from disassembler import instruction_start_bits
+from buildstats import BuildStats
+from allocation import Allocation, AllocationCounters, AllocationError, SlotAllocator
+from physmem import MmapMemory, SparseMemory, phys_mem_backends
 
 class Field(object):
     # a factory method
@@ -125,6 +134,7 @@ class AD(Field):
         self.segment_name = None
         self.dir_index = None
         self.seg_index = None
+        self.resolved = False
         self.rights = { 'write' : True,
                         'read'  : True,
                         'heap'  : False,
@@ -146,18 +156,27 @@ class AD(Field):
         self.size_bits = 32
         return self.size_bits
 
+    # Resolve the target segment of the AD to coordinates. Must be done
+    # after coordinates are assigned.
+    def resolve(self):
+        if self.resolved:
+            return
+        self.resolved = True
+        if not self.valid:
+            return
+        if self.segment_name not in self.image.object_by_name:
+            print("can't find segment", self.segment_name)
+        assert self.segment_name in self.image.object_by_name
+        obj = self.image.object_by_name[self.segment_name]
+        if self.dir_index is None:
+            self.dir_index = obj.dir_index
+            self.seg_index = obj.seg_index
+        self.image.references.setdefault((self.dir_index, self.seg_index), []).append(self)
+
     def write_value(self):
         ad = 0
+        self.resolve()
         if self.valid:
-            if self.segment_name not in self.image.object_by_name:
-                print("can't find segment", self.segment_name)
-            assert self.segment_name in self.image.object_by_name
-            obj = self.image.object_by_name[self.segment_name]
-            if self.dir_index is None:
-                self.dir_index = obj.dir_index
-                self.seg_index = obj.seg_index
-            obj.reference_count += 1
-
             ad = ((self.dir_index        << 20) |
                   (self.rights['write']  << 19) |
                   (self.rights['read']   << 18) |
@@ -231,6 +250,9 @@ class DataField(Field):
             self.size_bits = f.size_bits
             if self.type == 'ordinal':
                 self.numeric = True
+            elif self.type == 'label':
+                # written as the bit offset of the label
+                self.numeric = True
         else:
             if self.type == 'character':
                 self.size_bits = 8
@@ -244,7 +266,11 @@ class DataField(Field):
             elif self.type == 'object_selector':
                 self.size_bits = 16
             
-        if not self.numeric:
+        # an object selector is laid out, but not yet written unless
+        # its value is numeric
+        if self.type == 'object_selector':
+            self.numeric = isinstance(self.value, int)
+        elif not self.numeric:
             self.skip = True
             return
         
@@ -258,8 +284,16 @@ class DataField(Field):
             return # XXX
         if not self.numeric:
             return # XXX
-        bytes = [(self.value >> (8*i)) & 0xff for i in range(self.size_bits//8)]
-        self.segment.write_byte_to_image(self.offset_bits, bytes)
+        value = self.value
+        if self.type == 'label' and not isinstance(value, int):
+            value = self.segment.labels.get(value)
+            if value is None:
+                print("segment %s field %s: undefined label %s" % (self.segment.name, self.name, self.value))
+                return
+        size_bytes = self.size_bits // 8
+        self.segment.write_uint_to_image(self.offset_bits,
+                                         value & ((1 << self.size_bits) - 1),
+                                         size_bytes)
 
 
 class CodeItem(object):
@@ -284,7 +318,7 @@ class Label(CodeItem):
             d.get(k, Label._parse_other)(k, v)
         assert self.name is not None
         assert self.name not in field.segment.labels
-        field.segment.labels[self.name] = field.segment.ip
+        field.segment.labels[self.name] = None  # bit offset, assigned when assembled
 
 class Assume(CodeItem):
     def __init__(self, field, item_tree):
@@ -294,8 +328,32 @@ class Assume(CodeItem):
         field.segment.eas[self.eas_index] = self.seg_name
 
 class Instruction(CodeItem):
+    def _parse_dref(self, ref_tree):
+        segment_name = ref_tree.get('segment')
+        displacement = ref_tree.get('displacement')
+        assert segment_name is not None and displacement is not None
+        self.drefs.append((segment_name, displacement))
+
+    def _parse_bref(self, ref_tree):
+        assert self.target is None
+        self.target = ref_tree.get('target')
+        assert self.target is not None
+
+    def _parse_other(self, ref_tree):
+        print("unrecognized instruction operand", ref_tree.tag)
+
     def __init__(self, field, item_tree):
-        pass
+        self.op = item_tree.get('op')
+        assert self.op is not None
+        self.format = normalize_format(item_tree.get('format', ''))
+        # EAS assumptions in effect at this instruction
+        self.eas = tuple(field.segment.eas)
+        self.drefs = []   # (segment name, displacement) pairs
+        self.target = None
+        d = { 'dref': self._parse_dref,
+              'bref': self._parse_bref }
+        for ref_tree in item_tree:
+            d.get(ref_tree.tag, self._parse_other)(ref_tree)
 
 
 class Code(Field):
@@ -303,14 +361,19 @@ class Code(Field):
         super().__init__(segment, field_tree)
         assert segment.base_type == 0
         assert segment.__class__ == InstructionSegment
-        self.size_bits = 0 # each instruction will be allocated as it is parsed
+        assert segment.code is None
+        segment.code = self
+        self.offset_bits = instruction_start_bits(self.arch)
+        self.size_bits = 0 # determined when the instructions are assembled
+        self.data = b''
         self.items = []
-        d = { 'label':       Label,
-              'assume':      Assume, 
-              'instruction': Instruction }
         for item in field_tree:
             self.items.append(CodeItem.parse(self, item))
 
+    def write_value(self):
+        if self.size_bits:
+            self.segment.write_byte_to_image(self.offset_bits, self.data)
+
 class ObjectTableEntry(Field):
     def __init__(self, segment, offset_bits = None):
         #print("creating OTE, offset", offset)
@@ -322,9 +385,20 @@ class ObjectTableEntry(Field):
             self.offset_bits = offset_bits
             self.allocate()
 
+    # object table entries are allocated from the table's slot allocator
+    # rather than its bit-granular allocation
+    def allocate(self):
+        if self.allocated:
+            return
+        if self.offset_bits is None:
+            self.offset_bits = self.segment.slots.allocate() * 128
+        else:
+            assert self.offset_bits % 128 == 0
+            self.segment.slots.claim(self.offset_bits // 128)
+        self.allocated = True
+
     def write_value(self):
-        for i in range(len(self.descriptor)):
-            self.segment.write_u32_to_image(self.offset_bits, self.descriptor)
+        self.segment.write_u32_to_image(self.offset_bits, self.descriptor)
 
 class ObjectTableHeader(ObjectTableEntry):
     def __init__(self, segment):
@@ -418,7 +492,6 @@ class Object(object):
         self.dir_index = None
         self.seg_index = None
         self.level_number = 0  # XXX global
-        self.reference_count = 0
         self.ote = None
 
         self.object_table = tree.get('object_table')
@@ -445,7 +518,7 @@ class Object(object):
             else:
                 seg_table = self.image.object_by_coord[(2, self.dir_index)]
             if self.seg_index is None:
-                self.seg_index = seg_table.allocation.find_free(size=128) // 128
+                self.seg_index = seg_table.slots.find_free()
             self.ote = self.create_object_descriptor(seg_table)
             self.ote.allocate()
             assert self.seg_index == self.ote.offset_bits // 128
@@ -464,6 +537,9 @@ class Object(object):
         coord = (self.dir_index, self.seg_index)
         #print("descr", self.name, "assigned", coord)
         assert coord not in self.image.object_by_coord
+        seg_table = self.image.object_by_coord.get((2, self.dir_index))
+        if seg_table is not None and not seg_table.slots.is_free(self.seg_index):
+            raise AllocationError('%s coordinates (%d, %d) already in use' % (self.name, self.dir_index, self.seg_index))
         self._alloc_ote()
 
     def _set_dir_index(self, dir_index):
@@ -603,13 +679,17 @@ class Segment(Object):
         #     and/or zero-length access part
         return 8
     
+    # size in bits of the allocated part of the segment
+    def allocated_size_bits(self):
+        return self.allocation.last_free_range()
+
     def compute_size(self):
         # first allocate fields at fixed offsets
         for field in self.fields:
             if (not field.allocated) and (field.offset_bits is not None):
                 try:
                     field.allocate()
-                except Allocation.AllocationError as e:
+                except AllocationError as e:
                      print("segment %s field allocation error, pos %d, size %d" % (self.name, field.offset_bits, field.size_bits))
 
         # then allocate fields at dynamic offsets
@@ -618,7 +698,7 @@ class Segment(Object):
                 field.allocate()
 
         try:
-            self.size_bits = max(self.allocation.last_free_range(),
+            self.size_bits = max(self.allocated_size_bits(),
                                  self.min_size_bits,
                                  self.abs_min_size_bits())
         except Exception as e:
@@ -628,19 +708,23 @@ class Segment(Object):
                   self.abs_min_size_bits())
         return self.size_bits
 
+    # Size in bytes of physical memory occupied by a segment of the
+    # specified size in bits, including the 8 byte segment prefix, below
+    # the phys addr, and rounding up to a multiple of 8 bytes.
+    @staticmethod
+    def phys_size_bytes(size_bits):
+        size_bits_rounded_with_prefix = 64 + size_bits
+        if size_bits_rounded_with_prefix % 64 != 0:
+            size_bits_rounded_with_prefix += 64 - (size_bits_rounded_with_prefix % 64)
+        return size_bits_rounded_with_prefix // 8
+
     def allocate_physical_memory(self, debug = False):
         if self.phys_allocated:
             return
         assert self.size_bits is not None
-        # allow 8 bytes for segment prefix, below the phys addr
-        # and round up size to a multiple of 8
-        size_bits_rounded_with_prefix = 64 + self.size_bits
-        if size_bits_rounded_with_prefix % 64 != 0:
-            size_bits_rounded_with_prefix += 64 - (size_bits_rounded_with_prefix % 64)
-        #print("segment %s coord (%d, %d): orig size %d rounded with prefix %d" % (self.name, self.dir_index, self.seg_index, self.size_bits, size_bits_rounded_with_prefix))
-        size_bytes_with_prefix = size_bits_rounded_with_prefix // 8
+        size_bytes_with_prefix = self.phys_size_bytes(self.size_bits)
         if debug:
-            print('size %d bits, size_bits_rounded_with_prefix %d bits, size_bytes_with_prefix %d' % (self.size_bits, size_bits_rounded_with_prefix, size_bytes_with_prefix))
+            print('size %d bits, size_bytes_with_prefix %d' % (self.size_bits, size_bytes_with_prefix))
         if self.phys_addr is None:
             self.phys_addr = self.image.phys_mem_allocation.allocate(size = size_bytes_with_prefix) + 8
         else:
@@ -660,31 +744,51 @@ class Segment(Object):
     def create_object_descriptor(self, seg_table):
         return StorageDescriptor(seg_table, self, self.seg_index)
 
-    # can write a single byte or a sequence of bytes
-    def write_byte_to_image(self, bit_offset, data):
+    _uint_format = { 1: 'B',
+                     2: 'H',
+                     4: 'I',
+                     8: 'Q' }
+
+    # Write a single unsigned integer, or a sequence of unsigned
+    # integers, of size_bytes each, little-endian, directly into the
+    # image physical memory.
+    def write_uint_to_image(self, bit_offset, data, size_bytes):
         assert self.phys_addr is not None
         assert bit_offset % 8 == 0
         byte_offset = bit_offset // 8
-        #print('bit offset %d, byte offset %d' % (bit_offset, byte_offset))
-        pa = self.phys_addr + byte_offset
         if isinstance(data, int):
-            #print('writing byte %02x to byte offset %04x, pa %06x' % (data, byte_offset, pa))
-            self.image.phys_mem[pa] = data
+            data = (data,)
+        count = len(data)
+        if byte_offset + count * size_bytes > self.size_bits // 8:
+            print("byte offset %d, size bits %d, byte count %d" % (byte_offset, self.size_bits, count * size_bytes))
+        assert byte_offset + count * size_bytes <= self.size_bits // 8
+        pa = self.phys_addr + byte_offset
+        self.image.bytes_written += count * size_bytes
+        if size_bytes in self._uint_format:
+            self.image.phys_mem.pack_into('<%d%s' % (count, self._uint_format[size_bytes]),
+                                          pa, *data)
         else:
-            if byte_offset + len(data) > (self.size_bits * 8):
-                print("byte offset %d, size bits %d, byte count %d" % (byte_offset, self.size_bits, len(data)))
-            assert byte_offset + len(data) <= (self.size_bits * 8)
-            #print('writing bytes %s to byte offset %04x, pa %06x' % (' '.join(['%02x' % d for d in data]), byte_offset, pa))
-            self.image.phys_mem[pa:pa + len(data)] = data
+            for v in data:
+                self.image.phys_mem[pa:pa + size_bytes] = v.to_bytes(size_bytes, 'little')
+                pa += size_bytes
+
+    # Each of the following can write a single value or a sequence
+    # of values.
+    def write_u8_to_image(self, bit_offset, data):
+        self.write_uint_to_image(bit_offset, data, 1)
+
+    def write_u16_to_image(self, bit_offset, data):
+        self.write_uint_to_image(bit_offset, data, 2)
 
-    # can write a single u32 or a sequence of u32
     def write_u32_to_image(self, bit_offset, data):
-        if isinstance(data, int):
-            self.write_byte_to_image(bit_offset,
-                                     [(data >> (8*j)) & 0xff for j in range(4)])
-        else:
-            for i in range(len(data)):
-                self.write_u32_to_image(bit_offset + 32*i, data[i])
+        self.write_uint_to_image(bit_offset, data, 4)
+
+    def write_u64_to_image(self, bit_offset, data):
+        self.write_uint_to_image(bit_offset, data, 8)
+
+    # can write a single byte or a sequence of bytes
+    def write_byte_to_image(self, bit_offset, data):
+        self.write_uint_to_image(bit_offset, data, 1)
 
     def write_to_image(self):
         if self.written:
@@ -699,8 +803,7 @@ class Segment(Object):
         #print('AD image %08x' % (ad_image))
         
         # write segment prefix at self.phys_addr - 8
-        self.write_u32_to_image(-64, ad_image)
-        self.write_u32_to_image(-32, 0)
+        self.write_u32_to_image(-64, (ad_image, 0))
 
         for field in self.fields:
             field.write_value()
@@ -740,6 +843,8 @@ class DataSegment(Segment):
 
 
 class SegmentTable(DataSegment):
+    max_entries = 4096
+
     # a factory method
     @staticmethod
     def parse(image, tree):
@@ -751,6 +856,9 @@ class SegmentTable(DataSegment):
 
     def __init__(self, image, segment_tree):
         super().__init__(image, segment_tree)
+        # object table entries are fixed size slots
+        self.slots = SlotAllocator(self.max_entries, self.name)
+
         assert len(segment_tree) == 0   # can't have any data fields
         assert self.dir_index is None or self.dir_index is 2
         self._set_dir_index(2)
@@ -761,19 +869,34 @@ class SegmentTable(DataSegment):
         self.object_table_header = ObjectTableHeader(self)
         self.fields.append(self.object_table_header)
 
+    # Returns a list of (index, count) of ranges of free descriptors
+    # needed to fill all unused entries below the last used entry, plus
+    # enough additional entries at the end to provide at least
+    # min_free_descriptors free descriptors.
+    def free_descriptor_ranges(self):
+        end = self.slots.end()
+        ranges = list(self.slots.free_ranges(end))
+        count = sum(n for start, n in ranges)
+        if count < self.min_free_descriptors:
+            ranges.append((end, self.min_free_descriptors - count))
+        return ranges
+
+    def allocated_size_bits(self):
+        return self.slots.end() * 128
+
     def compute_size(self):
         # fill remaining space with free descriptors in a linked list
         prev_descriptor = self.object_table_header
-        free_descriptor_count = 0
         index = 0
-        while (not self.allocation.contiguous_from_zero()) or free_descriptor_count < self.min_free_descriptors:
-            free_descriptor = FreeDescriptor(self)
-            free_descriptor.allocate()
-            index = free_descriptor.offset_bits // 128
-            self.fields.append(free_descriptor)
-            prev_descriptor.set_free_index(index)
-            free_descriptor_count += 1
-            prev_descriptor = free_descriptor
+        for start, count in self.free_descriptor_ranges():
+            self.slots.reserve(start, count)
+            for index in range(start, start + count):
+                free_descriptor = FreeDescriptor(self)
+                free_descriptor.offset_bits = index * 128
+                free_descriptor.allocated = True
+                self.fields.append(free_descriptor)
+                prev_descriptor.set_free_index(index)
+                prev_descriptor = free_descriptor
         self.object_table_header.set_end_index(index)
         return super().compute_size()
 
@@ -800,9 +923,85 @@ class InstructionSegment(DataSegment):
     def __init__(self, image, segment_tree):
         self.labels = { }
         self.eas = [ None, None, None, None ]
-        self.ip = 112  # XXX should get from definitions
+        self.code = None
         super().__init__(image, segment_tree)
 
+    # Returns the EAS index and AD slot through which a segment is
+    # accessible, given the EAS assumptions of an instruction.
+    def _selector(self, eas, segment_name):
+        for eas_index, as_name in enumerate(eas):
+            access_segment = self.image.object_by_name.get(as_name)
+            if access_segment is None:
+                continue
+            for field in access_segment.fields:
+                if isinstance(field, AD) and field.segment_name == segment_name:
+                    return eas_index, field.offset_bits // 32
+        raise AssemblyError('segment %s not accessible through assumed EAS' % segment_name)
+
+    # Returns a displacement in bytes, given either a number or the name
+    # of a field of the segment.
+    def _displacement(self, segment_name, displacement):
+        try:
+            return int(displacement, 0)
+        except ValueError:
+            pass
+        segment = self.image.object_by_name.get(segment_name)
+        if segment is None:
+            raise AssemblyError('unknown segment %s' % segment_name)
+        for field in segment.fields:
+            if isinstance(field, DataField) and field.name == displacement and field.offset_bits is not None:
+                return field.offset_bits // 8
+        f = self.arch.symbols[segment.segment_type].value.field_by_name.get(displacement)
+        if f is None or f.offset_bits is None:
+            raise AssemblyError('segment %s has no field %s' % (segment_name, displacement))
+        return f.offset_bits // 8
+
+    def _assembly_error(self, msg):
+        print("segment %s: %s" % (self.name, msg))
+        self.image.assembly_errors.append((self.name, msg))
+
+    # Encode the instructions into the code field.  Must be done after
+    # the sizes of the segments referenced by the code are computed.
+    # Errors are reported and recorded in the image's assembly_errors.
+    def assemble(self):
+        block = CodeBlock(self.image.assembler, self.code.offset_bits)
+        for item in self.code.items:
+            try:
+                if isinstance(item, Label):
+                    block.label(item.name)
+                elif isinstance(item, Instruction):
+                    refs = [direct_scalar_reference(*self._selector(item.eas, segment_name),
+                                                    self._displacement(segment_name, displacement))
+                            for segment_name, displacement in item.drefs]
+                    block.instruction(item.op, item.format, refs, item.target)
+            except AssemblyError as e:
+                if isinstance(item, Instruction):
+                    self._assembly_error("instruction %s: %s" % (item.op, e))
+                else:
+                    self._assembly_error(str(e))
+        try:
+            block.relax()
+            self.labels.update(block.label_offsets())
+            self.code.data = block.getvalue()
+        except AssemblyError as e:
+            self._assembly_error(str(e))
+            self.code.data = b''
+        self.code.size_bits = 8 * len(self.code.data)
+
+    # Returns a hash of the code and its offset, or None if there's no
+    # code.  Must be called after assemble().
+    def code_hash(self):
+        if self.code is None:
+            return None
+        h = hashlib.sha256(self.code.data)
+        h.update(str(self.code.offset_bits).encode('ascii'))
+        return h.hexdigest()
+
+    def compute_size(self):
+        if self.code is not None:
+            self.assemble()
+        return super().compute_size()
+
 
 class Refinement(Object):
     # a factory method
@@ -836,12 +1035,23 @@ class Image(object):
         def __init__(self, tree):
             self.msg = 'invalid object type "%s"' % tree.tag
 
-    def __init__(self, arch, image_tree):
+    phys_mem_size = 1 << 24
+
+    # phys_mem, if supplied, is a physmem.PhysicalMemory of
+    # phys_mem_size bytes. If image_tree is None, objects are added
+    # with add_object(), as done by parse_file(). The definition hash
+    # of each object, needed only for incremental rebuilds, is computed
+    # if hash_definitions is True.
+    def __init__(self, arch, image_tree = None, phys_mem = None, hash_definitions = False):
         self.arch = arch
-        image_root = image_tree.getroot()
-        assert image_root.tag == 'image'
+        self.hash_definitions = hash_definitions
+        self.assembler = Assembler(arch)
         self.object_by_coord = { }
 
+        # ADs referring to each object, by coordinates of the object,
+        # maintained as the ADs are resolved
+        self.references = { }
+
         self.object_by_name = OrderedDict()
         # Using OrderedDict here to get deterministic enumeration
         # of the dictionary. This program should produce correct output
@@ -849,14 +1059,64 @@ class Image(object):
         # is advantageous for regression testing.
 
         self.segment_table_directory = None
-        self.phys_mem_allocation = Allocation(1 << 24, "phys mem")
-        self.phys_mem = bytearray(1 << 24)
-
-        for obj_tree in image_root:
-            name = obj_tree.get('name')
-            assert name not in self.object_by_name
-            #print('Image.__init__() calling Object.parse() for %s' % name)
-            self.object_by_name[name] = Object.parse(self, obj_tree)
+        # the physical memory allocator holds every segment, so
+        # first fit searches benefit from the free index
+        self.phys_mem_allocation = Allocation(self.phys_mem_size, "phys mem",
+                                              indexed = True)
+        if phys_mem is None:
+            phys_mem = SparseMemory(self.phys_mem_size)
+        assert len(phys_mem) == self.phys_mem_size
+        self.phys_mem = phys_mem
+        self.bytes_written = 0
+        self.assembly_errors = []   # (segment name, message)
+        # options affecting the result, recorded in the build state
+        self.layout = 'definition'
+        self.unreachable_stripped = False
+        # segments kept at the addresses recorded in the build state
+        self.recorded_placements = []
+
+        if image_tree is not None:
+            image_root = image_tree.getroot()
+            assert image_root.tag == 'image'
+            for obj_tree in image_root:
+                self.add_object(obj_tree)
+
+    def add_object(self, obj_tree):
+        name = obj_tree.get('name')
+        assert name not in self.object_by_name
+        #print('Image.__init__() calling Object.parse() for %s' % name)
+        obj = Object.parse(self, obj_tree)
+        obj.definition_hash = None
+        if self.hash_definitions:
+            # hash excludes the tail, i.e., whitespace following the element
+            tail = obj_tree.tail
+            obj_tree.tail = None
+            obj.definition_hash = hashlib.sha256(xml.etree.ElementTree.tostring(obj_tree)).hexdigest()
+            obj_tree.tail = tail
+        self.object_by_name[name] = obj
+        return obj
+
+    # Construct an Image from an image definition file, using iterparse
+    # to construct each object as soon as its element has been parsed,
+    # then discarding the element, so that the whole element tree is
+    # never in memory at once.
+    @classmethod
+    def parse_file(cls, arch, f, phys_mem = None, hash_definitions = False):
+        image = cls(arch, phys_mem = phys_mem, hash_definitions = hash_definitions)
+        depth = 0
+        image_root = None
+        for event, elem in xml.etree.ElementTree.iterparse(f, events = ('start', 'end')):
+            if event == 'start':
+                if depth == 0:
+                    assert elem.tag == 'image'
+                    image_root = elem
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1:
+                image.add_object(elem)
+                image_root.clear()
+        return image
 
     def assign_coordinates(self):
         # assign coordinates to all segment tables
@@ -869,31 +1129,118 @@ class Image(object):
             obj.assign_coordinates()
 
     def compute_segment_sizes(self):
-        # compute sizes of all segments
+        # compute sizes of all segments; instruction segments last, since
+        # assembling their code needs the offsets of fields in the
+        # segments it references
         for obj in self.object_by_name.values():
-            if isinstance(obj, Segment):
+            if isinstance(obj, Segment) and not isinstance(obj, InstructionSegment):
+                obj.compute_size()
+        for obj in self.object_by_name.values():
+            if isinstance(obj, InstructionSegment):
                 obj.compute_size()
 
-    def allocate_physical_memory(self):
+    layouts = ('definition', 'bfs', 'dfs')
+
+    # Returns the objects in the order in which physical memory is
+    # allocated to them. The 'definition' layout is the order of the
+    # image definition. The 'bfs' and 'dfs' layouts traverse the ADs
+    # from the processor access segments, breadth first or depth first,
+    # so that objects that are used together are adjacent. With either,
+    # the object tables come first, and unreachable objects last.
+    def layout_order(self, layout = 'definition'):
+        objects = list(self.object_by_name.values())
+        if layout == 'definition':
+            return objects
+        order = [obj for obj in objects if isinstance(obj, SegmentTable)]
+        roots = [obj for obj in objects if obj.dir_index == 1]
+        placed = set(order) | set(roots)
+        if layout == 'bfs':
+            order += roots
+            queue = deque(roots)
+            while queue:
+                for target in self._ad_targets(queue.popleft()):
+                    if target not in placed:
+                        placed.add(target)
+                        order.append(target)
+                        queue.append(target)
+        else:
+            # depth first, except that an access segment is followed
+            # by the other segments it refers to before the access
+            # segments it refers to, e.g., a context access segment by
+            # its context data and operand stack segments
+            stack = roots[::-1]
+            while stack:
+                obj = stack.pop()
+                order.append(obj)
+                access_segments = []
+                for target in self._ad_targets(obj):
+                    if target in placed:
+                        continue
+                    placed.add(target)
+                    if isinstance(target, AccessSegment):
+                        access_segments.append(target)
+                    else:
+                        order.append(target)
+                stack += access_segments[::-1]
+        order += [obj for obj in objects if obj not in placed]
+        return order
+
+    def allocate_physical_memory(self, layout = 'definition'):
+        self.layout = layout
         # allocate physical memory to objects at fixed addresses
-        for obj in self.object_by_name.values():
-            if obj.phys_addr is not None:
+        recorded = set(self.recorded_placements)
+        fixed = set(obj for obj in self.object_by_name.values()
+                    if obj.phys_addr is not None and obj not in recorded)
+        for obj in fixed:
+            obj.allocate_physical_memory()
+
+        if not recorded:
+            # allocate physical memory to all other objects
+            for obj in self.layout_order(layout):
+                obj.allocate_physical_memory()
+            return
+
+        # Keep segments at their recorded addresses, then allocate all
+        # other objects.  A recorded address may no longer be free, e.g.
+        # if the object table directory has grown, or the memory may be
+        # too fragmented for the other objects, so if allocation fails,
+        # back out and allocate as for a full build.
+        snapshot = self.phys_mem_allocation.snapshot()
+        try:
+            for obj in self.recorded_placements:
+                obj.allocate_physical_memory()
+            for obj in self.layout_order(layout):
+                obj.allocate_physical_memory()
+        except AllocationError as e:
+            print('unable to keep segments at recorded addresses: %s' % e)
+            self.phys_mem_allocation.restore(snapshot)
+            for obj in self.object_by_name.values():
+                if isinstance(obj, Segment) and obj not in fixed:
+                    obj.phys_addr = None
+                    obj.phys_allocated = False
+            self.recorded_placements = []
+            for obj in self.layout_order(layout):
                 obj.allocate_physical_memory()
 
-        # allocate physical memory to all other objects
+    def resolve_references(self):
+        # resolve the targets of all ADs to coordinates
         for obj in self.object_by_name.values():
-            obj.allocate_physical_memory()
+            if isinstance(obj, AccessSegment):
+                for field in obj.fields:
+                    if isinstance(field, AD):
+                        field.resolve()
 
-    def write_segments(self):
+    # If segments is not None, only the named segments are written.
+    def write_segments(self, segments = None):
         # if segment has a preassigned base address, write it
         for obj in self.object_by_name.values():
-            if isinstance(obj, Segment):
+            if isinstance(obj, Segment) and (segments is None or obj.name in segments):
                 if obj.phys_addr is not None:
                     obj.write_to_image()
 
         # write all other segments
         for obj in self.object_by_name.values():
-            if isinstance(obj, Segment):
+            if isinstance(obj, Segment) and (segments is None or obj.name in segments):
                 obj.write_to_image()
 
     def get_size(self):
@@ -901,35 +1248,259 @@ class Image(object):
         return self.size
 
     def write_to_file(self, f):
-        f.write(self.phys_mem[0:self.size])
+        self.phys_mem.write_to_file(f, self.size)
+
+    # Returns counts of objects, fields and bytes written, and of
+    # allocator operations, for build statistics.
+    def get_stats(self):
+        def sum_counters(allocations):
+            total = OrderedDict(vars(AllocationCounters()))
+            for a in allocations:
+                for k, v in vars(a.counters).items():
+                    total[k] += v
+            return total
+
+        segments = [obj for obj in self.object_by_name.values()
+                    if isinstance(obj, Segment)]
+        written = [seg for seg in segments if seg.written]
+        counts = OrderedDict()
+        counts['objects'] = len(self.object_by_name)
+        counts['segments'] = len(segments)
+        counts['segments_written'] = len(written)
+        counts['fields'] = sum(len(seg.fields) for seg in segments)
+        counts['fields_written'] = sum(len(seg.fields) for seg in written)
+        counts['bytes_written'] = self.bytes_written
+        counts['image_size'] = getattr(self, 'size', None)
+        allocators = OrderedDict()
+        allocators['phys_mem'] = sum_counters([self.phys_mem_allocation])
+        allocators['segment'] = sum_counters([seg.allocation for seg in segments])
+        allocators['object_table_slots'] = sum_counters([seg.slots for seg in segments
+                                                         if isinstance(seg, SegmentTable)])
+        return OrderedDict([('counts', counts), ('allocators', allocators)])
+
+    # Incremental rebuild support
+    #
+    # The build state records, for each object, a hash of its definition,
+    # its coordinates, and for segments, its size and physical address.
+    # For instruction segments, it also records a hash of the assembled
+    # code, which depends on the layout of the segments it references.
+    # When rebuilding, objects with unchanged definitions keep their
+    # coordinates, and segments that haven't changed size keep their
+    # physical addresses, so that only segments that are changed, or
+    # that contain descriptors of or ADs for changed objects, need to
+    # be written to the existing image file.
+
+    build_state_version = 3
 
-    def reachability_check(self):
+    @staticmethod
+    def builder_hash():
+        h = hashlib.sha256()
+        for fn in (__file__, assembler.__file__):
+            with open(fn, 'rb') as f:
+                h.update(f.read())
+        return h.hexdigest()
+
+    def get_build_state(self):
+        objects = OrderedDict()
+        for obj in self.object_by_name.values():
+            objects[obj.name] = { 'hash':      obj.definition_hash,
+                                  'type':      getattr(obj, 'segment_type', None),
+                                  'dir_index': obj.dir_index,
+                                  'seg_index': obj.seg_index,
+                                  'size_bits': getattr(obj, 'size_bits', None),
+                                  'phys_addr': getattr(obj, 'phys_addr', None) }
+            if isinstance(obj, InstructionSegment):
+                objects[obj.name]['code_hash'] = obj.code_hash()
+        return { 'version':    self.build_state_version,
+                 'builder':    self.builder_hash(),
+                 'arch':       getattr(self.arch, 'source_hash', None),
+                 'image_size': self.size,
+                 'layout':     self.layout,
+                 'strip_unreachable': self.unreachable_stripped,
+                 'objects':    objects }
+
+    # Can be called before the image is parsed, to decide whether the
+    # existing image file can be updated in place.  A different layout
+    # or stripping of unreachable objects would place the objects
+    # differently, so requires a full build.
+    @classmethod
+    def build_state_compatible(cls, state, arch, layout = 'definition',
+                               strip_unreachable = False):
+        return (state is not None and
+                state.get('version') == cls.build_state_version and
+                state.get('builder') == cls.builder_hash() and
+                state.get('arch') is not None and
+                state.get('arch') == getattr(arch, 'source_hash', None) and
+                state.get('layout') == layout and
+                state.get('strip_unreachable') == strip_unreachable)
+
+    # Must be called before assign_coordinates().
+    def apply_build_state_coordinates(self, state):
+        recorded = state['objects']
+        def unchanged(obj):
+            return (obj.name in recorded and
+                    recorded[obj.name]['hash'] == obj.definition_hash)
+        # segment tables first, since the other objects need their
+        # segment table to have coordinates
+        objects = ([obj for obj in self.object_by_name.values() if isinstance(obj, SegmentTable)] +
+                   [obj for obj in self.object_by_name.values() if not isinstance(obj, SegmentTable)])
+        for obj in objects:
+            if not unchanged(obj):
+                continue
+            r = recorded[obj.name]
+            coord = (r['dir_index'], r['seg_index'])
+            if obj.seg_index is not None:
+                continue
+            if obj.dir_index is not None and obj.dir_index != coord[0]:
+                continue
+            if coord in self.object_by_coord or (2, coord[0]) not in self.object_by_coord:
+                continue
+            obj._set_dir_index(coord[0])
+            obj._set_seg_index(coord[1])
+
+    # Must be called after compute_segment_sizes() and before
+    # allocate_physical_memory().
+    def apply_build_state_placement(self, state):
+        recorded = state['objects']
+        for obj in self.object_by_name.values():
+            if not isinstance(obj, Segment) or obj.phys_addr is not None:
+                continue
+            r = recorded.get(obj.name)
+            if r is None or r['phys_addr'] is None:
+                continue
+            # keep the segment in place if it still fits
+            if Segment.phys_size_bytes(obj.size_bits) <= Segment.phys_size_bytes(r['size_bits']):
+                obj.phys_addr = r['phys_addr']
+                self.recorded_placements.append(obj)
+
+    # Returns a set of names of segments that must be written, and a list
+    # of (address, size) physical memory ranges that were occupied by
+    # segments that have since moved or been removed.  Must be called
+    # after resolve_references().
+    def incremental_changes(self, state):
+        recorded = state['objects']
+        changed = set()
+        coord_changed = set()
+        tables = set()   # dir indexes of object tables containing changed entries
+        stale_ranges = []
+        for obj in self.object_by_name.values():
+            r = recorded.get(obj.name)
+            if (r is None or
+                r['dir_index'] != obj.dir_index or
+                r['seg_index'] != obj.seg_index):
+                coord_changed.add(obj.name)
+            if (r is None or
+                r['hash'] != obj.definition_hash or
+                r['dir_index'] != obj.dir_index or
+                r['seg_index'] != obj.seg_index or
+                r['size_bits'] != getattr(obj, 'size_bits', None) or
+                r['phys_addr'] != getattr(obj, 'phys_addr', None)):
+                changed.add(obj.name)
+                # the object's descriptor only depends on its type,
+                # coordinates, size and address, not its contents
+                if (r is None or
+                    r['type'] != getattr(obj, 'segment_type', None) or
+                    r['dir_index'] != obj.dir_index or
+                    r['seg_index'] != obj.seg_index or
+                    r['size_bits'] != getattr(obj, 'size_bits', None) or
+                    r['phys_addr'] != getattr(obj, 'phys_addr', None)):
+                    tables.add(obj.dir_index)
+                    if r is not None:
+                        tables.add(r['dir_index'])
+        for name, r in recorded.items():
+            obj = self.object_by_name.get(name)
+            if obj is None:
+                coord_changed.add(name)
+                tables.add(r['dir_index'])
+            if r['phys_addr'] is None:
+                continue
+            if (obj is None or
+                r['phys_addr'] != obj.phys_addr or
+                r['size_bits'] != obj.size_bits):
+                stale_ranges.append((r['phys_addr'] - 8, Segment.phys_size_bytes(r['size_bits'])))
+
+        dirty = set()
+        for obj in self.object_by_name.values():
+            if not isinstance(obj, Segment):
+                continue
+            if obj.name in changed:
+                dirty.add(obj.name)
+            elif isinstance(obj, SegmentTable) and obj.seg_index in tables:
+                dirty.add(obj.name)
+            elif (isinstance(obj, InstructionSegment) and
+                  recorded[obj.name].get('code_hash') != obj.code_hash()):
+                # the code depends on the layout of the segments it references
+                dirty.add(obj.name)
+            elif isinstance(obj, AccessSegment):
+                for field in obj.fields:
+                    if isinstance(field, AD) and field.segment_name in coord_changed:
+                        dirty.add(obj.name)
+                        break
+        return dirty, stale_ranges
+
+    def clear_phys_mem(self, ranges):
+        for addr, size in ranges:
+            self.phys_mem[addr:addr + size] = bytes(size)
+
+    # Patch an existing image file with the contents of the specified
+    # physical memory ranges and segments.
+    def patch_file(self, f, ranges, segments):
+        ranges = list(ranges)
+        for name in segments:
+            obj = self.object_by_name[name]
+            ranges.append((obj.phys_addr - 8, Segment.phys_size_bytes(obj.size_bits)))
+        for addr, size in sorted(ranges):
+            if addr >= self.size:
+                continue
+            size = min(size, self.size - addr)
+            f.seek(addr)
+            f.write(self.phys_mem.read(addr, size))
+        f.truncate(self.size)
+
+    # Returns a list of (segment, AD index) of the ADs referring to an
+    # object. Must be called after resolve_references(), and the AD
+    # indexes are only known after compute_segment_sizes().
+    def referrers(self, obj):
+        return [(ad.segment, ad.offset_bits // 32)
+                for ad in self.references.get((obj.dir_index, obj.seg_index), [])]
+
+    # Generates the objects that the valid ADs of an object refer to.
+    def _ad_targets(self, obj):
+        if not isinstance(obj, AccessSegment):
+            return
+        for ad in obj.fields:
+            assert isinstance(ad, AD)
+            if ad.valid:
+                ad.resolve()
+                yield self.object_by_coord[(ad.dir_index, ad.seg_index)]
+
+    # Returns the set of objects reachable from the processor objects,
+    # which are the access segments in the object table directory, and
+    # the object tables.
+    def reachable_objects(self):
+        reachable = set()
         trace_queue = []
 
-        # iterate over all segments:
-        #   mark segment as not reachable
-        #   if segment is a Processor Access Segment:
-        #     append segment to trace queue
         for obj in self.object_by_name.values():
-            obj.reachable = False
             if obj.dir_index == 1:
                 assert isinstance(obj, AccessSegment)
-                assert obj.system_type == arch.get_enumeration_value('system_type', 'processor')['value']
+                assert obj.system_type == self.arch.get_enumeration_value('system_type', 'processor')['value']
+                reachable.add(obj)
                 trace_queue.append(obj)
 
         # for all object tables pointed to by object table directory
         #   mark object tables reachable
         otd = self.object_by_coord[(2, 2)]
         assert isinstance(otd, DataSegment)
-        assert otd.system_type == arch.get_enumeration_value('system_type', 'object_table')['value']
+        assert otd.system_type == self.arch.get_enumeration_value('system_type', 'object_table')['value']
         for ote in otd.fields:
             if isinstance(ote, StorageDescriptor):
                 seg_index = ote.offset_bits // 128
                 ot = self.object_by_coord[(2, seg_index)]
                 assert isinstance(ot, DataSegment)
-                assert ot.system_type == arch.get_enumeration_value('system_type', 'object_table')['value']
-                ot.reachable = True
-                
+                assert ot.system_type == self.arch.get_enumeration_value('system_type', 'object_table')['value']
+                reachable.add(ot)
+
         # while trace queue is not empty:
         #   pull an access segment from trace queue
         #   for each AD in access segment:
@@ -940,28 +1511,57 @@ class Image(object):
         while len(trace_queue):
             obj = trace_queue.pop()
             assert isinstance(obj, AccessSegment)
-            for ad in obj.fields:
-                assert isinstance(ad, AD)
-                if not ad.valid:
-                    continue
-                ad_seg = self.object_by_coord[(ad.dir_index, ad.seg_index)]
-                if ad_seg.reachable:
+            for ad_seg in self._ad_targets(obj):
+                if ad_seg in reachable:
                     continue
-                ad_seg.reachable = True
+                reachable.add(ad_seg)
                 if isinstance(ad_seg, AccessSegment):
                     trace_queue.append(ad_seg)
+        return reachable
 
-        # iterate over all segments:
-        #   if segment is not marked reachable:
-        #     report unreachable segment
-        for obj in self.object_by_name.values():
-            if not obj.reachable:
-                print('segment not reachable: (%d, %d) %s' % (obj.dir_index,
-                                                              obj.seg_index,
-                                                              obj.name))
-        else:
+    def reachability_check(self):
+        reachable = self.reachable_objects()
+        unreachable = [obj for obj in self.object_by_name.values()
+                       if obj not in reachable]
+        for obj in unreachable:
+            print('segment not reachable: (%d, %d) %s' % (obj.dir_index,
+                                                          obj.seg_index,
+                                                          obj.name))
+        if not unreachable:
             print('all objects reachable')
-                
+
+    # Remove the objects that aren't reachable, and free their object
+    # table entries. Returns the list of removed objects. Must be called
+    # after resolve_references() and before compute_segment_sizes(), so
+    # that the object tables are sized without the removed entries.
+    def strip_unreachable(self):
+        self.unreachable_stripped = True
+        reachable = self.reachable_objects()
+        stripped = [obj for obj in self.object_by_name.values()
+                    if obj not in reachable]
+        if not stripped:
+            return stripped
+
+        stripped_otes = set()
+        for obj in stripped:
+            del self.object_by_name[obj.name]
+            del self.object_by_coord[(obj.dir_index, obj.seg_index)]
+            self.object_by_coord[(2, obj.dir_index)].slots.free(obj.seg_index)
+            stripped_otes.add(obj.ote)
+        for obj in self.object_by_name.values():
+            if isinstance(obj, SegmentTable):
+                obj.fields = [f for f in obj.fields if f not in stripped_otes]
+
+        # an unreachable object is only referred to by unreachable
+        # access segments
+        stripped_set = set(stripped)
+        for coord, ads in list(self.references.items()):
+            if coord not in self.object_by_coord:
+                del self.references[coord]
+            else:
+                self.references[coord] = [ad for ad in ads if ad.segment not in stripped_set]
+        return stripped
+
 
 if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser(description='iAPX 432 Image Builder')
@@ -971,50 +1571,151 @@ if __name__ == '__main__':
                             help='architecture definition (XML)')
     arg_parser.add_argument('--list-segments',
                             action='store_true')
+    arg_parser.add_argument('--phys-mem',
+                            choices=sorted(phys_mem_backends.keys()),
+                            default='sparse',
+                            help='physical memory backing store: sparse pages, flat buffer, or memory-mapped output file (default: sparse)')
     arg_parser.add_argument('image_definition',
                             type=argparse.FileType('r'),
                             nargs=1,
                             help='image definition (XML)')
+    arg_parser.add_argument('--incremental',
+                            metavar='STATE_FILE',
+                            help='incremental rebuild, using and updating build state in STATE_FILE')
+    arg_parser.add_argument('--stats',
+                            metavar='STATS_FILE',
+                            help='write per-phase time and memory use, and allocator and output counts, as JSON to STATS_FILE ("-" for stdout, with other output to stderr)')
+    arg_parser.add_argument('--profile',
+                            metavar='PROFILE_DIR',
+                            help='profile each phase, writing .pstats files to PROFILE_DIR')
+    arg_parser.add_argument('--layout',
+                            choices=Image.layouts,
+                            default='definition',
+                            help='order of physical memory allocation: image definition order, or breadth first or depth first traversal of ADs from the processor objects (default: definition)')
+    arg_parser.add_argument('--strip-unreachable',
+                            action='store_true',
+                            help='omit objects that aren\'t reachable from the processor objects')
+    arg_parser.add_argument('--referrers',
+                            metavar='OBJECT',
+                            action='append',
+                            help='list the ADs referring to the named object, may be repeated')
     arg_parser.add_argument('image_binary',
-                            type=argparse.FileType('wb'),
                             nargs=1,
                             help='image binary output')
 
+    add_arch_cache_arguments(arg_parser)
+
     args = arg_parser.parse_args()
 
-    arch_tree = xml.etree.ElementTree.parse(args.arch)
-    args.arch.close()
-    arch = Arch(arch_tree)
+    # When the statistics are written to stdout, send everything else
+    # to stderr, so that stdout is only the JSON.
+    stats_stdout = None
+    if args.stats == '-':
+        stats_stdout = sys.stdout
+        sys.stdout = sys.stderr
+
+    stats = BuildStats(trace_memory = args.stats is not None,
+                       profile_dir = args.profile)
+
+    with stats.phase('load_arch'):
+        arch = load_arch_from_args(args)
 
-    image_tree = xml.etree.ElementTree.parse(args.image_definition[0])
+    state = None
+    if args.incremental is not None and os.path.exists(args.incremental):
+        try:
+            with open(args.incremental, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            print('unable to read build state:', e)
+    image_fn = args.image_binary[0]
+    # a full rebuild must start from an empty image file and physical
+    # memory, so decide before opening the file
+    incremental = (Image.build_state_compatible(state, arch, args.layout,
+                                                args.strip_unreachable) and
+                   os.path.isfile(image_fn) and
+                   os.path.getsize(image_fn) == state.get('image_size'))
+    image_file = open(image_fn, 'r+b' if incremental else 'w+b')
+
+    if args.phys_mem == 'mmap':
+        phys_mem = MmapMemory(image_file, Image.phys_mem_size)
+    else:
+        phys_mem = phys_mem_backends[args.phys_mem](Image.phys_mem_size)
+    with stats.phase('parse'):
+        image = Image.parse_file(arch, args.image_definition[0], phys_mem = phys_mem,
+                                 hash_definitions = args.incremental is not None)
     args.image_definition[0].close()
-    image = Image(arch, image_tree)
+
+    if args.incremental is not None:
+        if incremental:
+            print("incremental rebuild")
+        else:
+            print("full rebuild")
+
+    if incremental:
+        image.apply_build_state_coordinates(state)
 
     print("assigning coordinates of objects")
-    image.assign_coordinates()
+    with stats.phase('assign_coordinates'):
+        image.assign_coordinates()
+
+    print("resolving references")
+    with stats.phase('resolve_references'):
+        image.resolve_references()
 
-    # XXX need a pass after assigning coordinates parse contents of data
-    # segments, so that intersegment references can be resolved
+    if args.strip_unreachable:
+        with stats.phase('strip_unreachable'):
+            stripped = image.strip_unreachable()
+        for obj in stripped:
+            print('stripped unreachable object: (%d, %d) %s' % (obj.dir_index,
+                                                                obj.seg_index,
+                                                                obj.name))
 
     print("computing sizes of segments")
-    image.compute_segment_sizes()
+    with stats.phase('compute_segment_sizes'):
+        image.compute_segment_sizes()
+
+    if image.assembly_errors:
+        print("%d assembly errors" % len(image.assembly_errors))
+        sys.exit(1)
+
+    if incremental:
+        image.apply_build_state_placement(state)
 
     print("allocating physical memory to objects")
-    image.allocate_physical_memory()
-    
-    print("writing segments to image")
-    image.write_segments()
+    with stats.phase('allocate_physical_memory'):
+        image.allocate_physical_memory(args.layout)
 
     image_size = image.get_size()
+
+    with stats.phase('write_segments'):
+        if incremental:
+            dirty, stale_ranges = image.incremental_changes(state)
+            print("writing %d changed segments to image" % len(dirty))
+            image.clear_phys_mem(stale_ranges)
+            image.write_segments(dirty)
+        else:
+            print("writing segments to image")
+            image.write_segments()
+
     print("image size %d (0x%06x)" % (image_size, image_size))
 
     print('%d objects in image' % len(image.object_by_coord))
 
     for obj in image.object_by_name.values():
-        if obj.dir_index != 2 and obj.reference_count == 0:
+        if obj.dir_index != 2 and (obj.dir_index, obj.seg_index) not in image.references:
             print("no AD references", obj.name)
 
-    image.reachability_check()
+    for name in args.referrers or []:
+        if name not in image.object_by_name:
+            print("no object", name)
+            continue
+        obj = image.object_by_name[name]
+        print("ADs referring to (%d, %d) %s:" % (obj.dir_index, obj.seg_index, obj.name))
+        for segment, index in image.referrers(obj):
+            print("  (%d, %d) %s AD %d" % (segment.dir_index, segment.seg_index, segment.name, index))
+
+    with stats.phase('reachability_check'):
+        image.reachability_check()
 
     if args.list_segments:
         if True:
@@ -1033,6 +1734,25 @@ if __name__ == '__main__':
                 print("%06x..%06x" % (d.phys_addr, d.phys_addr + d.size_bits // 8 - 1), k, d.name)
 
     print("writing image to output file")
-    image.write_to_file(args.image_binary[0])
-    
-
+    with stats.phase('write_file'):
+        if incremental and not isinstance(phys_mem, MmapMemory):
+            image.patch_file(image_file, stale_ranges, dirty)
+        else:
+            image.write_to_file(image_file)
+        image_file.close()
+
+    if args.incremental is not None:
+        temp_fn = args.incremental + '.tmp'
+        with open(temp_fn, 'w') as f:
+            json.dump(image.get_build_state(), f, indent = 1)
+        os.replace(temp_fn, args.incremental)
+
+    if args.stats is not None:
+        for section, values in image.get_stats().items():
+            stats.set_counters(section, values)
+        if stats_stdout is not None:
+            stats.write_json(stats_stdout)
+        else:
+            with open(args.stats, 'w') as f:
+                stats.write_json(f)
+    stats.close()
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+# Build phase statistics for Intel iAPX 432 utilities
+
+# Copyright 2014, 2015, 2016, 2017 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import cProfile
+import json
+import os
+import time
+import tracemalloc
+
+
+class BuildStats(object):
+    """
+    Records wall clock time, CPU time and optionally peak traced memory
+    of each phase of a build, along with arbitrary counters, and
+    optionally profiles each phase with cProfile, writing a .pstats
+    file per phase to profile_dir.
+    """
+    def __init__(self, trace_memory = False, profile_dir = None):
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self.base_bytes = 0   # traced memory forgotten by restarting tracing
+        if profile_dir is not None:
+            os.makedirs(profile_dir, exist_ok = True)
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def phase(self, name):
+        if self.trace_memory:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            else:
+                # Before Python 3.9, the peak can only be reset by
+                # restarting tracing, which forgets the traced blocks,
+                # so the memory traced before the restart is added to
+                # the peak. Memory freed after the restart that was
+                # allocated before it is then not subtracted, so the
+                # peak may be overstated.
+                self.base_bytes += tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+                tracemalloc.start()
+        profile = None
+        if self.profile_dir is not None:
+            profile = cProfile.Profile()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            d = OrderedDict()
+            d['wall_s'] = time.perf_counter() - wall
+            d['cpu_s'] = time.process_time() - cpu
+            if self.trace_memory:
+                d['peak_bytes'] = self.base_bytes + tracemalloc.get_traced_memory()[1]
+            if profile is not None:
+                fn = os.path.join(self.profile_dir,
+                                  '%02d-%s.pstats' % (len(self.phases), name))
+                profile.dump_stats(fn)
+                d['profile'] = fn
+            self.phases[name] = d
+
+    def set_counters(self, section, values):
+        self.counters[section] = values
+
+    def as_dict(self):
+        d = OrderedDict()
+        d['phases'] = self.phases
+        d['total_wall_s'] = sum(p['wall_s'] for p in self.phases.values())
+        d['total_cpu_s'] = sum(p['cpu_s'] for p in self.phases.values())
+        if self.trace_memory:
+            d['peak_bytes'] = max([p['peak_bytes'] for p in self.phases.values()],
+                                  default = 0)
+        d.update(self.counters)
+        return d
+
+    def write_json(self, f):
+        json.dump(self.as_dict(), f, indent = 1)
+        f.write('\n')
+
+    def close(self):
+        if self.trace_memory:
+            tracemalloc.stop()
@@ -17,43 +17,76 @@
 
 import argparse
 import attr
+from bisect import bisect_left, bisect_right
 from bitarray import bitarray
+import concurrent.futures
+import fnmatch
+import hashlib
+import io
+import mmap
+import os
+import pickle
+import sys
+import traceback
 import xml.etree.ElementTree
 from collections import OrderedDict
 
-from allocation import Allocation
-from arch import Arch
+from arch import Arch, add_arch_cache_arguments, load_arch_from_args
+from disassembler import DecodeError, Disassembler, print_listing
 
 
 class ObjectBuilderBase:
+    # The following class attributes are set by object_builder_factory():
+    #   _size_bytes     number of bytes spanned by the fields
+    #   _field_names    tuple of field names
+    #   _extract        function taking the little-endian integer value
+    #                   of the object image and returning a tuple of the
+    #                   field values
+    #   _from_int       function taking the integer value and returning
+    #                   a new instance
+
     def load_from_image(self, image, offset):
-        for field in attr.fields(self.__class__):
-            name = field.name
-            lsb = field.metadata['lsb']
-            width = field.metadata['width']
-#            print('loading', name, lsb, width)
-            field_bit_offset = 0
-            image_byte_offset = offset + (lsb // 8)
-            image_bit_offset = lsb % 8
-            value = 0
-            while width > 0:
-                if image_bit_offset + width < 8:
-                    bits_from_byte = width
-                else:
-                    bits_from_byte = 8 - image_bit_offset
-#                print('image_byte_offset:', image_byte_offset,
-#                      'image_bit_offset:', image_bit_offset)
-                byte = image[image_byte_offset] >> image_bit_offset
-                byte &= ((1 << bits_from_byte) - 1)
-                value |= (byte << field_bit_offset)
-                image_byte_offset += 1
-                image_bit_offset = 0
-                width -= bits_from_byte
-                field_bit_offset += bits_from_byte
-#            print('value:', value)
+        v = int.from_bytes(image[offset:offset + self._size_bytes], 'little')
+        for name, value in zip(self._field_names, self._extract(v)):
             setattr(self, name, value)
         return self
 
+    @classmethod
+    def columns_from_values(cls, values):
+        """
+        Decode a list of object integer values into column lists, one
+        list of values per field, without constructing an instance per
+        object.
+
+        Returns:
+            An OrderedDict mapping field names to lists of values.
+        """
+        columns = OrderedDict()
+        for name, lsb, mask in cls._field_layout:
+            columns[name] = [(v >> lsb) & mask for v in values]
+        return columns
+
+    @classmethod
+    def columns_from_image(cls, image, offset, count, stride = None):
+        """
+        Decode an array of objects into column lists, one list of
+        values per field.
+
+        Args:
+            image:  bytes-like image or segment
+            offset: byte offset of the first object
+            count:  number of objects
+            stride: byte distance between objects, defaults to object size
+
+        Returns:
+            An OrderedDict mapping field names to lists of values.
+        """
+        if stride is None:
+            stride = cls._size_bytes
+        size = cls._size_bytes
+        data = image[offset:offset + stride * count]
+        return cls.columns_from_values([int.from_bytes(data[i:i + size], 'little')
+                                        for i in range(0, stride * count, stride)])
 
 
 def object_builder_factory(class_name, *fields):
@@ -63,6 +96,24 @@ def object_builder_factory(class_name, *fields):
                                                               'width': width })
                                   for (name, lsb, width) in fields },
                         bases = (ObjectBuilderBase,))
+
+    # Generate extraction functions with the shifts and masks as
+    # constants, so that decoding an object is a single from_bytes()
+    # and one expression per field.
+    c._field_layout = tuple((name, lsb, (1 << width) - 1)
+                            for (name, lsb, width) in fields)
+    c._field_names = tuple(name for (name, lsb, width) in fields)
+    c._size_bytes = (max(lsb + width for (name, lsb, width) in fields) + 7) // 8
+    exprs = ['(v >> %d) & 0x%x' % (lsb, mask) for (name, lsb, mask) in c._field_layout]
+    kwargs = ['%s = (v >> %d) & 0x%x' % field for field in c._field_layout]
+    src = ('def _extract(v):\n'
+           '    return (%s,)\n'
+           'def _from_int(v):\n'
+           '    return cls(%s)\n') % (', '.join(exprs), ', '.join(kwargs))
+    namespace = { 'cls': c }
+    exec(src, namespace)
+    c._extract = staticmethod(namespace['_extract'])
+    c._from_int = staticmethod(namespace['_from_int'])
     return c
 
 
@@ -182,42 +233,37 @@ InterconnectDescriptor = object_builder_factory('InterconnectDescriptor',
                                                 ('preserved_96',       96, 16))
 
 
-def parse_descriptor(image, offset):
-    v = image[offset]
-    descriptor = None
+def descriptor_class(v):
     if v & 3 == 3:
-        descriptor = StorageDescriptor()
+        return StorageDescriptor
     elif v & 3 == 2:
-        descriptor = RefinementDescriptor()
+        return RefinementDescriptor
     elif v & 3 == 1:
-        descriptor = TypeDescriptor()
-    elif v & 0x18 == 1:
-        descriptor = InterconnectDescriptor()
+        return TypeDescriptor
+    elif v & 0x18 == 0x08:
+        return InterconnectDescriptor
     elif v & 0x18 == 0:
         if v & 4 == 0:
-            descriptor = ObjectTableHeader()
+            return ObjectTableHeader
         else:
-            descriptor = FreeDescriptor()
-    if descriptor is None:
-        print('%06x: %02x' % (offset, v))
-        assert descriptor is not None
-    return descriptor.load_from_image(image, offset)
+            return FreeDescriptor
+    return None
 
 
-object_table = { }
+def parse_descriptor(image, offset):
+    v = int.from_bytes(image[offset:offset + 16], 'little')
+    cls = descriptor_class(v & 0xff)
+    if cls is None:
+        print('%06x: %02x' % (offset, v & 0xff))
+        assert cls is not None
+    return cls._from_int(v)
 
 
 class Segment:
-    _image = None
-    _segments = { }
-    _phys_mem_allocation = Allocation(1 << 24, "phys mem")
-
-    # Do not construct a Segment directly! Use the get_segment() method.
-    def __init__(self, image, base, length, coord, descriptor, temp = False, guard = False):
+    # Do not construct a Segment directly! Use ImageDecoder.get_segment().
+    def __init__(self, decoder, base, length, coord, descriptor, temp = False, guard = False):
         assert guard
-        if Segment._image is None:
-            assert image is not None
-            Segment._image = image
+        image = decoder.image
         self.base = base
         self.length = length
         self.descriptor = descriptor
@@ -228,48 +274,264 @@ class Segment:
         #assert self.ad_image.seg_index == coord.seg_index
         if (self.ad_image.dir_index != coord.dir_index or
             self.ad_image.seg_index != coord.seg_index):
-            print('ad image coords %d/%d don''t match expected coords %d/%d' % (self.ad_image.dir_index, self.ad_image.seg_index, coord.dir_index, coord.seg_index))
+            decoder.warning('ad image coords %d/%d don''t match expected coords %d/%d' % (self.ad_image.dir_index, self.ad_image.seg_index, coord.dir_index, coord.seg_index))
 
         l2 = length
         if l2 % 8 != 0:
             l2 += 8 - (l2 % 8)
 
-        # assert not Segment._phys_mem_allocation.is_available(base - 8, l2)
-        #Segment._phys_mem_allocation._dump()
-        if not Segment._phys_mem_allocation.is_available(base - 8, l2):
-            print ('segment overlap!')
-
-        print('segment %d/%d at %06x %06x..%06x' % (coord.dir_index, coord.seg_index, base-8, base, base+length-1))
+        decoder.print('segment %d/%d at %06x %06x..%06x' % (coord.dir_index, coord.seg_index, base-8, base, base+length-1))
         if not temp:
-            Segment._phys_mem_allocation.allocate(addr = base - 8,
-                                                  size = l2,
-                                                  data = self)
+            decoder.index.add_segment(coord, base - 8, base + l2)
         self.data = image[base:base+length]
 
+    def get_descriptor(self):
+        return self.descriptor
+        
+    def get_base_addr(self):
+        return self.base
+
+    def get_length(self):
+        return self.length
+
+    def get_ad_image(self):
+        return self.ad_image
+
+    def __getitem__(self, key):
+        return self.data.__getitem__(key)
+
+
+def map_image(f):
+    """
+    Memory-map an open image file read-only.  The mapping remains valid
+    after the file is closed, until there are no more references to it.
+
+    Returns:
+        A memoryview of the image.
+    """
+    # an empty file can't be mapped
+    if os.fstat(f.fileno()).st_size == 0:
+        return memoryview(b'')
+    return memoryview(mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ))
+
+
+class ImageIndex:
+    """
+    Index of the segments and object table entries of a decoded image,
+    answering which segment contains a physical address, which
+    segments overlap an address range, and what the descriptor for a
+    coordinate is.
+
+    Segments are kept in parallel lists sorted by physical address,
+    searched by bisection.  Each segment spans from its prefix to the
+    end of its contents, rounded up to a multiple of 8 bytes.
+    Coordinates are (dir_index, seg_index) tuples, and descriptors are
+    kept as their 128-bit values, so the index can be saved with
+    pickle independently of the descriptor classes.
+    """
+    version = 1
+
+    def __init__(self, image_hash = None):
+        self.image_hash = image_hash
+        self.bases = []       # physical address of segment prefix
+        self.limits = []      # physical address following segment
+        self.coords = []
+        self.descriptor_values = { }   # by coordinate
+        self.overlaps = []    # pairs of coordinates of overlapping segments
+        self._max_limits = []   # maximum of limits up to each position
+        self._position = { }    # position of segment in lists, by coordinate
+
+    def add_segment(self, coord, base, limit):
+        self.bases.append(base)
+        self.limits.append(limit)
+        self.coords.append((coord.dir_index, coord.seg_index))
+
+    def add_descriptor(self, dir_index, seg_index, value):
+        self.descriptor_values[(dir_index, seg_index)] = value
+
+    # Must be called after all segments are added.
+    def finish(self):
+        order = sorted(range(len(self.bases)),
+                       key = lambda i: (self.bases[i], self.limits[i]))
+        self.bases = [self.bases[i] for i in order]
+        self.limits = [self.limits[i] for i in order]
+        self.coords = [self.coords[i] for i in order]
+        self._index()
+        # each overlap is reported against the preceding segment that
+        # extends furthest
+        self.overlaps = []
+        max_limit = 0
+        owner = None
+        for base, limit, coord in zip(self.bases, self.limits, self.coords):
+            if base < max_limit:
+                self.overlaps.append((owner, coord))
+            if limit > max_limit:
+                max_limit = limit
+                owner = coord
+
+    def _index(self):
+        self._max_limits = []
+        max_limit = 0
+        for limit in self.limits:
+            max_limit = max(max_limit, limit)
+            self._max_limits.append(max_limit)
+        self._position = { coord: i for i, coord in enumerate(self.coords) }
+
+    def _segment(self, i):
+        return (self.coords[i], self.bases[i], self.limits[i])
+
+    def segment(self, coord):
+        """Returns (coord, base, limit) of the segment, or None."""
+        i = self._position.get(tuple(coord))
+        return None if i is None else self._segment(i)
+
+    def segment_at(self, addr):
+        """
+        Returns (coord, base, limit) of the segment containing the
+        physical address, or None.
+        """
+        i = bisect_right(self.bases, addr) - 1
+        while i >= 0 and self._max_limits[i] > addr:
+            if self.limits[i] > addr:
+                return self._segment(i)
+            i -= 1
+        return None
+
+    def segments_overlapping(self, start, end):
+        """
+        Returns a list of (coord, base, limit) of the segments
+        overlapping the physical address range from start up to end.
+        """
+        result = []
+        i = bisect_left(self.bases, end) - 1
+        while i >= 0 and self._max_limits[i] > start:
+            if self.limits[i] > start:
+                result.append(self._segment(i))
+            i -= 1
+        result.reverse()
+        return result
+
+    def descriptor(self, coord):
+        """Returns the descriptor for the coordinate, or None."""
+        v = self.descriptor_values.get(tuple(coord))
+        if v is None:
+            return None
+        return descriptor_class(v & 0xff)._from_int(v)
+
+    def missing_segments(self):
+        """
+        Returns a sorted list of the coordinates of the valid storage
+        descriptors that have no segment in the index.
+        """
+        result = []
+        for coord, v in self.descriptor_values.items():
+            cls = descriptor_class(v & 0xff)
+            if (cls is StorageDescriptor and cls._from_int(v).valid and
+                coord not in self._position):
+                result.append(coord)
+        return sorted(result)
+
+    def descriptor_address(self, coord):
+        """Returns the physical address of the descriptor, or None."""
+        table = self.segment((2, coord[0]))
+        if table is None or tuple(coord) not in self.descriptor_values:
+            return None
+        return table[1] + 8 + 16 * coord[1]
+
+    def save(self, fn):
+        state = { 'version':           self.version,
+                  'image_hash':        self.image_hash,
+                  'bases':             self.bases,
+                  'limits':            self.limits,
+                  'coords':            self.coords,
+                  'descriptor_values': self.descriptor_values,
+                  'overlaps':          self.overlaps }
+        temp_fn = '%s.%d.tmp' % (fn, os.getpid())
+        with open(temp_fn, 'wb') as f:
+            pickle.dump(state, f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_fn, fn)
+
     @classmethod
-    def get_segment(cls, coord, image = None, base = None, length = None):
-        global object_table
-        if coord in Segment._segments:
-            return Segment._segments[coord]
-        if (coord.dir_index in object_table and
-            coord.seg_index < len(object_table[coord.dir_index])):
-            assert image is None and base is None and length is None
-            descriptor = object_table[coord.dir_index][coord.seg_index]
+    def load(cls, fn, image_hash):
+        """
+        Load a saved index, if it exists and is for the image with the
+        specified hash.
+
+        Returns:
+            An ImageIndex, or None.
+        """
+        try:
+            with open(fn, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if (not isinstance(state, dict) or
+            state.get('version') != cls.version or
+            state.get('image_hash') != image_hash):
+            return None
+        index = cls(image_hash)
+        for name in ('bases', 'limits', 'coords', 'descriptor_values', 'overlaps'):
+            setattr(index, name, state[name])
+        index._index()
+        if index.missing_segments():
+            return None
+        return index
+
+
+def image_hash(image):
+    return hashlib.sha256(image).hexdigest()
+
+
+class ImageDecoder:
+    """
+    Decoder for a single image.  All of the state of decoding is kept
+    in the instance, so any number of images can be decoded, one after
+    another or concurrently.
+
+    Args:
+        image: bytes-like image, such as bytes, a memoryview or an mmap
+        out:   text file for the decoding listing, defaults to stdout
+
+    Segment prefixes, segment contents and object tables are memoryview
+    slices of the image, not copies.
+    """
+    def __init__(self, image, out = None):
+        self.image = memoryview(image)
+        self.out = sys.stdout if out is None else out
+        self.object_table = { }    # lists of descriptors by directory index
+        self.segments = { }        # by Coord
+        self.index = ImageIndex()
+        self.warnings = []
+
+    def print(self, *args):
+        print(*args, file = self.out)
+
+    def warning(self, msg):
+        self.warnings.append(msg)
+        self.print(msg)
+
+    def get_segment(self, coord, base = None, length = None):
+        if coord in self.segments:
+            return self.segments[coord]
+        if (coord.dir_index in self.object_table and
+            coord.seg_index < len(self.object_table[coord.dir_index])):
+            assert base is None and length is None
+            descriptor = self.object_table[coord.dir_index][coord.seg_index]
             assert isinstance(descriptor, StorageDescriptor)
             assert descriptor.valid
             assert descriptor.storage_associated
-            segment = Segment(Segment._image,
+            segment = Segment(self,
                               descriptor.segment_base,
                               descriptor.segment_length + 1,
                               coord,
                               descriptor,
                               guard = True)
-            Segment._segments[coord] = segment
+            self.segments[coord] = segment
             return segment
 
-        assert image is not None and base is not None and length is not None
+        assert base is not None and length is not None
         #print('making temp segment w/ incomplete information')
-        return Segment(image,
+        return Segment(self,
                        base,
                        length,
                        coord,
@@ -277,92 +539,230 @@ class Segment:
                        temp = True,
                        guard = True)
 
-    def get_descriptor(self):
-        return self.descriptor
-        
-    def get_base_addr(self):
-        return self.base_addr
-
-    def get_length(self):
-        return self.length
-
-    def get_ad_image(self):
-        return self.ad_image
-
-    def __getitem__(self, key):
-        return self.data.__getitem__(key)
-
-
-def parse_object_table(coord, ot_segment = None):
-    if ot_segment is None:
-        ot_segment = Segment.get_segment(coord)
-    offset = 0
-
-    header = parse_descriptor(ot_segment, offset)
-    assert isinstance(header, ObjectTableHeader)
-    table = [header]
-    #print('object table header', header)
-
-    index = 1
-    while (index * 16) < ot_segment.get_length():
-        descriptor = parse_descriptor(ot_segment, index * 16)
+    def parse_object_table(self, coord, ot_segment = None):
+        if ot_segment is None:
+            ot_segment = self.get_segment(coord)
+        offset = 0
+
+        header = parse_descriptor(ot_segment, offset)
+        assert isinstance(header, ObjectTableHeader)
+        table = [header]
+        #print('object table header', header)
+
+        # read all entries from a single copy of the object table
+        count = (ot_segment.get_length() + 15) // 16
+        data = ot_segment[0:count * 16]
+        values = [int.from_bytes(data[i:i + 16], 'little')
+                  for i in range(0, count * 16, 16)]
+        for index, v in enumerate(values):
+            self.index.add_descriptor(coord.seg_index, index, v)
+
+        # group the entries by descriptor class, and decode each group
+        # as columns
+        groups = OrderedDict()
+        for index in range(1, count):
+            cls = descriptor_class(values[index] & 0xff)
+            if cls is None:
+                self.print('%06x: %02x' % (index * 16, values[index] & 0xff))
+                assert cls is not None
+            groups.setdefault(cls, []).append(index)
+        table.extend([None] * (count - 1))
+        for cls, indices in groups.items():
+            columns = cls.columns_from_values([values[i] for i in indices])
+            for index, fields in zip(indices, zip(*columns.values())):
+                table[index] = cls(*fields)
         if coord == Coord(2, 2):
-            assert (isinstance(descriptor, StorageDescriptor) or
-                    isinstance(descriptor, FreeDescriptor))
-        table.append(descriptor)
-        index += 1
-
-    # XXX validate free descriptor chain
-
-    return table
-
-
-def parse_object_table_hierarchy(image):
-    global object_table
-
-    print('parsing object table directory')
-    otd_descriptor = parse_descriptor(image, 8 + 32)
-    assert isinstance(otd_descriptor, StorageDescriptor)
-    otd_segment = Segment.get_segment(Coord(2, 2),
-                                      image,
-                                      otd_descriptor.segment_base,
-                                      otd_descriptor.segment_length + 1)
-    otd = parse_object_table(Coord(2, 2), ot_segment = otd_segment)
-    object_table[2] = otd
-    
-    # validate that descriptor points to object table directory
-    assert otd[2].segment_base == 8
-
-    for index in range(1, len(otd)):
-        ot_descriptor = otd[index]
-        if index > 2 and isinstance(ot_descriptor, FreeDescriptor):
-            continue
-        print('parsing object table %d' % index)
-        assert isinstance(ot_descriptor, StorageDescriptor)
-        object_table[index] = parse_object_table(Coord(2, index))
-        #if index == 1:
-        #   check that object table only contains processor access segments and free descriptors
-        #elif index == 2:
-        #   check that object table only contains object table data segments and free descriptors
-        #else:
-        #   check that object table contains no processor access segments or object table data segments
-
-
-def parse_image(image):
-    parse_object_table_hierarchy(image)
-
-    for dir_index in range(1, len(object_table)):
-        for seg_index in range(1, len(object_table[dir_index])):
-            descriptor = object_table[dir_index][seg_index]
-            if isinstance(descriptor, StorageDescriptor):
-                seg = Segment.get_segment(Coord(dir_index, seg_index))
+            assert all(isinstance(descriptor, (StorageDescriptor, FreeDescriptor))
+                       for descriptor in table[1:])
+
+        # XXX validate free descriptor chain
+
+        return table
+
+    def parse_object_table_hierarchy(self):
+        self.print('parsing object table directory')
+        if len(self.image) < 8 + 32 + 16:
+            raise DecodeError('image of %d bytes is too short for an object table directory descriptor' % len(self.image))
+        otd_descriptor = parse_descriptor(self.image, 8 + 32)
+        assert isinstance(otd_descriptor, StorageDescriptor)
+        otd_segment = self.get_segment(Coord(2, 2),
+                                       otd_descriptor.segment_base,
+                                       otd_descriptor.segment_length + 1)
+        otd = self.parse_object_table(Coord(2, 2), ot_segment = otd_segment)
+        self.object_table[2] = otd
+
+        # validate that descriptor points to object table directory
+        assert otd[2].segment_base == 8
+
+        for index in range(1, len(otd)):
+            ot_descriptor = otd[index]
+            if index > 2 and isinstance(ot_descriptor, FreeDescriptor):
+                continue
+            self.print('parsing object table %d' % index)
+            assert isinstance(ot_descriptor, StorageDescriptor)
+            self.object_table[index] = self.parse_object_table(Coord(2, index))
+            #if index == 1:
+            #   check that object table only contains processor access segments and free descriptors
+            #elif index == 2:
+            #   check that object table only contains object table data segments and free descriptors
+            #else:
+            #   check that object table contains no processor access segments or object table data segments
+
+    def parse_image(self):
+        self.parse_object_table_hierarchy()
+
+        # the segments of the object table directory, which are the
+        # object tables, have already been decoded
+        for dir_index in sorted(self.object_table):
+            if dir_index == 2:
+                continue
+            for seg_index in range(1, len(self.object_table[dir_index])):
+                descriptor = self.object_table[dir_index][seg_index]
+                if isinstance(descriptor, StorageDescriptor):
+                    seg = self.get_segment(Coord(dir_index, seg_index))
+                else:
+                    self.print('object  %d/%d is' % (dir_index, seg_index), type(descriptor).__name__)
+
+        self.index.finish()
+        missing = self.index.missing_segments()
+        if missing:
+            raise DecodeError('storage descriptors not decoded: %s' %
+                              ' '.join('%d/%d' % coord for coord in missing))
+        for a, b in self.index.overlaps:
+            self.warning('segment %d/%d overlaps segment %d/%d' % (b + a))
+
+    #    offset = 0
+    #    while offset < len(image):
+    #        l = parse_segment(image, offset)
+    #        offset += l
+
+    def instruction_segments(self, arch):
+        instruction_type = arch.get_enumeration_value('system_type', 'instruction')['value']
+        for coord in sorted(self.segments, key = lambda c: (c.dir_index, c.seg_index)):
+            segment = self.segments[coord]
+            descriptor = segment.get_descriptor()
+            if descriptor.base_type == 0 and descriptor.system_type == instruction_type:
+                yield coord, segment
+
+    def disassemble_instruction_segments(self, arch):
+        disassembler = Disassembler(arch)
+        for coord, segment in self.instruction_segments(arch):
+            self.print('instruction segment %d/%d:' % (coord.dir_index, coord.seg_index))
+            try:
+                print_listing(disassembler.disassemble(segment.data), self.out)
+            except DecodeError as e:
+                self.warning(str(e))
+
+
+def format_segment(segment):
+    coord, base, limit = segment
+    return 'segment %d/%d at %06x..%06x' % (coord[0], coord[1], base, limit - 1)
+
+
+def run_query(index, query, f = None):
+    """
+    Answer a query against an ImageIndex, printing the result.  A query
+    is one of:
+        ADDR        the segment containing a physical address
+        START-END   the segments overlapping a physical address range
+        D/S         the descriptor and segment of a coordinate
+        overlaps    all overlapping segments
+
+    Raises:
+        ValueError: the query is invalid
+    """
+    if query == 'overlaps':
+        for a, b in index.overlaps:
+            print('%s overlaps %s' % (format_segment(index.segment(b)),
+                                      format_segment(index.segment(a))), file = f)
+        if not index.overlaps:
+            print('no overlapping segments', file = f)
+    elif '/' in query:
+        d, s = query.split('/')
+        coord = (int(d, 0), int(s, 0))
+        descriptor = index.descriptor(coord)
+        if descriptor is None:
+            print('%d/%d: no descriptor' % coord, file = f)
+            return
+        print('%d/%d: descriptor at %06x: %s' % (coord + (index.descriptor_address(coord), descriptor)), file = f)
+        segment = index.segment(coord)
+        if segment is not None:
+            print('%d/%d: %s' % (coord + (format_segment(segment),)), file = f)
+    elif '-' in query:
+        start, end = (int(v, 0) for v in query.split('-'))
+        segments = index.segments_overlapping(start, end + 1)
+        for segment in segments:
+            print('%06x-%06x: %s' % (start, end, format_segment(segment)), file = f)
+        if not segments:
+            print('%06x-%06x: no segments' % (start, end), file = f)
+    else:
+        addr = int(query, 0)
+        segment = index.segment_at(addr)
+        if segment is None:
+            print('%06x: no segment' % addr, file = f)
+        else:
+            offset = addr - segment[1] - 8
+            if offset < 0:
+                print('%06x: %s, prefix' % (addr, format_segment(segment)), file = f)
             else:
-                print('object  %d/%d is' % (dir_index, seg_index), type(descriptor).__name__)
-            
-#    offset = 0
-#    while offset < len(image):
-#        l = parse_segment(image, offset)
-#        offset += l
+                print('%06x: %s, offset %d' % (addr, format_segment(segment), offset), file = f)
+
+
+# Batch decoding.  Each worker process loads the architecture
+# definition once, in _init_worker().
+
+_worker_arch = None
+
+def _init_worker(arch):
+    global _worker_arch
+    _worker_arch = arch
+
+
+def decode_file(path, disassemble = False, log_dir = None):
+    """
+    Decode an image file, writing the listing to a file in log_dir, if
+    specified.
+
+    Returns:
+        A dict summarizing the result.
+    """
+    out = io.StringIO()
+    result = { 'path': path }
+    decoder = None
+    try:
+        with open(path, 'rb') as f:
+            image = map_image(f)
+        decoder = ImageDecoder(image, out)
+        decoder.parse_image()
+        if disassemble:
+            decoder.disassemble_instruction_segments(_worker_arch)
+        result['ok'] = True
+    except Exception as e:
+        out.write('%s\n' % traceback.format_exc())
+        result['ok'] = False
+        result['error'] = traceback.format_exception_only(type(e), e)[-1].strip()
+    if decoder is not None:
+        result['segments'] = len(decoder.segments)
+        result['warnings'] = len(decoder.warnings)
+    if log_dir is not None:
+        with open(os.path.join(log_dir, os.path.basename(path) + '.txt'), 'w') as f:
+            f.write(out.getvalue())
+    return result
+
+
+def decode_batch(paths, arch, jobs = None, disassemble = False, log_dir = None):
+    """
+    Decode image files across a pool of worker processes, yielding a
+    result dict for each, in the order of paths.
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers = jobs,
+                                                initializer = _init_worker,
+                                                initargs = (arch,)) as executor:
+        futures = [executor.submit(decode_file, path, disassemble, log_dir)
+                   for path in paths]
+        for future in futures:
+            yield future.result()
+
 
 if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser(description='iAPX 432 Image Decoder')
@@ -372,16 +772,80 @@ if __name__ == '__main__':
                             help='architecture definition (XML)')
     arg_parser.add_argument('image_binary',
                             type=argparse.FileType('rb'),
-                            nargs=1,
+                            nargs='?',
                             help='image binary input')
+    arg_parser.add_argument('--disassemble',
+                            action='store_true',
+                            help='disassemble instruction segments')
+    arg_parser.add_argument('--batch',
+                            metavar='DIR',
+                            help='decode all image binaries in DIR in parallel, reporting a summary of each')
+    arg_parser.add_argument('--pattern',
+                            default='*.bin',
+                            help='batch: file name pattern of image binaries (default *.bin)')
+    arg_parser.add_argument('-j', '--jobs',
+                            type=int,
+                            help='batch: number of worker processes (default number of CPUs)')
+    arg_parser.add_argument('--log-dir',
+                            help='batch: write the listing of each image to LOG_DIR/<image>.txt')
+    arg_parser.add_argument('-q', '--query',
+                            action='append',
+                            help='query the segment and descriptor index instead of listing the image, may be repeated: ADDR, START-END, D/S, or overlaps')
+    arg_parser.add_argument('--index',
+                            metavar='INDEX_FILE',
+                            help='save the index to INDEX_FILE, or use it if it matches the image, rather than decoding the image again')
+
+    add_arch_cache_arguments(arg_parser)
 
     args = arg_parser.parse_args()
 
-    arch_tree = xml.etree.ElementTree.parse(args.arch)
-    args.arch.close()
-    arch = Arch(arch_tree)
-
-    image = args.image_binary[0].read()
-    args.image_binary[0].close()
-
-    parse_image(image)
+    if (args.image_binary is None) == (args.batch is None):
+        arg_parser.error('exactly one of an image binary or --batch is required')
+
+    arch = load_arch_from_args(args)
+
+    if args.batch is not None:
+        paths = sorted(os.path.join(args.batch, fn)
+                       for fn in os.listdir(args.batch)
+                       if fnmatch.fnmatch(fn, args.pattern))
+        if args.log_dir is not None:
+            os.makedirs(args.log_dir, exist_ok = True)
+        failed = 0
+        for result in decode_batch(paths, arch,
+                                   jobs = args.jobs,
+                                   disassemble = args.disassemble,
+                                   log_dir = args.log_dir):
+            if result['ok']:
+                print('%s: ok, %d segments, %d warnings' % (result['path'], result['segments'], result['warnings']))
+            else:
+                failed += 1
+                print('%s: FAILED: %s' % (result['path'], result['error']))
+        print('%d images, %d failed' % (len(paths), failed))
+        sys.exit(1 if failed else 0)
+
+    image = map_image(args.image_binary)
+    args.image_binary.close()
+
+    index = None
+    if args.index is not None:
+        h = image_hash(image)
+        index = ImageIndex.load(args.index, h)
+
+    if index is None or args.disassemble or not args.query:
+        # with queries, the listing of the object tables and segments
+        # isn't printed, but the disassembly is
+        decoder = ImageDecoder(image, io.StringIO() if args.query else None)
+        decoder.parse_image()
+        index = decoder.index
+        if args.index is not None:
+            index.image_hash = h
+            index.save(args.index)
+        if args.disassemble:
+            decoder.out = sys.stdout
+            decoder.disassemble_instruction_segments(arch)
+
+    for query in args.query or []:
+        try:
+            run_query(index, query)
+        except ValueError:
+            arg_parser.error('invalid query %s' % query)
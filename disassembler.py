@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+# Intel iAPX 432 GDP instruction disassembler
+
+# Copyright 2014, 2015, 2016, 2017 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# GDP instructions are bit-aligned, and all fields are consumed LSB
+# first.  An instruction consists of:
+#
+#   class         selects the number and lengths of operands, and
+#                 whether there is a branch reference
+#   format        selects whether each operand is an explicit data
+#                 reference or on the operand stack (absent for order 0)
+#   references    explicit data references, then the branch reference
+#   opcode        selects the operator within the class (may be empty)
+#
+# The layout of data references follows the data_reference struct of
+# the architecture definition:
+#
+#   control       displacement control (2 bits), segment control (2 bits),
+#                 long displacement (1 bit, omitted for dynamic vector
+#                 element references)
+#   segment       short direct:   6 bit short object selector
+#                 long direct:   16 bit object selector
+#                 indirect:      general indirect reference
+#   displacement  depends on displacement control
+#
+# The definitions file assigns the same segment control encoding to
+# both operand stack indirect and general indirect; segment control 0b10
+# is treated as general indirect, and the otherwise unused 0b11 as
+# operand stack indirect.
+
+import argparse
+import collections
+import weakref
+
+from archtables import (Class, Format, Operator, SizedValue,
+                        add_arch_cache_arguments, load_tables_py,
+                        update_tables_py)
+
+
+class DecodeError(Exception):
+    pass
+
+
+DirectSelector = collections.namedtuple('DirectSelector', ['long',
+                                                           'eas',
+                                                           'slot'])
+
+IndirectReference = collections.namedtuple('IndirectReference', ['type',       # 'operand_stack', 'intrasegment', 'general'
+                                                                 'long_selector',
+                                                                 'selector',   # DirectSelector, general only
+                                                                 'long_displacement',
+                                                                 'displacement'])
+
+DataReference = collections.namedtuple('DataReference', ['displacement_type',
+                                                         'long_displacement',
+                                                         'segment',   # DirectSelector or IndirectReference
+                                                         'displacement',  # scalar only
+                                                         'base',
+                                                         'index'])
+
+BranchReference = collections.namedtuple('BranchReference', ['absolute',
+                                                             'value'])
+
+Instruction = collections.namedtuple('Instruction', ['offset',      # bit offset in segment
+                                                     'size_bits',
+                                                     'operator',
+                                                     'clas',
+                                                     'format',
+                                                     'refs',        # explicit data references
+                                                     'branch_ref'])
+Instruction.branch_target = property(lambda self: branch_target(self))
+
+
+displacement_types = ('scalar',
+                      'record_item',
+                      'static_vector_element',
+                      'dynamic_vector_element')
+
+segment_control_short_direct   = 0
+segment_control_long_direct    = 1
+segment_control_general        = 2
+segment_control_operand_stack  = 3
+
+relative_branch_bits = 10
+absolute_branch_bits = 16
+
+# Largest possible instruction is well under this, so one window read
+# from the segment covers any single instruction.
+window_bytes = 64
+
+
+def branch_target(insn):
+    if insn.branch_ref is None:
+        return None
+    if insn.branch_ref.absolute:
+        return insn.branch_ref.value
+    return insn.offset + insn.branch_ref.value
+
+
+def instruction_start_bits(arch):
+    s = arch.symbols['instruction_data_segment'].value
+    return s.field_by_name['instructions'].offset_bits
+
+
+# Dense lookup tables are precomputed once per Arch, and are indexed by
+# the next bits of the instruction stream.  Each table entry is a tuple
+# of the encoding length and the associated item.
+class DecodeTables(object):
+    def _expand(self, d):
+        bits = self.arch.max_encoding_len(d)
+        if bits == 0:
+            return 0, [(0, v) for v in d.values()]
+        table = [(v.encoding.size_bits, v) for v in self.arch.expand_encoding_dict(d)]
+        return bits, table
+
+    def __init__(self, arch):
+        self.arch = arch
+        self.class_bits, self.class_table = self._expand(arch.class_by_encoding)
+
+        self.format_bits = []
+        self.format_table = []
+        for order in range(4):
+            bits, table = self._expand(arch.format_by_order_encoding[order])
+            self.format_bits.append(bits)
+            self.format_table.append(table)
+
+        # per-class opcode tables, indexed by id() of the class, since
+        # Arch.Class namedtuples contain a dict and aren't hashable
+        self.opcode_bits = { }
+        self.opcode_table = { }
+        for clas in arch.class_by_encoding.values():
+            bits, table = self._expand(clas.operators)
+            self.opcode_bits[id(clas)] = bits
+            self.opcode_table[id(clas)] = table
+
+        # For each format, the index of the explicit data reference
+        # supplying each operand, or None for operands on the stack, and
+        # the number of explicit data references.
+        self.format_refs = { }
+        for order in range(4):
+            for f in arch.format_by_order_encoding[order].values():
+                self.format_refs[id(f)] = self.parse_format(f)
+
+        self.start_bits = instruction_start_bits(arch)
+
+    @classmethod
+    def from_module(cls, m):
+        """
+        Construct DecodeTables from a decoding tables module written by
+        arch.gen_tables_py(), without an Arch.  The classes, formats and
+        operators are the same namedtuple types as those of an Arch.
+        """
+        self = cls.__new__(cls)
+        self.arch = None
+        classes = [Class(SizedValue(bits, value), reserved, list(refs), branch_ref, { })
+                   for bits, value, reserved, refs, branch_ref in m.classes]
+        formats = [Format(SizedValue(bits, value), list(operands))
+                   for order, bits, value, operands in m.formats]
+        operators = []
+        for operator_id, names, clas, bits, value, modes in m.operators:
+            operator = Operator(list(names), operator_id, classes[clas], SizedValue(bits, value), modes)
+            classes[clas].operators[operator.encoding] = operator
+            operators.append(operator)
+
+        def expand(items, table):
+            return [(items[i].encoding.size_bits, items[i]) for i in table]
+
+        self.class_bits = m.class_bits
+        self.class_table = expand(classes, m.class_table)
+        self.format_bits = list(m.format_bits)
+        self.format_table = [expand(formats, t) for t in m.format_tables]
+        self.opcode_bits = { }
+        self.opcode_table = { }
+        for clas, bits, t in zip(classes, m.opcode_bits, m.opcode_tables):
+            self.opcode_bits[id(clas)] = bits
+            self.opcode_table[id(clas)] = expand(operators, t)
+        self.format_refs = { id(f): self.parse_format(f) for f in formats }
+        self.start_bits = m.instruction_start_bits
+        # keep the classes and formats alive, since the tables are keyed
+        # by their ids
+        self.classes = classes
+        self.formats = formats
+        return self
+
+    @staticmethod
+    def parse_format(f):
+        operand_refs = []
+        ref_count = 0
+        for operand in f.operands:
+            if operand.startswith('dref'):
+                i = int(operand[4:]) - 1
+                operand_refs.append(i)
+                ref_count = max(ref_count, i + 1)
+            else:
+                operand_refs.append(None)
+        return tuple(operand_refs), ref_count
+
+
+_tables_by_arch = weakref.WeakKeyDictionary()
+
+def get_decode_tables(arch):
+    tables = _tables_by_arch.get(arch)
+    if tables is None:
+        tables = DecodeTables(arch)
+        _tables_by_arch[arch] = tables
+    return tables
+
+
+class Disassembler(object):
+    def __init__(self, arch, tables = None):
+        self.arch = arch
+        self.tables = get_decode_tables(arch) if tables is None else tables
+
+    def _direct_selector(self, w, o, long):
+        if long:
+            sel = (w >> o) & 0xffff
+            o += 16
+        else:
+            sel = (w >> o) & 0x3f
+            o += 6
+        return DirectSelector(long, sel & 3, sel >> 2), o
+
+    def _general_indirect(self, w, o):
+        long_selector = (w >> o) & 1
+        long_displacement = (w >> (o + 1)) & 1
+        o += 2
+        selector, o = self._direct_selector(w, o, long_selector)
+        disp_bits = 16 if long_displacement else 7
+        displacement = (w >> o) & ((1 << disp_bits) - 1)
+        o += disp_bits
+        return IndirectReference('general', bool(long_selector), selector,
+                                 bool(long_displacement), displacement), o
+
+    def _indirect_reference(self, w, o):
+        if (w >> o) & 1:
+            return IndirectReference('operand_stack', False, None, False, None), o + 1
+        if (w >> (o + 1)) & 1:
+            o += 2
+            long_displacement = (w >> o) & 1
+            o += 1
+            disp_bits = 16 if long_displacement else 7
+            displacement = (w >> o) & ((1 << disp_bits) - 1)
+            return IndirectReference('intrasegment', False, None,
+                                     bool(long_displacement), displacement), o + disp_bits
+        return self._general_indirect(w, o + 2)
+
+    def _data_reference(self, w, o):
+        displacement_type = (w >> o) & 3
+        segment_control = (w >> (o + 2)) & 3
+        o += 4
+        if displacement_type == 3:
+            long_displacement = False
+        else:
+            long_displacement = bool((w >> o) & 1)
+            o += 1
+
+        if segment_control == segment_control_short_direct:
+            segment, o = self._direct_selector(w, o, False)
+        elif segment_control == segment_control_long_direct:
+            segment, o = self._direct_selector(w, o, True)
+        elif segment_control == segment_control_general:
+            segment, o = self._general_indirect(w, o)
+        else:
+            segment = IndirectReference('operand_stack', False, None, False, None)
+
+        disp_bits = 16 if long_displacement else 7
+        displacement = None
+        base = None
+        index = None
+        if displacement_type == 0:    # scalar
+            displacement = (w >> o) & ((1 << disp_bits) - 1)
+            o += disp_bits
+        elif displacement_type == 1:  # record item
+            index = (w >> o) & ((1 << disp_bits) - 1)
+            o += disp_bits
+            base, o = self._indirect_reference(w, o)
+        elif displacement_type == 2:  # static vector element
+            if long_displacement:
+                base = (w >> o) & 0xffff
+                o += 16
+            else:
+                base = 0
+            index, o = self._indirect_reference(w, o)
+        else:                         # dynamic vector element
+            base, o = self._indirect_reference(w, o)
+            index, o = self._indirect_reference(w, o)
+
+        return DataReference(displacement_types[displacement_type],
+                             long_displacement, segment, displacement,
+                             base, index), o
+
+    def decode(self, data, offset, limit = None):
+        """
+        Decode a single instruction.
+
+        Args:
+            data:   bytes-like instruction segment contents
+            offset: bit offset of the instruction within data
+            limit:  bit offset of the end of valid data, defaults to
+                    the end of data
+
+        Returns:
+            An Instruction.
+
+        Raises:
+            DecodeError
+        """
+        if limit is None:
+            limit = len(data) * 8
+        t = self.tables
+        byte_offset = offset >> 3
+        w = int.from_bytes(data[byte_offset:byte_offset + window_bytes], 'little') >> (offset & 7)
+
+        size_bits, clas = t.class_table[w & ((1 << t.class_bits) - 1)]
+        if clas.reserved:
+            raise DecodeError('reserved instruction class %s at bit offset %d' % (str(clas.encoding), offset))
+        o = size_bits
+
+        order = len(clas.refs)
+        size_bits, fmt = t.format_table[order][(w >> o) & ((1 << t.format_bits[order]) - 1)]
+        o += size_bits
+
+        refs = []
+        for i in range(t.format_refs[id(fmt)][1]):
+            ref, o = self._data_reference(w, o)
+            refs.append(ref)
+
+        branch_ref = None
+        if clas.branch_ref:
+            absolute = (w >> o) & 1
+            o += 1
+            if absolute:
+                branch_ref = BranchReference(True, (w >> o) & ((1 << absolute_branch_bits) - 1))
+                o += absolute_branch_bits
+            else:
+                v = (w >> o) & ((1 << relative_branch_bits) - 1)
+                if v & (1 << (relative_branch_bits - 1)):
+                    v -= 1 << relative_branch_bits
+                branch_ref = BranchReference(False, v)
+                o += relative_branch_bits
+
+        opcode_bits = t.opcode_bits[id(clas)]
+        size_bits, operator = t.opcode_table[id(clas)][(w >> o) & ((1 << opcode_bits) - 1)]
+        o += size_bits
+
+        if offset + o > limit:
+            raise DecodeError('instruction at bit offset %d extends past end of segment' % offset)
+
+        return Instruction(offset, o, operator, clas, fmt, refs, branch_ref)
+
+    def disassemble(self, data, offset = None, limit = None):
+        """
+        Decode all instructions in an instruction segment. Decoding
+        stops at the last nonzero bit of the segment, since the segment
+        is padded with zeros.
+
+        Args:
+            data:   bytes-like instruction segment contents
+            offset: bit offset of first instruction, defaults to the
+                    offset of the instructions field of an instruction
+                    data segment
+            limit:  bit offset at which to stop
+
+        Returns:
+            A list of Instructions.
+        """
+        if offset is None:
+            offset = self.tables.start_bits
+        end = int.from_bytes(data, 'little').bit_length()
+        if limit is None:
+            limit = len(data) * 8
+        else:
+            end = min(end, limit)
+        instructions = []
+        decode = self.decode
+        while offset < end:
+            insn = decode(data, offset, limit)
+            instructions.append(insn)
+            offset += insn.size_bits
+        return instructions
+
+
+def format_selector(sel):
+    return 'eas%d.%d' % (sel.eas, sel.slot)
+
+def format_indirect(ind):
+    if ind.type == 'operand_stack':
+        return 'stk'
+    if ind.type == 'intrasegment':
+        return '[%d]' % ind.displacement
+    return '[%s+%d]' % (format_selector(ind.selector), ind.displacement)
+
+def format_data_reference(ref):
+    if isinstance(ref.segment, DirectSelector):
+        s = format_selector(ref.segment)
+    else:
+        s = format_indirect(ref.segment)
+    if ref.displacement_type == 'scalar':
+        return '%s+%d' % (s, ref.displacement)
+    if ref.displacement_type == 'record_item':
+        return '%s+%s+%d' % (s, format_indirect(ref.base), ref.index)
+    if ref.displacement_type == 'static_vector_element':
+        return '%s+%d[%s]' % (s, ref.base, format_indirect(ref.index))
+    return '%s+%s[%s]' % (s, format_indirect(ref.base), format_indirect(ref.index))
+
+def format_instruction(insn):
+    operands = []
+    for operand in insn.format.operands:
+        if operand.startswith('dref'):
+            operands.append(format_data_reference(insn.refs[int(operand[4:]) - 1]))
+        else:
+            operands.append(operand)
+    if insn.branch_ref is not None:
+        operands.append('%d' % insn.branch_target)
+    s = insn.operator.names[0]
+    if operands:
+        s += ' ' + ', '.join(operands)
+    return s
+
+
+def print_listing(instructions, f = None):
+    for insn in instructions:
+        print('%5d: %s' % (insn.offset, format_instruction(insn)), file = f)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='iAPX 432 Instruction Disassembler')
+    arg_parser.add_argument('-a', '--arch',
+                            type=argparse.FileType('r'),
+                            default='iapx432-1.0.xml',
+                            help='architecture definition (XML)')
+    arg_parser.add_argument('--offset',
+                            type=int,
+                            help='bit offset of first instruction (default: per instruction data segment)')
+    arg_parser.add_argument('segment_binary',
+                            type=argparse.FileType('rb'),
+                            nargs=1,
+                            help='instruction segment binary input')
+    arg_parser.add_argument('--tables',
+                            metavar='TABLES_PY',
+                            help='use a decoding tables module generated by arch.py, regenerating it if it isn\'t current')
+    add_arch_cache_arguments(arg_parser)
+
+    args = arg_parser.parse_args()
+
+    if args.tables is not None:
+        args.arch.close()
+        update_tables_py(args.arch.name, args.tables,
+                         cache_dir = args.arch_cache_dir,
+                         use_cache = not args.no_arch_cache)
+        disassembler = Disassembler(None, DecodeTables.from_module(load_tables_py(args.tables)))
+    else:
+        # only import arch.py when constructing an Arch
+        from arch import load_arch_from_args
+        disassembler = Disassembler(load_arch_from_args(args))
+
+    data = args.segment_binary[0].read()
+    args.segment_binary[0].close()
+
+    print_listing(disassembler.disassemble(data, offset = args.offset))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# Synthetic image definition generator for Intel iAPX 432 image builder
+# benchmarks
+
+# Copyright 2014, 2015, 2016, 2017 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The generated image consists of the objects of a base image
+# definition, normally image.xml, which provides the system objects,
+# plus a number of synthetic object tables, each containing a number of
+# generic access segments, generic data segments and instruction
+# segments. Every synthetic segment is referenced by an AD in an
+# earlier synthetic access segment, and the first synthetic access
+# segment is referenced from an access segment of the base image, so
+# all synthetic segments are reachable. Additional ADs to randomly
+# chosen synthetic segments give the requested AD density.
+
+import argparse
+import random
+import xml.etree.ElementTree as ET
+
+
+max_table_entries = 4095   # entry 0 of an object table is the header
+
+# access segment of the base image from which the synthetic segments
+# are reachable
+default_root = 'process_1_global_access_segment'
+
+
+class ImageGenParams(object):
+    def __init__(self,
+                 object_tables = 1,
+                 segments_per_table = 100,
+                 access_fraction = 0.25,
+                 code_fraction = 0.1,
+                 ad_density = 2.0,
+                 data_fields = 4,
+                 code_instructions = 8,
+                 seed = 0):
+        assert object_tables >= 1
+        assert 1 <= segments_per_table <= max_table_entries
+        self.object_tables = object_tables
+        self.segments_per_table = segments_per_table
+        self.access_fraction = access_fraction   # fraction of segments that are access segments
+        self.code_fraction = code_fraction       # fraction of segments that are instruction segments
+        self.ad_density = ad_density             # mean additional ADs per access segment
+        self.data_fields = data_fields           # fields per generic data segment
+        self.code_instructions = code_instructions   # instructions per instruction segment
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(vars(self))
+
+    @staticmethod
+    def add_arguments(parser):
+        defaults = ImageGenParams()
+        for name, value in vars(defaults).items():
+            parser.add_argument('--' + name.replace('_', '-'),
+                                type = type(value),
+                                default = value,
+                                help = 'default %s' % value)
+
+    @staticmethod
+    def from_args(args):
+        return ImageGenParams(**{ name: getattr(args, name)
+                                  for name in vars(ImageGenParams()) })
+
+
+def _segment(parent, name, seg_type, object_table = None):
+    seg = ET.SubElement(parent, 'segment', name = name, type = seg_type)
+    if object_table is not None:
+        seg.set('object_table', object_table)
+    return seg
+
+
+def _instruction_segment(seg, params):
+    for name, value in (('context_access_segment_length', '12'),
+                        ('context_data_segment_length',   '8'),
+                        ('operand_stack_segment_length',  '32'),
+                        ('initial_instruction_displacement', 'start'),
+                        ('data_constants_segment_index',  '1')):
+        ET.SubElement(seg, 'field', name = name, value = value)
+    code = ET.SubElement(seg, 'code')
+    ET.SubElement(code, 'label', name = 'start')
+    for i in range(params.code_instructions):
+        instruction = ET.SubElement(code, 'instruction', op = 'branch', format = 'br')
+        ET.SubElement(instruction, 'bref', target = 'start')
+
+
+def _data_segment(seg, params, rng):
+    types = (('ordinal', 32), ('short_ordinal', 16), ('character', 8))
+    for i in range(params.data_fields):
+        field_type, bits = rng.choice(types)
+        ET.SubElement(seg, 'field',
+                      name = 'f%d' % i,
+                      type = field_type,
+                      value = '0x%x' % rng.getrandbits(bits))
+
+
+def generate(base_tree, params, root = default_root):
+    """
+    Return an ElementTree of an image definition consisting of the
+    objects of base_tree plus synthetic objects as specified by params.
+    """
+    rng = random.Random(params.seed)
+    image_root = base_tree.getroot()
+    assert image_root.tag == 'image'
+
+    root_segment = None
+    for elem in image_root:
+        if elem.get('name') == root:
+            root_segment = elem
+    assert root_segment is not None, 'root access segment %s not found' % root
+
+    names = []            # all synthetic segments
+    access_segments = []  # synthetic access segment elements
+    for t in range(params.object_tables):
+        table = 'synth_%d_object_table' % t
+        _segment(image_root, table, 'object_table_data_segment')
+        for s in range(params.segments_per_table):
+            name = 'synth_%d_%d' % (t, s)
+            # make the segment reachable from an earlier access segment
+            if names:
+                ET.SubElement(rng.choice(access_segments), 'ad', segment = name)
+            r = rng.random()
+            if not access_segments or r < params.access_fraction:
+                seg = _segment(image_root, name, 'generic_access_segment', table)
+                access_segments.append(seg)
+            elif r < params.access_fraction + params.code_fraction:
+                seg = _segment(image_root, name, 'instruction_data_segment', table)
+                _instruction_segment(seg, params)
+            else:
+                seg = _segment(image_root, name, 'generic_data_segment', table)
+                _data_segment(seg, params, rng)
+            names.append(name)
+
+    ET.SubElement(root_segment, 'ad', segment = names[0])
+
+    extra_ads = int(params.ad_density * len(access_segments))
+    for i in range(extra_ads):
+        ET.SubElement(rng.choice(access_segments), 'ad', segment = rng.choice(names))
+
+    return base_tree
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'iAPX 432 synthetic image definition generator')
+    parser.add_argument('-b', '--base',
+                        type = argparse.FileType('r'),
+                        default = 'image.xml',
+                        help = 'base image definition (XML)')
+    parser.add_argument('--root',
+                        default = default_root,
+                        help = 'access segment of base image from which synthetic segments are reachable')
+    ImageGenParams.add_arguments(parser)
+    parser.add_argument('output',
+                        type = argparse.FileType('wb'),
+                        help = 'generated image definition (XML)')
+    args = parser.parse_args()
+
+    tree = generate(ET.parse(args.base), ImageGenParams.from_args(args), args.root)
+    tree.write(args.output, encoding = 'UTF-8', xml_declaration = True)
+    args.output.close()
@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+# Physical memory backing store for Intel iAPX 432 utilities
+
+# Copyright 2014, 2015, 2016, 2017 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from abc import ABC, abstractmethod
+import mmap
+import struct
+
+
+class PhysicalMemory(ABC):
+    """
+    Base class for byte-addressed physical memory of a fixed size,
+    initially all zero.  Supports indexing and slicing for reads and
+    writes, like a bytearray.  Backends must implement read() and
+    write().
+    """
+    def __init__(self, size: int):
+        if size < 1:
+            raise ValueError('requested size is negative or zero')
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def _check_range(self, addr: int, size: int):
+        if addr < 0 or addr + size > self._size:
+            raise IndexError('physical address range %06x..%06x out of range' % (addr, addr + size - 1))
+
+    def _slice_range(self, key):
+        start, stop, step = key.indices(self._size)
+        if step != 1:
+            raise ValueError('extended slices not supported')
+        return start, max(start, stop)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop = self._slice_range(key)
+            return self.read(start, stop - start)
+        return self.read(key, 1)[0]
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            start, stop = self._slice_range(key)
+            value = bytes(value)
+            if len(value) != stop - start:
+                raise ValueError('physical memory size can not be changed')
+            self.write(start, value)
+        else:
+            self.write(key, bytes((value,)))
+
+    @abstractmethod
+    def read(self, addr: int, size: int) -> bytes:
+        pass
+
+    @abstractmethod
+    def write(self, addr: int, data):
+        pass
+
+    def pack_into(self, fmt: str, addr: int, *values):
+        """
+        Pack values using a struct format and write them at addr.
+        """
+        self.write(addr, struct.pack(fmt, *values))
+
+    def write_to_file(self, f, size: int):
+        """
+        Write the first size bytes of memory to a file.
+        """
+        f.write(self.read(0, size))
+
+    def close(self):
+        pass
+
+
+class FlatMemory(PhysicalMemory):
+    """
+    Physical memory backed by a single bytearray covering the entire
+    address space.
+    """
+    def __init__(self, size: int):
+        super().__init__(size)
+        self._mem = bytearray(size)
+
+    def read(self, addr: int, size: int) -> bytes:
+        self._check_range(addr, size)
+        return bytes(self._mem[addr:addr + size])
+
+    def write(self, addr: int, data):
+        self._check_range(addr, len(data))
+        self._mem[addr:addr + len(data)] = data
+
+    def pack_into(self, fmt: str, addr: int, *values):
+        self._check_range(addr, struct.calcsize(fmt))
+        struct.pack_into(fmt, self._mem, addr, *values)
+
+
+class SparseMemory(PhysicalMemory):
+    """
+    Physical memory backed by fixed-size pages, which are allocated
+    on the first write to the page.  Reads of unallocated pages return
+    zeros.
+    """
+    def __init__(self, size: int, page_size: int = 4096):
+        super().__init__(size)
+        if page_size & (page_size - 1):
+            raise ValueError('page size must be a power of two')
+        self._page_size = page_size
+        self._page_shift = page_size.bit_length() - 1
+        self._pages = { }
+
+    def page_count(self) -> int:
+        return len(self._pages)
+
+    def _page(self, index: int):
+        page = self._pages.get(index)
+        if page is None:
+            page = bytearray(self._page_size)
+            self._pages[index] = page
+        return page
+
+    def read(self, addr: int, size: int) -> bytes:
+        self._check_range(addr, size)
+        result = bytearray(size)
+        pos = 0
+        while pos < size:
+            index = (addr + pos) >> self._page_shift
+            offset = (addr + pos) & (self._page_size - 1)
+            count = min(size - pos, self._page_size - offset)
+            page = self._pages.get(index)
+            if page is not None:
+                result[pos:pos + count] = page[offset:offset + count]
+            pos += count
+        return bytes(result)
+
+    def write(self, addr: int, data):
+        size = len(data)
+        self._check_range(addr, size)
+        data = memoryview(data).cast('B')
+        pos = 0
+        while pos < size:
+            index = (addr + pos) >> self._page_shift
+            offset = (addr + pos) & (self._page_size - 1)
+            count = min(size - pos, self._page_size - offset)
+            self._page(index)[offset:offset + count] = data[pos:pos + count]
+            pos += count
+
+    def pack_into(self, fmt: str, addr: int, *values):
+        size = struct.calcsize(fmt)
+        self._check_range(addr, size)
+        offset = addr & (self._page_size - 1)
+        if offset + size <= self._page_size:
+            struct.pack_into(fmt, self._page(addr >> self._page_shift), offset, *values)
+        else:
+            self.write(addr, struct.pack(fmt, *values))
+
+    def write_to_file(self, f, size: int):
+        for addr in range(0, size, self._page_size):
+            count = min(size - addr, self._page_size)
+            page = self._pages.get(addr >> self._page_shift)
+            if page is None:
+                f.write(bytes(count))
+            else:
+                f.write(page[:count])
+
+
+class MmapMemory(FlatMemory):
+    """
+    Physical memory backed by a memory-mapped output file, so that the
+    image is written directly into the file.  The file must be open
+    for both reading and writing.  The file is extended to the size
+    of the address space while building, which on most file systems
+    doesn't allocate disk blocks, and is truncated to the image size by
+    write_to_file().
+    """
+    def __init__(self, f, size: int):
+        PhysicalMemory.__init__(self, size)
+        self._file = f
+        f.truncate(size)
+        self._mem = mmap.mmap(f.fileno(), size, access = mmap.ACCESS_WRITE)
+
+    def read(self, addr: int, size: int) -> bytes:
+        self._check_range(addr, size)
+        return self._mem[addr:addr + size]
+
+    def write_to_file(self, f, size: int):
+        assert f is self._file
+        self._mem.flush()
+        self.close()
+        f.truncate(size)
+        f.seek(size)
+
+    def close(self):
+        if not self._mem.closed:
+            self._mem.close()
+
+
+phys_mem_backends = { 'sparse': SparseMemory,
+                      'flat':   FlatMemory,
+                      'mmap':   MmapMemory }
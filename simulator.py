@@ -0,0 +1,908 @@
+#!/usr/bin/env python3
+# Intel iAPX 432 GDP simulator
+
+# Copyright 2014, 2015, 2016, 2017 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The simulator executes a single context of an image built by
+# builder.py, in a copy of the image, so the image file isn't changed.
+# Access descriptors are resolved through the object table directory
+# and object tables of the image, as by the GDP.
+#
+# Each instruction is decoded only the first time it is executed, into
+# a step function: a closure which reads the source operands, applies
+# the operator, writes the result, and returns the bit offset of the
+# next instruction.  Data references with a direct selector and a
+# scalar displacement, which are most of them, are resolved to a
+# physical address when the step function is made.  Step functions are
+# cached per instruction segment, by bit offset.  Writing to an
+# instruction segment discards its cached step functions.  Writing to
+# an object table discards all resolved descriptors, and all step
+# functions, since they refer to the resolved segments.
+#
+# Only the computational operators on characters, short ordinals,
+# ordinals, short integers and integers, moves of reals, the
+# intrasegment branch operators and the interconnect operators are
+# implemented.  There is no fault handling; a fault stops the
+# simulation, as does return_from_context, since contexts and processes
+# aren't simulated.
+
+import argparse
+import sys
+import time
+
+from arch import load_arch_from_args
+from archtables import (SegmentField, add_arch_cache_arguments,
+                        load_tables_py, update_tables_py)
+from decode import (AccessDescriptor, Coord, InterconnectDescriptor,
+                    StorageDescriptor, descriptor_class, map_image)
+from disassembler import (DecodeError, DecodeTables, DirectSelector,
+                          Disassembler, format_instruction,
+                          get_decode_tables)
+
+
+class SimulatorFault(Exception):
+    pass
+
+
+class _Halt(Exception):
+    def __init__(self, ip):
+        self.ip = ip
+
+
+# The object table directory is at a fixed physical address, and its
+# own descriptor is its entry 2.
+object_table_directory_base = 8
+object_table_directory_index = 2
+
+
+class SegmentInfo(object):
+    """
+    A segment resolved from its object descriptor.  For an interconnect
+    segment, base is the interconnect address.
+    """
+    __slots__ = ('coord', 'base', 'length', 'base_type', 'system_type',
+                 'interconnect', 'watched')
+
+    def __init__(self, coord, base, length, base_type = None, system_type = None,
+                 interconnect = False, watched = False):
+        self.coord = coord
+        self.base = base
+        self.length = length
+        self.base_type = base_type
+        self.system_type = system_type
+        self.interconnect = interconnect
+        self.watched = watched     # writes must invalidate cached state
+
+
+class InterconnectSpace(object):
+    """
+    Interconnect address space without any devices.  A register reads
+    as the last value written to it, or zero.
+    """
+    def __init__(self):
+        self.registers = { }
+
+    def read(self, address):
+        return self.registers.get(address, 0)
+
+    def write(self, address, value):
+        self.registers[address] = value
+
+
+# Operators computing a result from their source operands, by name.
+# Operand values are unsigned; results may be negative, and are
+# truncated to the width of the destination operand.
+operator_functions = { }
+
+def _fault(msg):
+    raise SimulatorFault(msg)
+
+def _define_numeric_operators(suffix, bits, signed, wrap):
+    mask = (1 << bits) - 1
+    sign = 1 << (bits - 1)
+    if signed:
+        lo, hi = -sign, sign - 1
+        value = lambda a: a - (1 << bits) if a & sign else a
+    else:
+        lo, hi = 0, mask
+        value = lambda a: a
+
+    # The arithmetic operators are written out for unsigned operands,
+    # which are the common case.
+    if wrap:
+        check = lambda r: r
+        add = lambda a, b: a + b
+        subtract = lambda a, b: a - b
+        multiply = lambda a, b: a * b
+        increment = lambda a: a + 1
+        decrement = lambda a: a - 1
+    else:
+        check = lambda r: r if lo <= r <= hi else _fault('overflow')
+        if signed:
+            add = lambda a, b: check(value(a) + value(b))
+            subtract = lambda a, b: check(value(a) - value(b))
+            multiply = lambda a, b: check(value(a) * value(b))
+            increment = lambda a: check(value(a) + 1)
+            decrement = lambda a: check(value(a) - 1)
+        else:
+            def add(a, b):
+                r = a + b
+                return r if r <= hi else _fault('overflow')
+            def subtract(a, b):
+                r = a - b
+                return r if r >= 0 else _fault('overflow')
+            def multiply(a, b):
+                r = a * b
+                return r if r <= hi else _fault('overflow')
+            def increment(a):
+                return a + 1 if a < hi else _fault('overflow')
+            def decrement(a):
+                return a - 1 if a else _fault('overflow')
+
+    def divide(a, b):
+        a, b = value(a), value(b)
+        if b == 0:
+            _fault('divide by zero')
+        q = abs(a) // abs(b)
+        return check(-q if (a < 0) != (b < 0) else q)
+
+    def remainder(a, b):
+        a, b = value(a), value(b)
+        if b == 0:
+            _fault('divide by zero')
+        r = abs(a) % abs(b)
+        return -r if a < 0 else r
+
+    ops = { 'move':                  lambda a: a,
+            'zero':                  lambda: 0,
+            'one':                   lambda: 1,
+            'add':                   add,
+            'subtract':              subtract,
+            'multiply':              multiply,
+            'divide':                divide,
+            'remainder':             remainder,
+            'increment':             increment,
+            'decrement':             decrement,
+            'equal':                 lambda a, b: int(a == b),
+            'not_equal':             lambda a, b: int(a != b),
+            'equal_zero':            lambda a: int(a == 0),
+            'not_equal_zero':        lambda a: int(a != 0),
+            'indivisibly_add':       add }
+    if signed:
+        ops.update({ 'greater_than':          lambda a, b: int(value(a) > value(b)),
+                     'greater_than_or_equal': lambda a, b: int(value(a) >= value(b)),
+                     'negate':                lambda a: check(-value(a)),
+                     'positive':              lambda a: int(value(a) > 0),
+                     'negative':              lambda a: int(value(a) < 0) })
+    else:
+        ops.update({ 'greater_than':          lambda a, b: int(a > b),
+                     'greater_than_or_equal': lambda a, b: int(a >= b),
+                     'and':                   lambda a, b: a & b,
+                     'or':                    lambda a, b: a | b,
+                     'xor':                   lambda a, b: a ^ b,
+                     'xnor':                  lambda a, b: ~(a ^ b) & mask,
+                     'complement':            lambda a: ~a & mask })
+    for name, f in ops.items():
+        operator_functions[name + '_' + suffix] = f
+
+_define_numeric_operators('character',     8,  False, True)
+_define_numeric_operators('short_ordinal', 16, False, False)
+_define_numeric_operators('short_integer', 16, True,  False)
+_define_numeric_operators('ordinal',       32, False, False)
+_define_numeric_operators('integer',       32, True,  False)
+
+# reals are only moved, not interpreted
+for suffix in ('short_real', 'real', 'temporary_real'):
+    operator_functions['move_' + suffix] = lambda a: a
+    operator_functions['zero_' + suffix] = lambda: 0
+
+def _convert(bits, signed, signed_result, result_bits):
+    lo = -(1 << (result_bits - 1)) if signed_result else 0
+    hi = (1 << (result_bits - 1 if signed_result else result_bits)) - 1
+    sign = 1 << (bits - 1)
+    def f(a):
+        if signed and a & sign:
+            a -= 1 << bits
+        return a if lo <= a <= hi else _fault('range')
+    return f
+
+operator_functions.update({
+    'convert_character_to_short_ordinal': _convert(8,  False, False, 16),
+    'convert_short_ordinal_to_character': _convert(16, False, False, 8),
+    'convert_short_ordinal_to_ordinal':   _convert(16, False, False, 32),
+    'convert_short_integer_to_integer':   _convert(16, True,  True,  32),
+    'convert_ordinal_to_short_ordinal':   _convert(32, False, False, 16),
+    'convert_ordinal_to_integer':         _convert(32, False, True,  32),
+    'convert_integer_to_short_integer':   _convert(32, True,  True,  16),
+    'convert_integer_to_ordinal':         _convert(32, True,  False, 32) })
+
+
+def _discard(v):
+    pass
+
+
+# Returns a step function applying f to the values returned by the
+# source readers, and passing the result to write.  If order isn't
+# None, the readers aren't in the order of f's arguments, and order
+# gives the index in reads of each argument.
+def _value_step(reads, f, write, next_ip, order = None):
+    if write is None:
+        write = _discard
+    if order is not None:
+        g = f
+        f = lambda *values: g(*[values[k] for k in order])
+    if len(reads) == 0:
+        def step():
+            write(f())
+            return next_ip
+    elif len(reads) == 1:
+        r0, = reads
+        def step():
+            write(f(r0()))
+            return next_ip
+    elif len(reads) == 2:
+        r0, r1 = reads
+        def step():
+            write(f(r0(), r1()))
+            return next_ip
+    else:
+        r0, r1, r2 = reads
+        def step():
+            write(f(r0(), r1(), r2()))
+            return next_ip
+    return step
+
+
+def _with_prologue(prologue, step):
+    def prologue_step():
+        for locate in prologue:
+            locate()
+        return step()
+    return prologue_step
+
+
+class Simulator(object):
+    """
+    Simulator of a GDP executing a context of an image.
+
+    Args:
+        arch:         Arch, or None if tables is given
+        image:        bytes-like image, which is copied
+        interconnect: object with read(address) and write(address, value)
+                      methods for the interconnect address space,
+                      defaults to an InterconnectSpace
+        tables:       decoding tables module written by
+                      arch.gen_tables_py(), used instead of the Arch
+    """
+    def __init__(self, arch, image, interconnect = None, tables = None):
+        self.arch = arch
+        self.mem = bytearray(image)
+        self.interconnect = InterconnectSpace() if interconnect is None else interconnect
+        if tables is None:
+            self.tables = get_decode_tables(arch)
+
+            def enum(name, value):
+                return arch.get_enumeration_value(name, value)['value']
+
+            def fields(name):
+                return arch.symbols[name].value.field_by_name
+        else:
+            self.tables = DecodeTables.from_module(tables)
+
+            def enum(name, value):
+                return tables.enumerations[name][value]
+
+            def fields(name):
+                return { field_name: SegmentField(*field)
+                         for field_name, field in tables.segments[name].items() }
+        self.disassembler = Disassembler(arch, self.tables)
+
+        self.data_segment_type = enum('base_type', 'data_segment')
+        self.access_segment_type = enum('base_type', 'access_segment')
+        self.instruction_type = enum('system_type', 'instruction')
+        self.object_table_type = enum('system_type', 'object_table')
+
+        self.context_slots = { name: f.offset_bits // 32
+                               for name, f in fields('context_access_segment').items() }
+        self.process_current_context = fields('process_access_segment')['current_context'].offset_bits // 32
+        self.context_fields = fields('context_data_segment')
+        self.initial_instruction_displacement = fields('instruction_data_segment')['initial_instruction_displacement']
+
+        self.segments = { }    # SegmentInfo by Coord
+        self.selectors = { }   # SegmentInfo by object selector
+        self.code = { }        # step functions by bit offset, by Coord
+
+        self.context = None
+        self.context_data = None
+        self.code_segment = None
+        self.instruction_index = None
+        self.stack = None
+        self.sp = 0
+        self.ip = None
+        self.halted = False
+        self.steps = 0
+
+    def _clear(self):
+        self.segments.clear()
+        self.selectors.clear()
+        for code in self.code.values():
+            code.clear()
+
+    def flush(self):
+        """
+        Discard all resolved descriptors and selectors, and cached step
+        functions, and resolve the segments of the running context
+        again from the object tables.
+
+        Raises:
+            SimulatorFault if a segment of the running context is no
+            longer valid
+        """
+        self._clear()
+        if self.context is None:
+            return
+        self.context = self.segment(self.context.coord)
+        self.context_data = self._data_segment(self.segment(self.context_data.coord))
+        self.stack = self._data_segment(self.segment(self.stack.coord))
+        code_segment = self._data_segment(self.segment(self.code_segment.coord))
+        if code_segment.system_type != self.instruction_type:
+            raise SimulatorFault('object %d/%d is not an instruction segment' % (code_segment.coord.dir_index, code_segment.coord.seg_index))
+        self.code_segment = code_segment
+        self.code_data = memoryview(self.mem)[code_segment.base:code_segment.base + code_segment.length]
+
+    def _written(self, seg):
+        code = self.code.get(seg.coord)
+        if code:
+            code.clear()
+        if seg.system_type == self.object_table_type:
+            self.flush()
+
+    def _table_entry(self, base, length, index):
+        offset = index * 16
+        if offset + 16 > length:
+            return None
+        v = int.from_bytes(self.mem[base + offset:base + offset + 16], 'little')
+        cls = descriptor_class(v & 0xff)
+        return None if cls is None else cls._from_int(v)
+
+    def descriptor(self, coord):
+        """
+        Return the object descriptor for coord, found through the object
+        table directory, or None if there is none.
+        """
+        otd = self._table_entry(object_table_directory_base,
+                                (object_table_directory_index + 1) * 16,
+                                object_table_directory_index)
+        if not isinstance(otd, StorageDescriptor) or not otd.valid:
+            raise SimulatorFault('invalid object table directory descriptor')
+        table = self._table_entry(otd.segment_base, otd.segment_length + 1, coord.dir_index)
+        if not isinstance(table, StorageDescriptor) or not table.valid:
+            return None
+        return self._table_entry(table.segment_base, table.segment_length + 1, coord.seg_index)
+
+    def segment(self, coord):
+        """
+        Return the SegmentInfo for coord.
+
+        Raises:
+            SimulatorFault if coord doesn't designate a valid segment
+        """
+        seg = self.segments.get(coord)
+        if seg is not None:
+            return seg
+        d = self.descriptor(coord)
+        if isinstance(d, StorageDescriptor) and d.valid and d.storage_associated:
+            seg = SegmentInfo(coord, d.segment_base, d.segment_length + 1,
+                              d.base_type, d.system_type)
+            if seg.base + seg.length > len(self.mem):
+                raise SimulatorFault('object %d/%d extends beyond image' % (coord.dir_index, coord.seg_index))
+            seg.watched = (seg.base_type == self.data_segment_type and
+                           seg.system_type in (self.instruction_type, self.object_table_type))
+        elif isinstance(d, InterconnectDescriptor) and d.valid:
+            seg = SegmentInfo(coord, d.base_address, d.length + 1, interconnect = True)
+        else:
+            raise SimulatorFault('object %d/%d is not a valid segment' % (coord.dir_index, coord.seg_index))
+        self.segments[coord] = seg
+        return seg
+
+    def access_descriptor(self, seg, slot):
+        """
+        Return the SegmentInfo of the segment referenced by the AD in
+        slot of access segment seg.
+        """
+        if seg.base_type != self.access_segment_type:
+            raise SimulatorFault('object %d/%d is not an access segment' % (seg.coord.dir_index, seg.coord.seg_index))
+        if (slot + 1) * 4 > seg.length:
+            raise SimulatorFault('AD index %d beyond end of access segment %d/%d' % (slot, seg.coord.dir_index, seg.coord.seg_index))
+        a = seg.base + slot * 4
+        ad = AccessDescriptor._from_int(int.from_bytes(self.mem[a:a + 4], 'little'))
+        if not ad.valid:
+            raise SimulatorFault('null AD at index %d of access segment %d/%d' % (slot, seg.coord.dir_index, seg.coord.seg_index))
+        return self.segment(Coord(ad.dir_index, ad.seg_index))
+
+    def selector_segment(self, selector):
+        """
+        Return the SegmentInfo of the segment designated by an object
+        selector, which selects an entry access segment of the current
+        context, and an AD within it.
+        """
+        seg = self.selectors.get(selector)
+        if seg is None:
+            eas = selector & 3
+            if eas == 0:
+                access_segment = self.context
+            else:
+                access_segment = self.access_descriptor(self.context,
+                                                        self.context_slots['entry_access_segment_%d' % eas])
+            seg = self.access_descriptor(access_segment, selector >> 2)
+            self.selectors[selector] = seg
+        return seg
+
+    def _data_segment(self, seg):
+        if seg.interconnect or seg.base_type != self.data_segment_type:
+            raise SimulatorFault('object %d/%d is not a data segment' % (seg.coord.dir_index, seg.coord.seg_index))
+        return seg
+
+    def read(self, seg, offset, size_bytes):
+        if offset + size_bytes > seg.length:
+            raise SimulatorFault('displacement %d beyond end of segment %d/%d' % (offset, seg.coord.dir_index, seg.coord.seg_index))
+        a = seg.base + offset
+        return int.from_bytes(self.mem[a:a + size_bytes], 'little')
+
+    def write(self, seg, offset, size_bytes, value):
+        if offset + size_bytes > seg.length:
+            raise SimulatorFault('displacement %d beyond end of segment %d/%d' % (offset, seg.coord.dir_index, seg.coord.seg_index))
+        a = seg.base + offset
+        self.mem[a:a + size_bytes] = (value & ((1 << (8 * size_bytes)) - 1)).to_bytes(size_bytes, 'little')
+        if seg.watched:
+            self._written(seg)
+
+    # Fields of system objects beyond the end of the segment read as
+    # zero, and aren't written.
+    def _read_field(self, seg, name):
+        f = self.context_fields[name] if isinstance(name, str) else name
+        if (f.offset_bits + f.size_bits) // 8 > seg.length:
+            return 0
+        return self.read(seg, f.offset_bits // 8, f.size_bits // 8)
+
+    def _write_field(self, seg, name, value):
+        f = self.context_fields[name]
+        if (f.offset_bits + f.size_bits) // 8 <= seg.length:
+            self.write(seg, f.offset_bits // 8, f.size_bits // 8, value)
+
+    def pop(self, size_bytes):
+        sp = self.sp - size_bytes
+        if sp < 0:
+            raise SimulatorFault('operand stack underflow')
+        self.sp = sp
+        a = self.stack.base + sp
+        return int.from_bytes(self.mem[a:a + size_bytes], 'little')
+
+    def top(self, size_bytes):
+        if self.sp < size_bytes:
+            raise SimulatorFault('operand stack underflow')
+        a = self.stack.base + self.sp - size_bytes
+        return int.from_bytes(self.mem[a:a + size_bytes], 'little')
+
+    def start(self, context, instruction_index = None, ip = None):
+        """
+        Prepare to execute a context.
+
+        Args:
+            context:           Coord of the context access segment
+            instruction_index: index in the domain of the instruction
+                               segment, defaults to the current
+                               instruction object index of the context
+            ip:                bit offset of the first instruction,
+                               defaults to the instruction pointer of
+                               the context, or if that is zero, the
+                               initial instruction displacement of the
+                               instruction segment
+        """
+        self._clear()
+        self.context = self.segment(context)
+        slots = self.context_slots
+        self.context_data = self._data_segment(self.access_descriptor(self.context, slots['context_data_segment']))
+        if instruction_index is None:
+            instruction_index = self._read_field(self.context_data, 'current_instruction_object_index')
+        domain = self.access_descriptor(self.context, slots['domain_of_definition'])
+        code_segment = self._data_segment(self.access_descriptor(domain, instruction_index))
+        if code_segment.system_type != self.instruction_type:
+            raise SimulatorFault('object %d/%d is not an instruction segment' % (code_segment.coord.dir_index, code_segment.coord.seg_index))
+        if ip is None:
+            ip = self._read_field(self.context_data, 'instruction_pointer')
+        if not ip:
+            ip = self._read_field(code_segment, self.initial_instruction_displacement)
+        self.stack = self._data_segment(self.access_descriptor(self.context, slots['operand_stack']))
+        self.sp = self._read_field(self.context_data, 'stack_pointer')
+        self.instruction_index = instruction_index
+        self.code_segment = code_segment
+        self.code_data = memoryview(self.mem)[code_segment.base:code_segment.base + code_segment.length]
+        self.code.setdefault(code_segment.coord, { })
+        self.ip = ip
+        self.halted = False
+        self.steps = 0
+
+    def start_process(self, process, instruction_index = None, ip = None):
+        """
+        Prepare to execute the current context of a process, given the
+        Coord of its process access segment.
+        """
+        context = self.access_descriptor(self.segment(process), self.process_current_context)
+        self.start(context.coord, instruction_index, ip)
+
+    def save_state(self):
+        """
+        Write the instruction pointer and stack pointer to the context
+        data segment.
+        """
+        self._write_field(self.context_data, 'instruction_pointer', self.ip)
+        self._write_field(self.context_data, 'stack_pointer', self.sp)
+        self._write_field(self.context_data, 'current_instruction_object_index', self.instruction_index)
+
+    def run(self, steps = None, trace = None):
+        """
+        Execute instructions until the context halts or faults, or steps
+        instructions have been executed.
+
+        Args:
+            steps: maximum number of instructions, defaults to no limit
+            trace: text file to which to list each instruction before
+                   it is executed
+
+        Returns:
+            The number of instructions executed.
+
+        Raises:
+            SimulatorFault, with the instruction pointer of the
+            faulting instruction left in ip
+        """
+        insns = self.code[self.code_segment.coord]
+        predecode = self._predecode
+        limit = sys.maxsize if steps is None else steps
+        ip = self.ip
+        count = 0
+        try:
+            if trace is None:
+                for count in range(limit):
+                    ip = (insns.get(ip) or predecode(ip))()
+                else:
+                    count = limit
+            else:
+                for count in range(limit):
+                    step = insns.get(ip) or predecode(ip)
+                    print('%5d: %s' % (ip, format_instruction(self.disassembler.decode(self.code_data, ip))), file = trace)
+                    ip = step()
+                else:
+                    count = limit
+        except _Halt as e:
+            ip = e.ip
+            count += 1
+            self.halted = True
+        finally:
+            self.ip = ip
+            self.steps += count
+            self.save_state()
+        return count
+
+    def _predecode(self, ip):
+        try:
+            insn = self.disassembler.decode(self.code_data, ip)
+        except DecodeError as e:
+            raise SimulatorFault(str(e))
+        next_ip = ip + insn.size_bits
+        operator = insn.operator
+        name = operator.names[0]
+
+        if insn.branch_ref is not None:
+            if insn.branch_ref.absolute:
+                target = insn.branch_ref.value
+            else:
+                target = ip + insn.branch_ref.value
+
+        reads, order, write, prologue = self._operands(insn)
+
+        if name == 'branch':
+            def step():
+                return target
+        elif name in ('branch_true', 'branch_false'):
+            r0, = reads
+            if name == 'branch_true':
+                def step():
+                    return target if r0() & 1 else next_ip
+            else:
+                def step():
+                    return next_ip if r0() & 1 else target
+        elif name == 'branch_indirect':
+            r0, = reads
+            def step():
+                return r0()
+        elif name == 'return_from_context':
+            def step():
+                raise _Halt(next_ip)
+        elif name.startswith('save_'):
+            size_bytes = insn.clas.refs[0] // 8
+            step = _value_step([], lambda: self.top(size_bytes), write, next_ip)
+        elif name == 'move_to_interconnect':
+            step = _value_step(reads, self._move_to_interconnect, None, next_ip, order)
+        elif name == 'move_from_interconnect':
+            step = _value_step(reads, self._move_from_interconnect, write, next_ip, order)
+        else:
+            for name in operator.names:
+                f = operator_functions.get(name)
+                if f is not None:
+                    break
+            else:
+                raise SimulatorFault('unimplemented operator %s' % name)
+            step = _value_step(reads, f, write, next_ip, order)
+        if prologue:
+            step = _with_prologue(prologue, step)
+
+        self.code[self.code_segment.coord][ip] = step
+        return step
+
+    def _interconnect_address(self, selector, displacement):
+        seg = self.selector_segment(selector)
+        if not seg.interconnect:
+            raise SimulatorFault('object %d/%d is not an interconnect segment' % (seg.coord.dir_index, seg.coord.seg_index))
+        if displacement >= seg.length:
+            raise SimulatorFault('displacement %d beyond end of interconnect segment %d/%d' % (displacement, seg.coord.dir_index, seg.coord.seg_index))
+        return seg.base + displacement
+
+    def _move_to_interconnect(self, selector, displacement, value):
+        self.interconnect.write(self._interconnect_address(selector, displacement), value)
+
+    def _move_from_interconnect(self, selector, displacement):
+        return self.interconnect.read(self._interconnect_address(selector, displacement))
+
+    def _operands(self, insn):
+        """
+        Return the operand accessors of an instruction:
+
+            reads:    functions returning the values of the source
+                      operands, in the order in which they are read
+            order:    for each source operand, in operand order, its
+                      index in reads, or None if that's the same order
+            write:    function writing the destination operand, or None
+            prologue: functions to be called before reading any operand
+        """
+        operand_refs = self.tables.format_refs[id(insn.format)][0]
+        modes = insn.operator.modes
+        # Data references other than direct scalar ones are located
+        # once per execution, before any operand is read, in case
+        # locating them pops the operand stack.
+        located = { }
+        prologue = []
+        sources = []
+        write = None
+        for i, operand in enumerate(insn.format.operands):
+            size_bytes = insn.clas.refs[i] // 8
+            ref_index = operand_refs[i]
+            if ref_index is None:
+                # stack operands are popped in order, stk1 before stk2
+                key = int(operand[3:]) if operand[3:] else i
+                r, w = self._stack_accessors(size_bytes)
+            else:
+                key = i
+                ref = insn.refs[ref_index]
+                if ref.displacement_type == 'scalar' and isinstance(ref.segment, DirectSelector):
+                    r, w = self._direct_accessors(ref, size_bytes)
+                else:
+                    if ref_index not in located:
+                        cell = [None]
+                        located[ref_index] = cell
+                        prologue.append(self._locator(ref, size_bytes, cell))
+                    r, w = self._located_accessors(located[ref_index], size_bytes)
+            if modes[i] in ('r', 'rmw'):
+                sources.append((key, r))
+            if modes[i] in ('w', 'rmw'):
+                write = w
+        by_key = sorted(range(len(sources)), key = lambda k: sources[k][0])
+        reads = [sources[k][1] for k in by_key]
+        order = None
+        if by_key != list(range(len(sources))):
+            order = [by_key.index(k) for k in range(len(sources))]
+        return reads, order, write, prologue
+
+    def _direct_accessors(self, ref, size_bytes):
+        seg = self._data_segment(self.selector_segment(ref.segment.eas | (ref.segment.slot << 2)))
+        if ref.displacement + size_bytes > seg.length:
+            raise SimulatorFault('displacement %d beyond end of segment %d/%d' % (ref.displacement, seg.coord.dir_index, seg.coord.seg_index))
+        mem = self.mem
+        a = seg.base + ref.displacement
+        b = a + size_bytes
+        mask = (1 << (8 * size_bytes)) - 1
+        from_bytes = int.from_bytes
+
+        def read():
+            return from_bytes(mem[a:b], 'little')
+
+        if seg.watched:
+            def write(v):
+                mem[a:b] = (v & mask).to_bytes(size_bytes, 'little')
+                self._written(seg)
+        else:
+            def write(v):
+                mem[a:b] = (v & mask).to_bytes(size_bytes, 'little')
+        return read, write
+
+    def _stack_accessors(self, size_bytes):
+        mem = self.mem
+        base = self.stack.base
+        length = self.stack.length
+        mask = (1 << (8 * size_bytes)) - 1
+        from_bytes = int.from_bytes
+
+        def read():
+            sp = self.sp - size_bytes
+            if sp < 0:
+                raise SimulatorFault('operand stack underflow')
+            self.sp = sp
+            a = base + sp
+            return from_bytes(mem[a:a + size_bytes], 'little')
+
+        def write(v):
+            sp = self.sp
+            if sp + size_bytes > length:
+                raise SimulatorFault('operand stack overflow')
+            a = base + sp
+            mem[a:a + size_bytes] = (v & mask).to_bytes(size_bytes, 'little')
+            self.sp = sp + size_bytes
+        return read, write
+
+    def _located_accessors(self, cell, size_bytes):
+        def read():
+            seg, offset = cell[0]
+            return self.read(seg, offset, size_bytes)
+
+        def write(v):
+            seg, offset = cell[0]
+            self.write(seg, offset, size_bytes, v)
+        return read, write
+
+    def _selector_function(self, sel):
+        if isinstance(sel, DirectSelector):
+            seg = self.selector_segment(sel.eas | (sel.slot << 2))
+            return lambda: seg
+        if sel.type == 'operand_stack':
+            return lambda: self.selector_segment(self.pop(2))
+        selector_seg = self._selector_function(sel.selector)
+        displacement = sel.displacement
+        return lambda: self.selector_segment(self.read(self._data_segment(selector_seg()), displacement, 2))
+
+    # Returns a function returning the 16-bit value designated by an
+    # indirect reference, given the segment of the operand.
+    def _indirect_function(self, ind):
+        if ind.type == 'operand_stack':
+            return lambda seg: self.pop(2)
+        displacement = ind.displacement
+        if ind.type == 'intrasegment':
+            return lambda seg: self.read(seg, displacement, 2)
+        indirect_seg = self._selector_function(ind.selector)
+        return lambda seg: self.read(self._data_segment(indirect_seg()), displacement, 2)
+
+    def _locator(self, ref, size_bytes, cell):
+        """
+        Return a function storing the segment and displacement of the
+        operand designated by a data reference in cell[0].
+        """
+        segment = self._selector_function(ref.segment)
+        if ref.displacement_type == 'scalar':
+            def offset(seg):
+                return ref.displacement
+        elif ref.displacement_type == 'record_item':
+            base = self._indirect_function(ref.base)
+            def offset(seg):
+                return base(seg) + ref.index
+        elif ref.displacement_type == 'static_vector_element':
+            index = self._indirect_function(ref.index)
+            def offset(seg):
+                return ref.base + index(seg) * size_bytes
+        else:
+            base = self._indirect_function(ref.base)
+            index = self._indirect_function(ref.index)
+            def offset(seg):
+                b = base(seg)
+                return b + index(seg) * size_bytes
+
+        def locate():
+            seg = self._data_segment(segment())
+            cell[0] = (seg, offset(seg))
+        return locate
+
+
+def parse_coord(s):
+    try:
+        d, s = s.split('/')
+        return Coord(int(d, 0), int(s, 0))
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid coordinate %s, expected D/S' % s)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='iAPX 432 GDP Simulator')
+    arg_parser.add_argument('-a', '--arch',
+                            type=argparse.FileType('r'),
+                            default='iapx432-1.0.xml',
+                            help='architecture definition (XML)')
+    arg_parser.add_argument('image_binary',
+                            type=argparse.FileType('rb'),
+                            help='image binary input')
+    group = arg_parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--context',
+                       type=parse_coord,
+                       metavar='D/S',
+                       help='coordinates of the context access segment to execute')
+    group.add_argument('--process',
+                       type=parse_coord,
+                       metavar='D/S',
+                       help='coordinates of the process access segment whose current context to execute')
+    arg_parser.add_argument('--instruction-index',
+                            type=int,
+                            help='index in the domain of the instruction segment (default per context)')
+    arg_parser.add_argument('--ip',
+                            type=int,
+                            help='bit offset of the first instruction (default per context)')
+    arg_parser.add_argument('--steps',
+                            type=int,
+                            default=1000000,
+                            help='maximum number of instructions to execute (default 1000000)')
+    arg_parser.add_argument('--trace',
+                            action='store_true',
+                            help='list each instruction as it is executed')
+    arg_parser.add_argument('--tables',
+                            metavar='TABLES_PY',
+                            help='use a decoding tables module generated by arch.py, regenerating it if it isn\'t current')
+
+    add_arch_cache_arguments(arg_parser)
+
+    args = arg_parser.parse_args()
+
+    if args.tables is not None:
+        args.arch.close()
+        update_tables_py(args.arch.name, args.tables,
+                         cache_dir = args.arch_cache_dir,
+                         use_cache = not args.no_arch_cache)
+        arch = None
+        tables = load_tables_py(args.tables)
+    else:
+        arch = load_arch_from_args(args)
+        tables = None
+
+    image = map_image(args.image_binary)
+    args.image_binary.close()
+
+    sim = Simulator(arch, image, tables = tables)
+    status = 0
+    start_time = time.perf_counter()
+    try:
+        if args.process is not None:
+            sim.start_process(args.process, args.instruction_index, args.ip)
+        else:
+            sim.start(args.context, args.instruction_index, args.ip)
+        sim.run(args.steps, sys.stdout if args.trace else None)
+        if sim.halted:
+            print('halted at bit offset %d' % sim.ip)
+        else:
+            print('stopped at bit offset %d' % sim.ip)
+    except SimulatorFault as e:
+        if sim.ip is None:
+            print('fault: %s' % e)
+        else:
+            print('fault at bit offset %d: %s' % (sim.ip, e))
+        status = 1
+    elapsed = time.perf_counter() - start_time
+    print('%d instructions in %.3f s, %.0f instructions per second' % (sim.steps, elapsed, sim.steps / elapsed if elapsed else 0))
+    sys.exit(status)